@@ -0,0 +1,300 @@
+"""
+Batched move generation
+
+Attack maps, check status and legal move counts of many positions at once,
+computed with NumPy over an int8[N, 64] array of piece codes (see
+model.Piece.code, EMPTY for an empty square) plus per position vectors of
+side to move (bitboard.WHITE/BLACK), castling rights (model bits) and en
+passant square (-1 if none). The kernels loop over directions and steps,
+never over positions, and agree with MoveGenerator.
+"""
+from __future__ import annotations
+
+from typing import Iterable
+
+import numpy as np
+
+from fen import parse_fen
+from bitboard import Bitboards
+from model import GameState, GameStateFlag, Vector, KNIGHT_MOVEMENTS, GODLIKE_MOVEMENTS, BISHOP_MOVEMENTS, \
+    PAWN_ATTACK_MOVEMENTS, TOP_DIRECTION, DIRECTION_INDEX, WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, \
+    BLACK_QUEENSIDE, EMPTY_CODE, COLORS, WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
+
+EMPTY = -1
+# Every board gets an extra column, the square off board steps land on
+OFF_BOARD = -2
+OFF = 64
+# FROM_COMPACT[code], CompactBoard codes to the ones used here
+FROM_COMPACT = np.array(range(EMPTY_CODE + 1), np.int8)
+FROM_COMPACT[EMPTY_CODE] = EMPTY
+
+
+# --------------
+# TABLES
+# --------------
+
+def _offset_table(step: tuple[int, int]) -> np.ndarray:
+    """ table[square], the square one step away or OFF. Distinct squares never share a target """
+    dx, dy = step
+    table = np.full(64, OFF, np.intp)
+    for square in range(64):
+        x, y = square % 8 + dx, square // 8 + dy
+        if 0 <= x < 8 and 0 <= y < 8:
+            table[square] = y * 8 + x
+    return table
+
+
+def _axis(step: tuple[int, int]) -> int:
+    """ Both directions of a line share the smallest direction index """
+    x, y = step
+    return min(DIRECTION_INDEX[x, y], DIRECTION_INDEX[-x, -y])
+
+
+KNIGHT_STEPS = np.stack([_offset_table(step) for step in KNIGHT_MOVEMENTS])
+KING_STEPS = np.stack([_offset_table(step) for step in GODLIKE_MOVEMENTS])
+# RAY_STEPS[direction, k, square], k + 1 squares away
+RAY_STEPS = np.stack([np.stack([_offset_table(tuple(step * distance)) for distance in range(1, 8)])
+                      for step in GODLIKE_MOVEMENTS])
+LINE_PIECE = tuple(BISHOP if step in BISHOP_MOVEMENTS else ROOK for step in GODLIKE_MOVEMENTS)
+AXIS = tuple(_axis(step) for step in GODLIKE_MOVEMENTS)
+
+# Indexed by side
+PAWN_CAPTURES = tuple(tuple(Vector(*v, color.direction()) for v in PAWN_ATTACK_MOVEMENTS) for color in COLORS)
+PAWN_CAPTURE_STEPS = tuple(np.stack([_offset_table(step) for step in steps]) for steps in PAWN_CAPTURES)
+PAWN_CAPTURE_AXES = tuple(tuple(map(_axis, steps)) for steps in PAWN_CAPTURES)
+PAWN_PUSH_STEPS = tuple(_offset_table(TOP_DIRECTION * color.direction()) for color in COLORS)
+PUSH_AXIS = _axis(TOP_DIRECTION)
+PAWN_START_RANK = (1, 6)
+PAWN_PROMOTION_RANK = (6, 1)
+
+# side, castling right, squares that must be empty, squares that must not be attacked, rook square
+CASTLES = (
+    (WHITE, WHITE_KINGSIDE, (5, 6), (5, 6), 7),
+    (WHITE, WHITE_QUEENSIDE, (1, 2, 3), (2, 3), 0),
+    (BLACK, BLACK_KINGSIDE, (61, 62), (61, 62), 63),
+    (BLACK, BLACK_QUEENSIDE, (57, 58, 59), (58, 59), 56),
+)
+
+
+def _rank(rank: int) -> np.ndarray:
+    squares = np.zeros(64, bool)
+    squares[rank * 8:rank * 8 + 8] = True
+    return squares
+
+
+# --------------
+# TABLES
+# --------------
+
+
+class Positions:
+    """ N positions as arrays, boards is int8[N, 64] """
+    boards: np.ndarray
+    side: np.ndarray
+    castling: np.ndarray
+    en_passant: np.ndarray
+
+    def __init__(self, boards: np.ndarray, side: np.ndarray, castling: np.ndarray, en_passant: np.ndarray):
+        self.boards = np.asarray(boards, np.int8)
+        self.side = np.asarray(side, np.int8)
+        self.castling = np.asarray(castling, np.uint8)
+        self.en_passant = np.asarray(en_passant, np.int8)
+
+    def __len__(self):
+        return len(self.boards)
+
+    @classmethod
+    def from_states(cls, states: Iterable[GameState]) -> Positions:
+        boards, side, castling, en_passant = [], [], [], []
+        for state in states:
+            boards.append(state.board.compact())
+            side.append(state.side)
+            castling.append(state.castling_rights())
+            en_passant.append(state.en_passant_target.flat() if state.check_flag(GameStateFlag.EN_PASSANT) else -1)
+        codes = np.frombuffer(b''.join(boards), np.uint8).reshape(-1, 64)
+        return cls(FROM_COMPACT[codes], side, castling, en_passant)
+
+    @classmethod
+    def from_fens(cls, fens: Iterable[str]) -> Positions:
+        return cls.from_states(map(parse_fen, fens))
+
+    def squares(self) -> np.ndarray:
+        """ int8[65, N], square major so that every kernel step moves whole rows. The last row is off board """
+        return np.concatenate([self.boards.T, np.full((1, len(self)), OFF_BOARD, np.int8)])
+
+
+def _pieces(squares: np.ndarray, color: np.ndarray, *piece_types: int) -> np.ndarray:
+    """ bool[64, N] squares holding one of piece_types of the color of each position """
+    found = np.zeros((OFF, squares.shape[1]), bool)
+    for piece_type in piece_types:
+        found |= squares[:OFF] == piece_type * 2 + color
+    return found
+
+
+def _attacks(squares: np.ndarray, color: np.ndarray, empty: np.ndarray) -> np.ndarray:
+    """ bool[65, N] squares attacked by color, sliders go on through empty squares only """
+    attacked = np.zeros(squares.shape, bool)
+    for steps, piece_type in ((KNIGHT_STEPS, KNIGHT), (KING_STEPS, KING)):
+        pieces = _pieces(squares, color, piece_type)
+        for targets in steps:
+            attacked[targets] |= pieces
+    for side in (WHITE, BLACK):
+        pawns = _pieces(squares, color, PAWN) & (color == side)
+        for targets in PAWN_CAPTURE_STEPS[side]:
+            attacked[targets] |= pawns
+    for direction, steps in enumerate(RAY_STEPS):
+        active = _pieces(squares, color, LINE_PIECE[direction], QUEEN)
+        for targets in steps:
+            attacked[targets] |= active
+            active = active & empty[targets]
+    attacked[OFF] = False
+    return attacked
+
+
+def attack_maps(positions: Positions) -> np.ndarray:
+    """ bool[N, 2, 64] squares attacked by white and by black """
+    squares = positions.squares()
+    empty = squares == EMPTY
+    return np.stack([_attacks(squares, np.full(len(positions), side, np.int8), empty)[:OFF].T
+                     for side in (WHITE, BLACK)], axis=1)
+
+
+class KingScan:
+    """ Checkers and pins of the side to move, walking out from its king """
+    king: np.ndarray
+    checkers: np.ndarray
+    # check_block[square, n], where a non king move must land: anywhere, on
+    # the line of a single check, or nowhere on double check
+    check_block: np.ndarray
+    # pin_axis[square, n], axis a pinned piece must stay on, -1 if not pinned
+    pin_axis: np.ndarray
+
+    def __init__(self, squares: np.ndarray, side: np.ndarray):
+        n, positions = squares.shape[1], np.arange(squares.shape[1])
+        them = side ^ 1
+        self.king = np.argmax(squares == KING * 2 + side, axis=0)
+        self.checkers = np.zeros(n, np.int8)
+        self.check_block = np.zeros(squares.shape, bool)
+        self.pin_axis = np.full(squares.shape, -1, np.int8)
+
+        # enemy pawns attack the king from the squares its own pawns would capture on
+        pawn_steps = np.where(side == WHITE, PAWN_CAPTURE_STEPS[WHITE][:, self.king],
+                              PAWN_CAPTURE_STEPS[BLACK][:, self.king])
+        for steps, piece_type in ((KNIGHT_STEPS[:, self.king], KNIGHT), (pawn_steps, PAWN)):
+            for square in steps:
+                check = squares[square, positions] == piece_type * 2 + them
+                self.checkers += check
+                self.check_block[square[check], positions[check]] = True
+
+        own = (squares >= 0) & ((squares & 1) == side)
+        for direction, steps in enumerate(RAY_STEPS):
+            sliders = (squares == LINE_PIECE[direction] * 2 + them) | (squares == QUEEN * 2 + them)
+            walking = np.ones(n, bool)
+            defender = np.full(n, -1, np.intp)
+            line = np.zeros(squares.shape, bool)
+            for targets in steps:
+                square = targets[self.king]
+                undefended = walking & (defender < 0)
+                line[square[undefended], positions[undefended]] = True
+                hit = walking & sliders[square, positions]
+                check = hit & (defender < 0)
+                self.checkers += check
+                self.check_block[:, check] |= line[:, check]
+                pin = hit & (defender >= 0)
+                self.pin_axis[defender[pin], positions[pin]] = AXIS[direction]
+                first_own = undefended & own[square, positions]
+                defender[first_own] = square[first_own]
+                walking &= (squares[square, positions] == EMPTY) | first_own
+
+        self.check_block[:, self.checkers == 0] = True
+        self.check_block[:, self.checkers > 1] = False
+        self.check_block[OFF] = False
+
+
+def check_status(positions: Positions) -> np.ndarray:
+    """ int8[N] pieces giving check to the side to move """
+    return KingScan(positions.squares(), positions.side).checkers
+
+
+def legal_move_counts(positions: Positions) -> np.ndarray:
+    """ int32[N] legal moves of the side to move, a promotion once per piece """
+    squares, side = positions.squares(), positions.side
+    indices = np.arange(len(positions))
+    scan = KingScan(squares, side)
+    king = scan.king
+
+    own = (squares >= 0) & ((squares & 1) == side)
+    enemy = (squares >= 0) & ~own
+    empty = squares == EMPTY
+    # the king does not shield the squares behind it from sliders
+    without_king = empty.copy()
+    without_king[king, indices] = True
+    danger = _attacks(squares, side ^ 1, without_king)
+
+    counts = np.zeros(len(positions), np.int32)
+    allowed = ~own & scan.check_block
+    free = scan.pin_axis[:OFF] == -1
+    pin_axis = scan.pin_axis[:OFF]
+
+    knights = _pieces(squares, side, KNIGHT) & free
+    for targets in KNIGHT_STEPS:
+        counts += (knights & allowed[targets]).sum(axis=0)
+
+    for direction, steps in enumerate(RAY_STEPS):
+        active = _pieces(squares, side, LINE_PIECE[direction], QUEEN) & (free | (pin_axis == AXIS[direction]))
+        for targets in steps:
+            counts += (active & allowed[targets]).sum(axis=0)
+            active = active & empty[targets]
+
+    for color in (WHITE, BLACK):
+        pawns = _pieces(squares, side, PAWN) & (side == color)
+        # a promotion is four moves
+        weight = (1 + 3 * _rank(PAWN_PROMOTION_RANK[color]))[:, None]
+        one_step = PAWN_PUSH_STEPS[color]
+        pushed = pawns & (free | (pin_axis == PUSH_AXIS)) & empty[one_step]
+        counts += ((pushed & allowed[one_step]) * weight).sum(axis=0)
+        two_steps = np.append(one_step, OFF)[one_step]
+        start_rank = _rank(PAWN_START_RANK[color])[:, None]
+        counts += (pushed & start_rank & empty[two_steps] & allowed[two_steps]).sum(axis=0)
+        for targets, axis in zip(PAWN_CAPTURE_STEPS[color], PAWN_CAPTURE_AXES[color]):
+            capturing = pawns & (free | (pin_axis == axis)) & enemy[targets] & allowed[targets]
+            counts += (capturing * weight).sum(axis=0)
+    counts += _en_passant_counts(positions, king)
+
+    for targets in KING_STEPS:
+        square = targets[king]
+        counts += (square != OFF) & ~own[square, indices] & ~danger[square, indices]
+
+    unchecked = scan.checkers == 0
+    for color, right, path, safe, rook in CASTLES:
+        castles = unchecked & (side == color) & (positions.castling & right).astype(bool)
+        castles &= squares[rook] == ROOK * 2 + color
+        castles &= empty[list(path)].all(axis=0) & ~danger[list(safe)].any(axis=0)
+        counts += castles
+    return counts
+
+
+def _bitboards(board: np.ndarray) -> Bitboards:
+    return Bitboards([sum(1 << int(square) for square in np.flatnonzero(board == code)) for code in range(12)])
+
+
+def _en_passant_counts(positions: Positions, king: np.ndarray) -> np.ndarray:
+    """
+        Capturing en passant can uncover the king in ways no pin shows, the
+        few positions with such a capture available are simulated one by one
+    """
+    counts = np.zeros(len(positions), np.int32)
+    for index in np.flatnonzero(positions.en_passant >= 0):
+        board, side, target = positions.boards[index], int(positions.side[index]), int(positions.en_passant[index])
+        # own pawns reach target from the squares an enemy pawn on target would capture on
+        starts = [int(start) for start in PAWN_CAPTURE_STEPS[side ^ 1][:, target]
+                  if start != OFF and board[start] == PAWN * 2 + side]
+        if not starts:
+            continue
+        bitboards = _bitboards(board)
+        occupied = bitboards.occupancy[WHITE] | bitboards.occupancy[BLACK]
+        captured = int(PAWN_PUSH_STEPS[side ^ 1][target])
+        for start in starts:
+            after = occupied ^ (1 << start) ^ (1 << captured) | (1 << target)
+            counts[index] += not bitboards.attackers_to(int(king[index]), side ^ 1, after) & ~(1 << captured)
+    return counts
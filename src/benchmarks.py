@@ -0,0 +1,263 @@
+"""
+Micro benchmarks
+
+Each benchmark times one piece of the engine in isolation over the perft
+reference positions, perft.py is the end to end one.
+"""
+import argparse
+import copy
+import pickle
+import random
+from time import perf_counter
+from typing import Callable
+
+from batch import Positions, legal_move_counts
+from cache import MoveCache, EvictionPolicy
+from fen import parse_fen, dump_fen, parse_many, dump_many
+from game import Game
+from model import GameState
+from move_generator import GeneratorBackend
+from perft import REFERENCE_POSITIONS, PerftGame, perft
+from persistence import RECORD_SIZE, encode_many, decode_many
+
+
+def best_time(fn: Callable[[], object], repeat: int) -> float:
+    """ Best of repeat runs, the least disturbed by the rest of the machine """
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+# --------------
+# DISPATCH
+# --------------
+
+class DispatchResult:
+    name: str
+    moves: int
+    descriptors: float
+    compiled: float
+
+    def __init__(self, name: str, moves: int, descriptors: float, compiled: float):
+        self.name = name
+        self.moves = moves
+        self.descriptors = descriptors
+        self.compiled = compiled
+
+    def __str__(self):
+        return (f'{self.name:<12} {self.moves:>4} moves  descriptors {self.per_move(self.descriptors):>6.2f}us  '
+                f'compiled {self.per_move(self.compiled):>6.2f}us  '
+                f'removed {self.per_move(self.descriptors - self.compiled):>6.2f}us per move  '
+                f'x{self.descriptors / self.compiled:.1f}')
+
+    __repr__ = __str__
+
+    def per_move(self, seconds: float) -> float:
+        return seconds / self.moves * 1e6
+
+
+def dispatch_benchmark(repeat: int = 50) -> list[DispatchResult]:
+    """ Move generation through MovementMapper against the compiled per piece generators """
+    results = []
+    for name, fen, _ in REFERENCE_POSITIONS:
+        game = Game(fen)
+        game.start_game()
+        generator = game.move_generator
+        pieces = generator.moving_pieces
+        moves = len(generator.generate(pieces))
+        results.append(DispatchResult(name, moves,
+                                      best_time(lambda: generator.generate_from_descriptors(pieces), repeat),
+                                      best_time(lambda: generator.generate(pieces), repeat)))
+    return results
+
+
+# --------------
+# DISPATCH
+# --------------
+
+
+# --------------
+# BATCH
+# --------------
+
+class ThroughputResult:
+    name: str
+    items: int
+    seconds: float
+
+    def __init__(self, name: str, items: int, seconds: float):
+        self.name = name
+        self.items = items
+        self.seconds = seconds
+
+    def __str__(self):
+        return f'{self.name:<36} {self.items:>8} in {self.seconds:>8.3f}s  {self.items / self.seconds:>10.0f}/s'
+
+    __repr__ = __str__
+
+
+def batch_benchmark(repeat: int = 50) -> list[ThroughputResult]:
+    """ Legal move counts of the reference positions, one MoveGenerator at a time against one batch """
+    fens = [fen for _, fen, _ in REFERENCE_POSITIONS] * repeat
+
+    def one_by_one():
+        for fen in fens:
+            game = PerftGame(fen, GeneratorBackend.BITBOARD)
+            game.prepare_move_generator()
+            game.move_generator.count_legal()
+
+    positions = Positions.from_fens(fens)
+    return [ThroughputResult('move generator', len(fens), best_time(one_by_one, 1)),
+            ThroughputResult('batch', len(fens), best_time(lambda: legal_move_counts(positions), 1))]
+
+
+# --------------
+# BATCH
+# --------------
+
+
+# --------------
+# CACHE
+# --------------
+
+def cache_benchmark(repeat: int = 1, depth: int = 4, max_entries: int = 1 << 14) -> list[ThroughputResult]:
+    """ Perft nodes per second of the en passant position without and with a move cache, transpositions hit it """
+    _, fen, _ = REFERENCE_POSITIONS[2]
+    caches = {'no cache': None} | {policy.name.lower(): MoveCache(max_entries, policy) for policy in EvictionPolicy}
+    results = []
+    for name, cache in caches.items():
+        game = PerftGame(fen, move_cache=cache)
+        game.start_game()
+        nodes = perft(game, depth)
+        seconds = best_time(lambda: perft(game, depth), repeat) if cache is None else \
+            best_time(lambda: (cache.clear(), perft(game, depth)), repeat)
+        label = name if cache is None else f'{name} {cache.stats.hit_rate():.0%} hits'
+        results.append(ThroughputResult(label, nodes, seconds))
+    return results
+
+
+# --------------
+# CACHE
+# --------------
+
+
+# --------------
+# FEN
+# --------------
+
+def fen_benchmark(repeat: int = 50) -> list[ThroughputResult]:
+    """ GameState.from_fen and to_fen against the fen codec, over positions of random games """
+    rng, fens = random.Random(0), []
+    for _, fen, _ in REFERENCE_POSITIONS:
+        game = PerftGame(fen, GeneratorBackend.BITBOARD)
+        game.start_game()
+        for _ in range(repeat):
+            fens.append(game.game_state.to_fen())
+            moves = game.legal_moves()
+            if not moves:
+                break
+            game.play(rng.choice(moves), None)
+    fens *= 10
+    states = list(parse_many(fens))
+    runs = {
+        'GameState.from_fen': lambda: list(map(GameState.from_fen, fens)),
+        'parse_many': lambda: list(parse_many(fens)),
+        'GameState.to_fen': lambda: [state.to_fen() for state in states],
+        'dump_many': lambda: list(dump_many(states)),
+    }
+    return [ThroughputResult(name, len(fens), best_time(run, 1)) for name, run in runs.items()]
+
+
+# --------------
+# FEN
+# --------------
+
+
+# --------------
+# RECORDS
+# --------------
+
+def records_benchmark(repeat: int = 50) -> list[ThroughputResult]:
+    """ Positions through binary records against pickled GameState objects, bytes per position in the name """
+    _, fen, _ = REFERENCE_POSITIONS[1]
+    states = [parse_fen(fen)] * repeat * 40
+    records, pickled = encode_many(states), [pickle.dumps(state) for state in states]
+    runs = {
+        f'encode_many {RECORD_SIZE}B': lambda: encode_many(states),
+        f'decode_many {RECORD_SIZE}B': lambda: list(decode_many(records)),
+        f'pickle.dumps {len(pickled[0])}B': lambda: [pickle.dumps(state) for state in states],
+        f'pickle.loads {len(pickled[0])}B': lambda: [pickle.loads(data) for data in pickled],
+    }
+    return [ThroughputResult(name, len(states), best_time(run, 1)) for name, run in runs.items()]
+
+
+# --------------
+# RECORDS
+# --------------
+
+
+# --------------
+# SNAPSHOT
+# --------------
+
+def snapshot_benchmark(repeat: int = 50, plies: tuple[int, ...] = (10, 100, 400)) -> list[ThroughputResult]:
+    """
+        Ways to branch off a position of a game in progress, back to it after
+        every copy, further and further into the game: the knights shuffling
+        back and forth make the history as long as asked
+    """
+    _, fen, _ = REFERENCE_POSITIONS[0]
+    game = PerftGame(fen, GeneratorBackend.BITBOARD)
+    game.start_game()
+    shuffle = ((6, 21), (62, 45), (21, 6), (45, 62))
+    results = []
+    played = 0
+    for target in plies:
+        for ply in range(played, target):
+            move = next(move for move in game.legal_moves() if move.as_values() == shuffle[ply % 4])
+            game.play(move, None)
+        played = target
+        state = game.game_state
+        snapshot = state.snapshot()
+        count = repeat * 20
+        runs = {
+            'copy.deepcopy': lambda: [copy.deepcopy(state) for _ in range(count)],
+            'dump_fen and parse_fen': lambda: [parse_fen(dump_fen(state)) for _ in range(count)],
+            'clone': lambda: [state.clone() for _ in range(count)],
+            'snapshot': lambda: [state.snapshot() for _ in range(count)],
+            'restore': lambda: [state.restore(snapshot) for _ in range(count)],
+        }
+        results.extend(ThroughputResult(f'{name} at {target} plies', count, best_time(run, 1))
+                       for name, run in runs.items())
+    return results
+
+
+# --------------
+# SNAPSHOT
+# --------------
+
+BENCHMARKS: dict[str, Callable[[int], list]] = {
+    'dispatch': dispatch_benchmark,
+    'batch': batch_benchmark,
+    'cache': cache_benchmark,
+    'fen': fen_benchmark,
+    'records': records_benchmark,
+    'snapshot': snapshot_benchmark,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro benchmarks over the perft reference positions')
+    parser.add_argument('benchmark', choices=BENCHMARKS)
+    parser.add_argument('--repeat', type=int, help='runs to take the best of, each benchmark has its own default')
+    args = parser.parse_args()
+    benchmark = BENCHMARKS[args.benchmark]
+    for result in benchmark() if args.repeat is None else benchmark(args.repeat):
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,450 @@
+"""
+Bitboard move generation backend
+
+Position is kept as twelve 64-bit integers (one per piece, indexed by piece code)
+plus one occupancy integer per side. Square i is bit i, with the same flat
+numbering as Slot.flat (a1 = 0, h8 = 63).
+
+The generator yields packed moves (see model.encode_move), MoveGenerator is in
+charge of turning them into Move objects when needed.
+"""
+from __future__ import annotations
+
+from itertools import chain
+from typing import Iterator, Optional
+
+from model import Board, Vector, BISHOP_MOVEMENTS, ROOK_MOVEMENTS, GODLIKE_MOVEMENTS, PAWN_ATTACK_MOVEMENTS, \
+    KNIGHT_TARGETS, KING_TARGETS, RAY_TARGETS, BETWEEN_SLOTS, direction_index, \
+    WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE, PROMOTION_PIECETYPES, PackedMove, \
+    NORMAL_MOVE, DOUBLE_PUSH_MOVE, EN_PASSANT_MOVE, CASTLE_MOVE, EMPTY_CODE, WHITE, PAWN, KNIGHT, BISHOP, ROOK, \
+    QUEEN, KING
+
+FULL = (1 << 64) - 1
+
+# promotion bits of a packed move, best piece first
+ALL_PROMOTIONS = tuple(t.value - 1 << 12 for t in reversed(PROMOTION_PIECETYPES))
+# a single move per promotion, leaving the choice of the piece to the caller
+ANY_PROMOTION = (ALL_PROMOTIONS[0],)
+
+
+def lsb(bitboard: int) -> int:
+    return (bitboard & -bitboard).bit_length() - 1
+
+
+def msb(bitboard: int) -> int:
+    return bitboard.bit_length() - 1
+
+
+def squares(bitboard: int) -> Iterator[int]:
+    while bitboard:
+        lowest = bitboard & -bitboard
+        yield lowest.bit_length() - 1
+        bitboard ^= lowest
+
+
+def popcount(bitboard: int) -> int:
+    return bin(bitboard).count('1')
+
+
+# --------------
+# TABLES
+# --------------
+
+def mask(slots) -> int:
+    bitboard = 0
+    for slot in slots:
+        bitboard |= 1 << slot.flat()
+    return bitboard
+
+
+def _pawn_attacks(color_direction: int) -> tuple[int, ...]:
+    directions = tuple(direction_index(Vector(*step, color_direction)) for step in PAWN_ATTACK_MOVEMENTS)
+    return tuple(mask(chain.from_iterable(RAY_TARGETS[direction][square][:1] for direction in directions))
+                 for square in range(64))
+
+
+BISHOP_DIRECTIONS = tuple(map(direction_index, BISHOP_MOVEMENTS))
+ROOK_DIRECTIONS = tuple(map(direction_index, ROOK_MOVEMENTS))
+# Rays growing towards higher squares find their nearest blocker in the lowest bit
+POSITIVE_DIRECTIONS = tuple(step.y > 0 or (step.y == 0 and step.x > 0) for step in GODLIKE_MOVEMENTS)
+
+KNIGHT_ATTACKS = tuple(map(mask, KNIGHT_TARGETS))
+KING_ATTACKS = tuple(map(mask, KING_TARGETS))
+PAWN_ATTACKS = (_pawn_attacks(1), _pawn_attacks(-1))
+RAYS = tuple(tuple(map(mask, rays)) for rays in RAY_TARGETS)
+# QUEEN_RAYS[square], every line through square, where the pins of a king there are found
+QUEEN_RAYS = tuple(mask(chain.from_iterable(rays[square] for rays in RAY_TARGETS)) for square in range(64))
+BETWEEN = tuple(tuple(map(mask, row)) for row in BETWEEN_SLOTS)
+
+
+def nearest_blocker(direction: int, blockers: int) -> int:
+    return lsb(blockers) if POSITIVE_DIRECTIONS[direction] else msb(blockers)
+
+
+def slider_attacks(square: int, occupied: int, directions: tuple[int, ...]) -> int:
+    attacks = 0
+    for direction in directions:
+        ray = RAYS[direction][square]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= RAYS[direction][nearest_blocker(direction, blockers)]
+        attacks |= ray
+    return attacks
+
+
+def bishop_attacks(square: int, occupied: int) -> int:
+    return slider_attacks(square, occupied, BISHOP_DIRECTIONS)
+
+
+def rook_attacks(square: int, occupied: int) -> int:
+    return slider_attacks(square, occupied, ROOK_DIRECTIONS)
+
+
+# --------------
+# TABLES
+# --------------
+
+class Bitboards:
+    pieces: list[int]
+    occupancy: list[int]
+
+    __slots__ = ('pieces', 'occupancy')
+
+    def __init__(self, pieces: list[int]):
+        self.pieces = pieces
+        self.refresh()
+
+    def refresh(self):
+        pieces = self.pieces
+        self.occupancy = [pieces[0] | pieces[2] | pieces[4] | pieces[6] | pieces[8] | pieces[10],
+                          pieces[1] | pieces[3] | pieces[5] | pieces[7] | pieces[9] | pieces[11]]
+
+    @classmethod
+    def from_board(cls, board: Board):
+        pieces = [0] * 12
+        for square, piece in enumerate(board):
+            if piece is not None:
+                pieces[piece.code] |= 1 << square
+        return cls(pieces)
+
+    def king_square(self, side: int) -> int:
+        return lsb(self.pieces[KING * 2 + side])
+
+    def attackers_to(self, square: int, side: int, occupied: int) -> int:
+        pieces = self.pieces
+        queens = pieces[QUEEN * 2 + side]
+        return ((KNIGHT_ATTACKS[square] & pieces[KNIGHT * 2 + side])
+                | (KING_ATTACKS[square] & pieces[KING * 2 + side])
+                | (PAWN_ATTACKS[side ^ 1][square] & pieces[PAWN * 2 + side])
+                | (bishop_attacks(square, occupied) & (pieces[BISHOP * 2 + side] | queens))
+                | (rook_attacks(square, occupied) & (pieces[ROOK * 2 + side] | queens)))
+
+    def pins(self, side: int, king: int) -> dict[int, int]:
+        """
+            Maps every piece of side pinned to its king to the squares
+            it can still move to (the line up to and including the pinner)
+        """
+        return self.line_blockers(king, side, side ^ 1)
+
+    def discoverers(self, side: int) -> dict[int, int]:
+        """
+            Maps every piece of side standing alone between one of its
+            sliders and the enemy king to the squares keeping the line closed
+        """
+        return self.line_blockers(self.king_square(side ^ 1), side, side)
+
+    def line_blockers(self, king: int, side: int, slider_side: int) -> dict[int, int]:
+        """ Pieces of side that are the only blocker between king and a slider of slider_side """
+        pieces = self.pieces
+        own, occupied = self.occupancy[side], self.occupancy[0] | self.occupancy[1]
+        diagonal_sliders = pieces[BISHOP * 2 + slider_side] | pieces[QUEEN * 2 + slider_side]
+        straight_sliders = pieces[ROOK * 2 + slider_side] | pieces[QUEEN * 2 + slider_side]
+        blocking = {}
+        for direction in range(8):
+            sliders = diagonal_sliders if direction in BISHOP_DIRECTIONS else straight_sliders
+            ray = RAYS[direction][king]
+            if not ray & sliders:
+                continue
+            blockers = ray & occupied
+            if not blockers:
+                continue
+            first = nearest_blocker(direction, blockers)
+            if not own >> first & 1:
+                continue
+            blockers &= RAYS[direction][first]
+            if not blockers:
+                continue
+            second = nearest_blocker(direction, blockers)
+            if sliders >> second & 1:
+                blocking[first] = ray & ~RAYS[direction][second]
+        return blocking
+
+
+def piece_attacks(code: int, square: int, occupied: int) -> int:
+    piece_type, side = divmod(code, 2)
+    if piece_type == PAWN:
+        return PAWN_ATTACKS[side][square]
+    if piece_type == KNIGHT:
+        return KNIGHT_ATTACKS[square]
+    if piece_type == BISHOP:
+        return bishop_attacks(square, occupied)
+    if piece_type == ROOK:
+        return rook_attacks(square, occupied)
+    if piece_type == QUEEN:
+        return bishop_attacks(square, occupied) | rook_attacks(square, occupied)
+    return KING_ATTACKS[square]
+
+
+def attack_table(bitboards: Bitboards) -> list[int]:
+    """ Squares attacked by the piece standing on each square, 0 if empty """
+    occupied = bitboards.occupancy[0] | bitboards.occupancy[1]
+    attacks = [0] * 64
+    for code, bitboard in enumerate(bitboards.pieces):
+        for square in squares(bitboard):
+            attacks[square] = piece_attacks(code, square, occupied)
+    return attacks
+
+
+def king_safety(bitboards: Bitboards, attacks: list[int], side: int) -> tuple[int, int]:
+    """
+        Pieces checking side's king and squares attacked by the opponent,
+        looking through the king so it cannot step back along a checking line
+    """
+    pieces = bitboards.pieces
+    them = side ^ 1
+    occupied = bitboards.occupancy[0] | bitboards.occupancy[1]
+    king = 1 << bitboards.king_square(side)
+    diagonal = pieces[BISHOP * 2 + them] | pieces[QUEEN * 2 + them]
+    straight = pieces[ROOK * 2 + them] | pieces[QUEEN * 2 + them]
+    checking = danger = 0
+    for square in squares(bitboards.occupancy[them]):
+        square_attacks = attacks[square]
+        if square_attacks & king:
+            checking |= 1 << square
+            if diagonal >> square & 1:
+                square_attacks |= bishop_attacks(square, occupied ^ king)
+            if straight >> square & 1:
+                square_attacks |= rook_attacks(square, occupied ^ king)
+        danger |= square_attacks
+    return checking, danger
+
+
+# pieces checking the king, squares it cannot step on and pinned pieces to the squares they can move to
+KingSafety = tuple[int, int, dict[int, int]]
+
+
+def _castle_targets(bitboards: Bitboards, side: int, castling: int, danger: int) -> int:
+    occupied = bitboards.occupancy[0] | bitboards.occupancy[1]
+    rook = bitboards.pieces[ROOK * 2 + side]
+    base = 0 if side == WHITE else 56
+    kingside, queenside = (WHITE_KINGSIDE, WHITE_QUEENSIDE) if side == WHITE else (BLACK_KINGSIDE, BLACK_QUEENSIDE)
+    targets = 0
+    if (castling & kingside and rook >> (base + 7) & 1
+            and not occupied & (0b11 << (base + 5)) and not danger & (0b11 << (base + 5))):
+        targets |= 1 << (base + 6)
+    if (castling & queenside and rook >> base & 1
+            and not occupied & (0b111 << (base + 1)) and not danger & (0b11 << (base + 2))):
+        targets |= 1 << (base + 2)
+    return targets
+
+
+# kind of the targets that promote, not a kind of packed move
+PROMOTING = 4
+# targets of a start square, with the kind of move reaching them
+Targets = tuple[int, int, int]
+
+
+def legal_targets(bitboards: Bitboards, attacks: list[int], side: int, castling: int,
+                  en_passant: Optional[int], safety: Optional[KingSafety] = None,
+                  noisy: Optional[bool] = None) -> Iterator[Targets]:
+    """
+        Legal target squares of side grouped by start square and kind of move,
+        given the attack table of the position and its king safety, computed
+        here if not given. Pawns come first, the king last. noisy keeps only
+        the captures and promotions when True, only the other moves when False
+    """
+    pieces = bitboards.pieces
+    them = side ^ 1
+    own, enemy = bitboards.occupancy[side], bitboards.occupancy[them]
+    occupied = own | enemy
+    king = bitboards.king_square(side)
+    if safety is None:
+        checking, danger = king_safety(bitboards, attacks, side)
+        pinned = None
+    else:
+        checking, danger, pinned = safety
+    if noisy is None:
+        wanted = ~own
+    else:
+        wanted = enemy if noisy else ~occupied
+
+    # Everything else is pointless if the king is double checked
+    double_check = checking & (checking - 1)
+    if not double_check:
+        if checking:
+            target_mask = checking | BETWEEN[king][lsb(checking)]
+        else:
+            target_mask = FULL
+        if pinned is None:
+            pinned = bitboards.pins(side, king)
+        pawn_mask = target_mask & ~own
+        target_mask &= wanted
+
+        forward, start_rank, promotion_rank = (8, 1, 6) if side == WHITE else (-8, 6, 1)
+        for start in squares(pieces[PAWN * 2 + side]):
+            promoting = start // 8 == promotion_rank
+            if noisy is False and promoting:
+                continue
+            allowed = pawn_mask & pinned.get(start, FULL)
+            one_step = start + forward
+            ends = attacks[start] & enemy & allowed if noisy is not False else 0
+            if not occupied >> one_step & 1 and (noisy is not True or promoting):
+                ends |= allowed & 1 << one_step
+                two_steps = one_step + forward
+                if start // 8 == start_rank and not occupied >> two_steps & 1 and allowed >> two_steps & 1:
+                    yield start, 1 << two_steps, DOUBLE_PUSH_MOVE
+            if ends:
+                yield start, ends, PROMOTING if promoting else NORMAL_MOVE
+            if noisy is not False and en_passant is not None and attacks[start] >> en_passant & 1:
+                captured = en_passant - forward
+                after = occupied ^ (1 << start) ^ (1 << captured) | (1 << en_passant)
+                if not bitboards.attackers_to(king, them, after) & ~(1 << captured):
+                    yield start, 1 << en_passant, EN_PASSANT_MOVE
+
+        for start in squares(pieces[KNIGHT * 2 + side]):
+            if start not in pinned and attacks[start] & target_mask:
+                yield start, attacks[start] & target_mask, NORMAL_MOVE
+
+        for start in squares(pieces[BISHOP * 2 + side] | pieces[ROOK * 2 + side] | pieces[QUEEN * 2 + side]):
+            ends = attacks[start] & target_mask & pinned.get(start, FULL)
+            if ends:
+                yield start, ends, NORMAL_MOVE
+
+    ends = attacks[king] & wanted & ~danger
+    if ends:
+        yield king, ends, NORMAL_MOVE
+    if not checking and noisy is not True:
+        ends = _castle_targets(bitboards, side, castling, danger)
+        if ends:
+            yield king, ends, CASTLE_MOVE
+
+
+def legal_moves(bitboards: Bitboards, attacks: list[int], side: int, castling: int, en_passant: Optional[int],
+                promotions: tuple[int, ...] = ALL_PROMOTIONS, safety: Optional[KingSafety] = None,
+                noisy: Optional[bool] = None) -> list[PackedMove]:
+    """
+        Packed legal moves of side, see legal_targets. Every promotion is
+        yielded once per bits in promotions
+    """
+    moves: list[PackedMove] = []
+    for start, ends, kind in legal_targets(bitboards, attacks, side, castling, en_passant, safety, noisy):
+        if kind == PROMOTING:
+            moves.extend(start | end << 6 | promotion for end in squares(ends) for promotion in promotions)
+        else:
+            moves.extend(start | end << 6 | kind << 14 for end in squares(ends))
+    return moves
+
+
+def count_legal(bitboards: Bitboards, attacks: list[int], side: int, castling: int,
+                en_passant: Optional[int], safety: Optional[KingSafety] = None) -> int:
+    """ Number of legal moves, a promotion counting once per piece """
+    return sum(popcount(ends) * (len(ALL_PROMOTIONS) if kind == PROMOTING else 1)
+               for _, ends, kind in legal_targets(bitboards, attacks, side, castling, en_passant, safety))
+
+
+def has_legal_move(bitboards: Bitboards, attacks: list[int], side: int, castling: int,
+                   en_passant: Optional[int], safety: Optional[KingSafety] = None) -> bool:
+    return any(legal_targets(bitboards, attacks, side, castling, en_passant, safety))
+
+
+def check_targets(bitboards: Bitboards, side: int) -> list[int]:
+    """
+        Squares from which a piece of side would check the enemy king, by
+        piece type. A slider already on an open line to it would be checking
+        right now, so moving along that line never matters
+    """
+    king = bitboards.king_square(side ^ 1)
+    occupied = bitboards.occupancy[0] | bitboards.occupancy[1]
+    diagonal, straight = bishop_attacks(king, occupied), rook_attacks(king, occupied)
+    return [PAWN_ATTACKS[side ^ 1][king], KNIGHT_ATTACKS[king], diagonal, straight, diagonal | straight, 0]
+
+
+class IncrementalAttacks:
+    """
+        Keeps the bitboards, the attack set of every piece and the pins of
+        each side between turns. update is told which squares changed and
+        recomputes the pieces standing on them, plus the sliders whose
+        attack set reaches one of them: knights, kings and pawns attack the
+        same squares wherever the other pieces are. The pins of a side are
+        kept until a changed square lies on a line through its king.
+        Checks and the squares the king cannot step on are derived from the
+        kept attack sets every turn, see king_safety
+    """
+    bitboards: Optional[Bitboards]
+    attacks: list[int]
+    # piece code on every square, EMPTY_CODE if empty
+    codes: bytearray
+    # attack sets recomputed by the last update
+    recomputed: int
+    # pins of each side and the king square they were found for
+    _pins: list[Optional[dict[int, int]]]
+    _pin_kings: list[int]
+    # squares changed since the pins of each side were found
+    _pin_changes: list[int]
+
+    def __init__(self):
+        self.bitboards = None
+        self.attacks = [0] * 64
+        self.codes = bytearray([EMPTY_CODE] * 64)
+        self.recomputed = 0
+        self._pins = [None, None]
+        self._pin_kings = [-1, -1]
+        self._pin_changes = [FULL, FULL]
+
+    def update(self, board: Board, changed: int) -> list[int]:
+        """ Attack table of board, changed holding every square written since the previous update """
+        if self.bitboards is None:
+            self.bitboards = Bitboards([0] * 12)
+            changed = FULL
+        pieces, attacks, codes = self.bitboards.pieces, self.attacks, self.codes
+        for square in squares(changed):
+            piece = board[square]
+            old, new = codes[square], EMPTY_CODE if piece is None else piece.code
+            bit = 1 << square
+            if old == new:
+                # written and written back, a move and its undo
+                changed ^= bit
+                continue
+            if old != EMPTY_CODE:
+                pieces[old] ^= bit
+            if new != EMPTY_CODE:
+                pieces[new] |= bit
+            codes[square] = new
+            attacks[square] = 0
+        self.recomputed = 0
+        if not changed:
+            return attacks
+        self._pin_changes[0] |= changed
+        self._pin_changes[1] |= changed
+        self.bitboards.refresh()
+
+        occupied = self.bitboards.occupancy[0] | self.bitboards.occupancy[1]
+        dirty = changed & occupied
+        sliders = pieces[4] | pieces[5] | pieces[6] | pieces[7] | pieces[8] | pieces[9]
+        for square in squares(sliders & ~dirty):
+            if attacks[square] & changed:
+                dirty |= 1 << square
+        for square in squares(dirty):
+            attacks[square] = piece_attacks(codes[square], square, occupied)
+        self.recomputed = popcount(dirty)
+        return attacks
+
+    def pins(self, side: int) -> dict[int, int]:
+        """ Bitboards.pins of side, found again only if its king moved or one of its lines changed """
+        king = self.bitboards.king_square(side)
+        pins = self._pins[side]
+        if pins is None or king != self._pin_kings[side] or self._pin_changes[side] & QUEEN_RAYS[king]:
+            pins = self._pins[side] = self.bitboards.pins(side, king)
+            self._pin_kings[side] = king
+            self._pin_changes[side] = 0
+        return pins
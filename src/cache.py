@@ -0,0 +1,129 @@
+"""
+Legal move cache
+
+Maps the Zobrist key of a position to the moves generated for it and the
+flags found while doing so (check, double check, mate, stalemate). Game
+consults it before preparing a turn, so positions seen again (transpositions,
+undo and redo, common openings) skip threat and move generation.
+
+Moves are kept packed, two bytes each, and turned back into Move objects on
+a hit: an entry of a middle game position weighs about 350 bytes where the
+Moves object graph is about 50 KB.
+"""
+from __future__ import annotations
+
+from array import array
+from collections import OrderedDict
+from enum import Enum
+from typing import Iterable, Optional
+
+from model import GameStateFlag, PackedMove
+
+# flags that depend on the position alone, the rest depend on the history
+CACHED_FLAGS = (GameStateFlag.CHECK | GameStateFlag.DOUBLE_CHECK | GameStateFlag.CHECKMATE
+                | GameStateFlag.STALEMATE | GameStateFlag.NORMAL)
+
+
+class EvictionPolicy(Enum):
+    # drop the least recently used entry
+    LRU = 0
+    # one entry per bucket, replaced only by an entry of at least the same depth
+    DEPTH_PREFERRED = 1
+
+
+class CacheEntry:
+    key: int
+    # packed legal moves, one per promotion move whatever the piece
+    moves: array
+    flag: GameStateFlag
+    depth: int
+
+    __slots__ = ('key', 'moves', 'flag', 'depth')
+
+    def __init__(self, key: int, moves: Iterable[PackedMove], flag: GameStateFlag, depth: int = 0):
+        self.key = key
+        self.moves = array('H', moves)
+        self.flag = flag & CACHED_FLAGS
+        self.depth = depth
+
+    def __str__(self):
+        return f'CacheEntry(key={self.key:016x}, moves={len(self.moves)}, flag={self.flag})'
+
+    __repr__ = __str__
+
+
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __str__(self):
+        return f'{self.hits} hits  {self.misses} misses  {self.evictions} evictions  {self.hit_rate():.1%} hit rate'
+
+    __repr__ = __str__
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+
+class MoveCache:
+    """ At most max_entries positions, evicted following policy, the default about 25 MB """
+    max_entries: int
+    policy: EvictionPolicy
+    stats: CacheStats
+    _lru: OrderedDict[int, CacheEntry]
+    _buckets: list[Optional[CacheEntry]]
+
+    def __init__(self, max_entries: int = 1 << 16, policy: EvictionPolicy = EvictionPolicy.LRU):
+        if max_entries < 1:
+            raise ValueError(max_entries)
+        self.max_entries = max_entries
+        self.policy = policy
+        self.clear()
+
+    def __len__(self):
+        if self.policy is EvictionPolicy.LRU:
+            return len(self._lru)
+        return sum(entry is not None for entry in self._buckets)
+
+    def clear(self):
+        self.stats = CacheStats()
+        self._lru = OrderedDict()
+        self._buckets = [None] * self.max_entries if self.policy is EvictionPolicy.DEPTH_PREFERRED else []
+
+    def get(self, key: int) -> Optional[CacheEntry]:
+        if self.policy is EvictionPolicy.LRU:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+        else:
+            entry = self._buckets[key % self.max_entries]
+            if entry is not None and entry.key != key:
+                entry = None
+        if entry is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return entry
+
+    def put(self, entry: CacheEntry):
+        if self.policy is EvictionPolicy.LRU:
+            self._lru[entry.key] = entry
+            self._lru.move_to_end(entry.key)
+            if len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+                self.stats.evictions += 1
+            return
+        bucket = entry.key % self.max_entries
+        stored = self._buckets[bucket]
+        if stored is not None and stored.key != entry.key:
+            if stored.depth > entry.depth:
+                return
+            self.stats.evictions += 1
+        self._buckets[bucket] = entry
@@ -0,0 +1,196 @@
+"""
+FEN and EPD codec
+
+Table driven: every rank string parses to 8 shared squares and every rank of
+8 squares serializes to its string once, later ranks come from the caches.
+Same results as GameState.from_fen and GameState.to_fen, several times faster,
+plus EPD and streaming versions for bulk imports and exports.
+"""
+from __future__ import annotations
+
+import re
+from typing import Iterable, Iterator, Optional
+
+from model import GameState, GameStateFlag, Board, Color, Square, WrongFenError, PIECE_PER_REPRESENTATION, \
+    BOARD_SLOTS, WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE
+from util import from_int_to_san
+
+# EPD operations, opcode to its operands, strings without their quotes
+Operations = dict[str, list[str]]
+
+# rank caches are dropped when they grow past this, distinct ranks are few in practice
+RANK_CACHE_SIZE = 1 << 16
+
+SIDES = {'w': Color.WHITE, 'b': Color.BLACK}
+CASTLING_RIGHTS = {char: right for char, right in
+                   zip('KQkq', (WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE))}
+# CASTLING_FIELDS[rights], castling field of the packed rights
+CASTLING_FIELDS = tuple(''.join(char for char, right in CASTLING_RIGHTS.items() if rights & right) or '-'
+                        for rights in range(16))
+SQUARES = {from_int_to_san(square): BOARD_SLOTS[square] for square in range(64)}
+SQUARE_NAMES = tuple(map(from_int_to_san, range(64)))
+EMPTY_RUNS = re.compile('1+')
+OPERAND = r'"[^"]*"|[^;\s"]+'
+OPERATION = re.compile(rf'\s*([A-Za-z]\w*)((?:\s+(?:{OPERAND}))*)\s*;')
+OPERANDS = re.compile(OPERAND)
+
+_parsed_ranks: dict[str, tuple[Square, ...]] = {}
+_dumped_ranks: dict[str, str] = {}
+
+
+# --------------
+# PARSING
+# --------------
+
+def _parse_rank(rank: str) -> tuple[Square, ...]:
+    squares = _parsed_ranks.get(rank)
+    if squares is not None:
+        return squares
+    parsed: list[Square] = []
+    for char in rank:
+        if '1' <= char <= '8':
+            parsed.extend((None,) * int(char))
+        elif char in PIECE_PER_REPRESENTATION:
+            parsed.append(PIECE_PER_REPRESENTATION[char])
+        else:
+            raise WrongFenError(rank)
+    if len(parsed) != 8:
+        raise WrongFenError(rank)
+    if len(_parsed_ranks) >= RANK_CACHE_SIZE:
+        _parsed_ranks.clear()
+    squares = _parsed_ranks[rank] = tuple(parsed)
+    return squares
+
+
+def _parse_position(placement: str, side: str, castling: str, en_passant: str, halfmove_clock: int,
+                    fullmove_number: int) -> GameState:
+    ranks = placement.split('/')
+    if len(ranks) != 8 or side not in SIDES:
+        raise WrongFenError(placement, side)
+    board = Board()
+    for rank in reversed(ranks):
+        board.extend(_parse_rank(rank))
+    rights = 0
+    if castling != '-':
+        for char in castling:
+            if char not in CASTLING_RIGHTS:
+                raise WrongFenError(castling)
+            rights |= CASTLING_RIGHTS[char]
+    target = None
+    if en_passant != '-':
+        target = SQUARES.get(en_passant)
+        if target is None:
+            raise WrongFenError(en_passant)
+    return GameState(board, GameStateFlag.NORMAL, SIDES[side], bool(rights & WHITE_KINGSIDE),
+                     bool(rights & WHITE_QUEENSIDE), bool(rights & BLACK_KINGSIDE), bool(rights & BLACK_QUEENSIDE),
+                     target, halfmove_clock, fullmove_number)
+
+
+def parse_fen(fen: str) -> GameState:
+    fields = fen.split()
+    if len(fields) != 6:
+        raise WrongFenError(fen)
+    placement, side, castling, en_passant, halfmove_clock, fullmove_number = fields
+    try:
+        return _parse_position(placement, side, castling, en_passant, int(halfmove_clock), int(fullmove_number))
+    except ValueError as error:
+        raise WrongFenError(fen) from error
+
+
+def parse_operations(operations: str) -> Operations:
+    parsed = {}
+    end = 0
+    for match in OPERATION.finditer(operations):
+        if operations[end:match.start()].strip():
+            break
+        parsed[match.group(1)] = [operand.strip('"') for operand in OPERANDS.findall(match.group(2))]
+        end = match.end()
+    if operations[end:].strip():
+        raise WrongFenError(operations)
+    return parsed
+
+
+def parse_epd(epd: str) -> tuple[GameState, Operations]:
+    """ Position and operations of an EPD line, the clocks come from hmvc and fmvn when present """
+    fields = epd.split(maxsplit=4)
+    if len(fields) < 4:
+        raise WrongFenError(epd)
+    operations = parse_operations(fields[4]) if len(fields) == 5 else {}
+    try:
+        halfmove_clock, fullmove_number = operations.get('hmvc', ['0']), operations.get('fmvn', ['1'])
+        state = _parse_position(*fields[:4], int(halfmove_clock[0]), int(fullmove_number[0]))
+    except (ValueError, IndexError) as error:
+        raise WrongFenError(epd) from error
+    return state, operations
+
+
+def _lines(lines: Iterable[str]) -> Iterator[str]:
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def parse_many(lines: Iterable[str]) -> Iterator[GameState]:
+    """ One position per FEN line, blank lines and # comments skipped """
+    return map(parse_fen, _lines(lines))
+
+
+def parse_many_epd(lines: Iterable[str]) -> Iterator[tuple[GameState, Operations]]:
+    return map(parse_epd, _lines(lines))
+
+
+# --------------
+# PARSING
+# --------------
+
+
+# --------------
+# DUMPING
+# --------------
+
+def _dump_rank(rank: str) -> str:
+    """ rank with '1' for every empty square """
+    dumped = _dumped_ranks.get(rank)
+    if dumped is None:
+        if len(_dumped_ranks) >= RANK_CACHE_SIZE:
+            _dumped_ranks.clear()
+        dumped = _dumped_ranks[rank] = EMPTY_RUNS.sub(lambda run: str(len(run.group())), rank)
+    return dumped
+
+
+def _dump_position(state: GameState) -> str:
+    squares = ''.join(['1' if piece is None else piece.representation for piece in state.board])
+    placement = '/'.join([_dump_rank(squares[start:start + 8]) for start in range(56, -1, -8)])
+    target = state.en_passant_target
+    return ' '.join((placement, 'w' if state.next_to_move else 'b', CASTLING_FIELDS[state.castling_rights()],
+                     '-' if target is None else SQUARE_NAMES[target.flat()]))
+
+
+def dump_fen(state: GameState) -> str:
+    return f'{_dump_position(state)} {state.halfmove_clock} {state.fullmove_number}'
+
+
+def dump_epd(state: GameState, operations: Optional[Operations] = None) -> str:
+    if not operations:
+        return _dump_position(state)
+    dumped = ' '.join(' '.join((opcode, *map(quote, operands))) + ';' for opcode, operands in operations.items())
+    return f'{_dump_position(state)} {dumped}'
+
+
+def quote(operand: str) -> str:
+    """ Operands with spaces or semicolons go as a single string """
+    return f'"{operand}"' if not operand or any(char in operand for char in ' ;') else operand
+
+
+def dump_many(states: Iterable[GameState]) -> Iterator[str]:
+    return map(dump_fen, states)
+
+
+def dump_many_epd(records: Iterable[tuple[GameState, Operations]]) -> Iterator[str]:
+    return (dump_epd(state, operations) for state, operations in records)
+
+
+# --------------
+# DUMPING
+# --------------
@@ -1,7 +1,10 @@
 import random
+from typing import Optional
 
-from model import GameState, Move, Moves, Piece, GameStateFlag, PieceType
-from move_generator import MoveGenerator
+from cache import MoveCache, CacheEntry
+from fen import parse_fen
+from model import GameState, Move, Moves, GameStateFlag, PieceType, get_piece_constant, FLAG_EN_PASSANT
+from move_generator import MoveGenerator, GeneratorBackend, unpack_move
 from ui import Controller
 
 
@@ -9,15 +12,50 @@ class Game:
     game_state: GameState
     move_generator: MoveGenerator
     current_moves: Moves
-
-    def __init__(self, fen: str):
-        self.game_state = GameState.from_fen(fen)
-        self.move_generator = MoveGenerator(self.game_state)
+    move_cache: Optional[MoveCache]
+    # depth given to the entries stored in the cache, for depth preferred replacement
+    cache_depth: int
+    # times a position must be reached to draw, 3 by the rules, 2 is enough to cut a search
+    draw_repetitions: int
+
+    def __init__(self, fen: str, backend: GeneratorBackend = GeneratorBackend.OBJECTS,
+                 move_cache: Optional[MoveCache] = None):
+        self.game_state = parse_fen(fen)
+        self.move_generator = MoveGenerator(self.game_state, backend)
+        self.move_cache = move_cache
+        self.cache_depth = 0
+        self.draw_repetitions = 3
 
     def start_game(self):
         self.prepare_next_turn()
 
     def prepare_next_turn(self):
+        if self.move_cache is not None:
+            key = self.game_state.zobrist_key()
+            entry = self.move_cache.get(key)
+            if entry is not None:
+                # the move generator is only prepared again if asked for something the cache does not keep
+                self.move_generator.stale = True
+                self.game_state.flags = entry.flag.value | (self.game_state.flags & FLAG_EN_PASSANT)
+                self.check_draw()
+                board = self.game_state.board
+                self.current_moves = Moves(unpack_move(board, packed) for packed in entry.moves)
+                return
+
+        self.prepare_move_generator()
+
+        # generate possible movements and start turn
+        self.current_moves = self.move_generator.generate_movements()
+        # pprint.pp(self.current_moves)
+
+        # check game state
+        self.check_game_state()
+
+        if self.move_cache is not None:
+            packed = map(self.game_state.encode_move, self.current_moves)
+            self.move_cache.put(CacheEntry(key, packed, self.game_state.state_flag, self.cache_depth))
+
+    def prepare_move_generator(self):
         # Configure move generator
         self.move_generator.clear()
 
@@ -27,25 +65,23 @@ class Game:
         # Get flags from threats generated and raise them
         flag = self.move_generator.get_flag_from_threats()
         if flag is not None:
-            self.game_state.state_flag = flag
-
-        # generate possible movements and start turn
-        self.current_moves = self.move_generator.generate_movements()
-        # pprint.pp(self.current_moves)
-
-        # check game state
-        self.check_game_state()
+            self.game_state.flags = flag.value | (self.game_state.flags & FLAG_EN_PASSANT)
 
     def next_turn(self):
         pass
 
-    def check_game_state(self):
-        if self.game_state.halfmove_clock > 49:
+    def check_draw(self):
+        if self.game_state.halfmove_clock > 49 or self.game_state.repetitions() >= self.draw_repetitions:
             self.game_state.raise_flag(GameStateFlag.DRAW)
 
+    def check_game_state(self):
+        # reads current_moves, generated first so the legal moves are not searched twice
+        self.check_draw()
+
         no_movements_allowed = self.current_moves.isempty()
         if no_movements_allowed:
-            if self.game_state.check_flag(GameStateFlag.CHECK):
+            if self.game_state.check_flag(GameStateFlag.CHECK) \
+                    or self.game_state.check_flag(GameStateFlag.DOUBLE_CHECK):
                 self.game_state.raise_flag(GameStateFlag.CHECKMATE)
             else:
                 self.game_state.raise_flag(GameStateFlag.STALEMATE)
@@ -60,20 +96,22 @@ class Game:
         # Execute side effects
         for side_effect in side_effects:
             side_effect(self, move)
+        self.game_state.record_position()
 
         self.prepare_next_turn()
 
     def promote_pawn(self, move: Move):
         random_piecetype = random.choice((PieceType.QUEEN, PieceType.ROOK, PieceType.BISHOP, PieceType.KNIGHT))
-        new_piece = Piece(move.piece.color, random_piecetype)
+        new_piece = get_piece_constant(move.piece.color, random_piecetype)
         self.game_state.promote_pawn(move.end, new_piece)
 
 
 class GraphicalGame(Game):
     controller: Controller
 
-    def __init__(self, fen: str):
-        super(GraphicalGame, self).__init__(fen)
+    def __init__(self, fen: str, backend: GeneratorBackend = GeneratorBackend.OBJECTS,
+                 move_cache: Optional[MoveCache] = None):
+        super(GraphicalGame, self).__init__(fen, backend, move_cache)
         self.controller = Controller(self.game_state)
 
     def start_game(self):
@@ -120,4 +158,4 @@ class GameManager:
             for flag in (GameStateFlag.STALEMATE, GameStateFlag.CHECKMATE, GameStateFlag.DRAW):
                 if self.game.game_state.check_flag(flag):
                     print(f'El resultado es {self.game.game_state.state_flag}')
-                    break
+                    return
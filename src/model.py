@@ -1,16 +1,15 @@
 from __future__ import annotations
 
-import copy
 import pprint
-from collections import UserDict, deque
+import random
+from collections import deque
 from enum import Flag, auto, Enum
-from itertools import groupby, chain
 from typing import Callable, Iterator, Optional, Iterable, Any
 
-from more_itertools import partition, divide
+from more_itertools import divide
 
 from superclasses import ColorFlag
-from util import from_int_to_san, from_san_to_int
+from util import from_int_to_san, from_san_to_int, is_inbound
 
 COLOR_REPRESENTATION = ('upper', 'lower')
 PIECETYPE_REPRESENTATION = ('P', 'N', 'B', 'R', 'Q', 'K')
@@ -57,6 +56,12 @@ class PieceType(Enum):
     KING = 5
 
 
+# Int codes for the hot loops, the enums stay at the API: side 0 for white and 1 for black,
+# piece type as PieceType value
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+COLORS = (Color.WHITE, Color.BLACK)
+
 # (COLOR_NAMES, COLOR_VALUES) = zip(*map(lambda col: (col.name, col.value), Color))
 # (PIECETYPE_NAMES, PIECETYPE_VALUES) = zip(*map(lambda t: (t.name, t.value), PieceType))
 
@@ -68,11 +73,18 @@ class Piece:
     color: Color
     type: PieceType
     representation: str
+    # type value * 2 + side, index in PIECES and value in a CompactBoard
+    code: int
+    side: int
+    type_value: int
 
     def __init__(self, color: Color, t: PieceType):
         self.color = color
         self.type = t
         self.representation = get_piece_representation(color, t)
+        self.side = WHITE if color else BLACK
+        self.type_value = t.value
+        self.code = self.type_value * 2 + self.side
 
     def __hash__(self):
         return hash((self.color, self.type))
@@ -81,17 +93,26 @@ class Piece:
         return f'{self.color}_{self.type}'
 
     def __eq__(self, other):
-        return type(self) is type(other) and self.color is other.color and self.type is other.type
+        return self is other or (type(self) is type(other) and self.color is other.color and self.type is other.type)
 
     __repr__ = __str__
 
+    # copies are the shared constant, as for Slot
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return get_piece_constant, (self.color, self.type)
+
     @classmethod
     def fromstr(cls, piece: str):
+        """ The shared constant of the representation """
         if piece is None:
             return None
-        p = Piece(Color(int(piece.isupper())), PieceType.from_representation(piece))
-        p.representation = piece
-        return p
+        return PIECE_PER_REPRESENTATION[piece]
 
     def tostr(self) -> str:
         return self.representation
@@ -112,10 +133,23 @@ def pieces_const() -> tuple[Piece, ...]:
     return tuple(Piece(Color(color), PieceType(piece_type)) for piece_type in type_range for color in color_range)
 
 
-WHITE_PAWN, BLACK_PAWN, WHITE_KNIGHT, BLACK_KNIGHT, WHITE_BISHOP, BLACK_BISHOP, WHITE_ROOK, BLACK_ROOK, WHITE_QUEEN, BLACK_QUEEN, WHITE_KING, BLACK_KING = pieces_const()
+PIECES = pieces_const()
+WHITE_PAWN, BLACK_PAWN, WHITE_KNIGHT, BLACK_KNIGHT, WHITE_BISHOP, BLACK_BISHOP, WHITE_ROOK, BLACK_ROOK, WHITE_QUEEN, BLACK_QUEEN, WHITE_KING, BLACK_KING = PIECES
+
+
+PIECE_PER_REPRESENTATION = {piece.representation: piece for piece in PIECES}
+# code of an empty square in a CompactBoard
+EMPTY_CODE = len(PIECES)
+# PIECE_OF_CODE[code], the shared constant or None for EMPTY_CODE
+PIECE_OF_CODE = PIECES + (None,)
+
+
+def get_piece_constant(color: Color, t: PieceType) -> Piece:
+    return PIECES[t.value * 2 + (not color)]
 
 
 class Point:
+    __slots__ = ('x', 'y')
     x: int  # column
     y: int  # row
 
@@ -173,6 +207,8 @@ class Point:
 
 
 class Vector(Point):
+    __slots__ = ()
+
     def __init__(self, x: int, y: int, direction: int = 1):
         Point.__init__(self, x * direction, y * direction)
 
@@ -218,16 +254,55 @@ LEFT_TOP_DIRECTION = Vector(-1, 1)
 
 
 class Slot(Point):
+    """
+        Immutable square. The 64 on board squares are built once, Slot(x, y)
+        and Slot.fromflat return the shared instance from BOARD_SLOTS. Off
+        board slots, met while walking a movement, are built on demand
+    """
+    __slots__ = ('_hash',)
+    _hash: int
+
+    def __new__(cls, x: int, y: int):
+        if 0 <= x < 8 and 0 <= y < 8 and len(_board_slots) == 64:
+            return _board_slots[y * 8 + x]
+        slot = object.__new__(cls)
+        object.__setattr__(slot, 'x', x)
+        object.__setattr__(slot, 'y', y)
+        object.__setattr__(slot, '_hash', hash((x, y)))
+        return slot
+
     def __init__(self, x: int, y: int):
-        Point.__init__(self, x, y)
+        # everything is done in __new__
+        pass
+
+    def __setattr__(self, name: str, value: Any):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return Slot, (self.x, self.y)
 
     def __eq__(self, other):
-        return Point.__eq__(self, other)
+        return self is other or Point.__eq__(self, other)
+
+    def __abs__(self) -> Slot:
+        return Slot(abs(self.x), abs(self.y))
 
     def __add__(self, other) -> Slot:
         (a, b), (x, y) = self, other
         return Slot(a + x, b + y)
 
+    __iadd__ = __add__
+
+    def __isub__(self, other) -> Slot:
+        (a, b), (x, y) = self, other
+        return Slot(a - x, b - y)
+
     def __mul__(self, other):
         (a, b) = self
         if isinstance(other, int):
@@ -241,13 +316,15 @@ class Slot(Point):
         return Vector(a - x, b - y)
 
     def __hash__(self):
-        return hash((self.x, self.y))
+        return self._hash
 
     def flat(self) -> int:
         return self.y * 8 + self.x
 
     @classmethod
     def fromflat(cls, flat: int):
+        if 0 <= flat < 64:
+            return BOARD_SLOTS[flat]
         return cls(flat % 8, flat // 8)
 
     @classmethod
@@ -255,9 +332,15 @@ class Slot(Point):
         x, y = point
         return cls(x // divisor, y // divisor)
 
-    def reverse(self):
-        self.y = 7 - self.y
-        return self
+    def reverse(self) -> Slot:
+        """ The same square seen from the other side of the board """
+        return Slot(self.x, 7 - self.y)
+
+
+# Slot.__new__ interns from here once complete
+_board_slots: list[Slot] = []
+_board_slots[:] = [Slot(square % 8, square // 8) for square in range(64)]
+BOARD_SLOTS = tuple(_board_slots)
 
 
 PAWN_ATTACK_MOVEMENTS = (LEFT_TOP_DIRECTION, RIGHT_TOP_DIRECTION)
@@ -268,6 +351,56 @@ BISHOP_MOVEMENTS = (LEFT_TOP_DIRECTION, LEFT_BOTTOM_DIRECTION, RIGHT_BOTTOM_DIRE
 ROOK_MOVEMENTS = (TOP_DIRECTION, RIGHT_DIRECTION, BOTTOM_DIRECTION, LEFT_DIRECTION)
 GODLIKE_MOVEMENTS = BISHOP_MOVEMENTS + ROOK_MOVEMENTS
 
+
+# --------------
+# GEOMETRY
+# --------------
+
+def _inbound_targets(square: int, steps: Iterable[Vector]) -> tuple[Slot, ...]:
+    x, y = square % 8, square // 8
+    return tuple(Slot(x + dx, y + dy) for dx, dy in steps if is_inbound(x + dx, y + dy))
+
+
+def _ray(square: int, step: Vector) -> tuple[Slot, ...]:
+    (x, y), (dx, dy) = Slot.fromflat(square), step
+    ray = []
+    while is_inbound(x + dx, y + dy):
+        x, y = x + dx, y + dy
+        ray.append(Slot(x, y))
+    return tuple(ray)
+
+
+def _between_table() -> tuple[tuple[tuple[Slot, ...], ...], ...]:
+    table: list[list[tuple[Slot, ...]]] = [[()] * 64 for _ in range(64)]
+    for rays in RAY_TARGETS:
+        for start, ray in enumerate(rays):
+            for i, slot in enumerate(ray):
+                table[start][slot.flat()] = ray[:i]
+    return tuple(map(tuple, table))
+
+
+def direction_index(step: Vector) -> int:
+    return DIRECTION_INDEX[tuple(step)]
+
+
+# Built once, indexed by flat square. Slots inside are shared, never mutate them
+DIRECTION_INDEX = {tuple(step): i for i, step in enumerate(GODLIKE_MOVEMENTS)}
+KNIGHT_TARGETS = tuple(_inbound_targets(square, KNIGHT_MOVEMENTS) for square in range(64))
+KING_TARGETS = tuple(_inbound_targets(square, GODLIKE_MOVEMENTS) for square in range(64))
+# PAWN_ATTACK_TARGETS[side][square], slots attacked by a pawn of that side
+PAWN_ATTACK_TARGETS = tuple(
+    tuple(_inbound_targets(square, (Vector(*v, color.direction()) for v in PAWN_ATTACK_MOVEMENTS))
+          for square in range(64))
+    for color in COLORS)
+# RAY_TARGETS[direction][square], sorted from the nearest slot
+RAY_TARGETS = tuple(tuple(_ray(square, step) for square in range(64)) for step in GODLIKE_MOVEMENTS)
+# BETWEEN_SLOTS[start][end], empty if not aligned
+BETWEEN_SLOTS = _between_table()
+
+# --------------
+# GEOMETRY
+# --------------
+
 SideEffectType = Callable[[Any, Any], None]
 
 
@@ -279,8 +412,8 @@ class Move:
 
     def __init__(self, piece: Piece, start: Slot, end: Slot):
         self.piece = piece
-        self.start = copy.copy(start)
-        self.end = copy.copy(end)
+        self.start = start
+        self.end = end
         self.side_effects = deque()
 
     def __iter__(self):
@@ -306,44 +439,106 @@ class Move:
         return cls(piece, start, start + step)
 
 
-class Moves(UserDict[Slot, list[Move]]):
-    def __init__(self, moves: Iterable[Move]):
-        super().__init__()
+# --------------
+# PACKED MOVES
+# --------------
+
+# 16 bits: start (0-5), end (6-11), promotion piece (12-13) and kind (14-15).
+# The promotion bits only mean something for a pawn reaching the last row
+PackedMove = int
+
+NORMAL_MOVE = 0
+DOUBLE_PUSH_MOVE = 1
+EN_PASSANT_MOVE = 2
+CASTLE_MOVE = 3
+
+PROMOTION_PIECETYPES = (PieceType.KNIGHT, PieceType.BISHOP, PieceType.ROOK, PieceType.QUEEN)
+
+
+def encode_move(start: int, end: int, promotion: Optional[PieceType] = None, kind: int = NORMAL_MOVE) -> PackedMove:
+    promotion_bits = promotion.value - 1 if promotion is not None else 0
+    return start | end << 6 | promotion_bits << 12 | kind << 14
+
+
+def decode_move(packed: PackedMove) -> tuple[int, int, PieceType, int]:
+    return packed & 63, packed >> 6 & 63, PROMOTION_PIECETYPES[packed >> 12 & 3], packed >> 14
+
+
+# --------------
+# PACKED MOVES
+# --------------
+
+
+class Moves:
+    """
+        Moves of a position indexed by square: the moves from a start, the
+        move between two squares and whether any move reaches a square are
+        constant time lookups. Iterates and counts the moves themselves
+    """
+    _moves: list[Move]
+    # _by_start[square], None if no move starts there
+    _by_start: list[Optional[list[Move]]]
+    # start * 64 + end to the move
+    _by_squares: dict[int, Move]
+    # _ends[square], 1 if a move ends there
+    _ends: bytearray
+
+    def __init__(self, moves: Iterable[Move] = ()):
+        self._moves = []
+        self._by_start = [None] * 64
+        self._by_squares = {}
+        self._ends = bytearray(64)
         self.add_moves(moves)
-        # self.debug()
 
-    def add_moves(self, moves: Iterable[Move]) -> None:
-        def groupby_dict(data: Iterable, key: str) -> dict:
-            return {key: list(d) for key, d in groupby(data, key=lambda move: getattr(move, key))}
+    def __str__(self):
+        return f'Moves({self._moves})'
+
+    __repr__ = __str__
+
+    def __len__(self):
+        return len(self._moves)
+
+    def __iter__(self) -> Iterator[Move]:
+        return iter(self._moves)
 
-        self.update(groupby_dict(moves, 'start'))
+    def add_moves(self, moves: Iterable[Move]) -> None:
+        by_start, by_squares, ends = self._by_start, self._by_squares, self._ends
+        for move in moves:
+            start, end = move.start.flat(), move.end.flat()
+            starting = by_start[start]
+            if starting is None:
+                by_start[start] = [move]
+            else:
+                starting.append(move)
+            by_squares[start << 6 | end] = move
+            ends[end] = 1
+            self._moves.append(move)
+
+    def get(self, start: Slot) -> Optional[list[Move]]:
+        return self._by_start[start.flat()]
+
+    def values(self) -> Iterator[list[Move]]:
+        """ Moves grouped by start square """
+        return (moves for moves in self._by_start if moves is not None)
 
     def search_move(self, start: Slot, end: Slot) -> Optional[Move]:
-        moves = self.get(start)
-        if moves is not None:
-            for move in moves:
-                if move.end == end:
-                    return move
-        return None
+        return self._by_squares.get(start.flat() << 6 | end.flat())
 
     def from_start(self, start: Slot) -> list[Slot]:
-        moves = self.get(start)
-        return [end for _, end, _ in moves] if moves is not None else []
+        moves = self._by_start[start.flat()]
+        return [move.end for move in moves] if moves is not None else []
 
     def debug(self):
-        pprint.pp(self)
-
-    def _end_iterator(self) -> Iterator[Slot]:
-        return (end for _, end, _ in chain.from_iterable(self.values()))
+        pprint.pp(self._moves)
 
     def search_end(self, target: Slot) -> bool:
-        return next((a for a in self._end_iterator() if a == target), False) is not None
+        return bool(self._ends[target.flat()])
 
     def get_ends(self) -> list[Slot]:
-        return list(self._end_iterator())
+        return [move.end for move in self._moves]
 
     def isempty(self) -> bool:
-        return len(self) == 0
+        return not self._moves
 
 
 Square = Optional[Piece]
@@ -370,6 +565,40 @@ class Board(list[Square]):
     def set(self, square: int, piece: Optional[Piece]):
         self[square] = piece
 
+    def compact(self) -> CompactBoard:
+        return CompactBoard(EMPTY_CODE if piece is None else piece.code for piece in self)
+
+    @classmethod
+    def from_compact(cls, codes: bytes) -> Board:
+        return cls(map(PIECE_OF_CODE.__getitem__, codes))
+
+
+class CompactBoard(bytearray):
+    """
+        The 64 piece codes of a board, one byte per square. Cheap to copy,
+        hash (as bytes) and ship around. Pieces read from it are the shared
+        constants of PIECES
+    """
+
+    def __str__(self):
+        return str(self.to_board())
+
+    def copy(self) -> CompactBoard:
+        return CompactBoard(self)
+
+    def get_piece(self, square: int) -> Square:
+        return PIECE_OF_CODE[self[square]]
+
+    def move(self, start: int, end: int):
+        self[end] = self[start]
+        self[start] = EMPTY_CODE
+
+    def set(self, square: int, piece: Optional[Piece]):
+        self[square] = EMPTY_CODE if piece is None else piece.code
+
+    def to_board(self) -> Board:
+        return Board.from_compact(self)
+
 
 LocalizedPiece = tuple[int | Slot, Piece]
 ColorPieceSet = list[LocalizedPiece]
@@ -380,6 +609,99 @@ WHITE_KING_ROOK_INITIAL_STATE = Slot(7, 0)
 BLACK_QUEEN_ROOK_INITIAL_STATE = Slot(0, 7)
 BLACK_KING_ROOK_INITIAL_STATE = Slot(7, 7)
 
+ALL_SQUARES = (1 << 64) - 1
+
+# Castling rights packed in an int
+WHITE_KINGSIDE = 1
+WHITE_QUEENSIDE = 2
+BLACK_KINGSIDE = 4
+BLACK_QUEENSIDE = 8
+ALL_CASTLING_RIGHTS = WHITE_KINGSIDE | WHITE_QUEENSIDE | BLACK_KINGSIDE | BLACK_QUEENSIDE
+
+# Rights kept when a piece leaves or lands on each square
+CASTLING_RIGHTS_KEPT = tuple(ALL_CASTLING_RIGHTS & ~{
+    WHITE_QUEEN_ROOK_INITIAL_STATE.flat(): WHITE_QUEENSIDE,
+    4: WHITE_KINGSIDE | WHITE_QUEENSIDE,
+    WHITE_KING_ROOK_INITIAL_STATE.flat(): WHITE_KINGSIDE,
+    BLACK_QUEEN_ROOK_INITIAL_STATE.flat(): BLACK_QUEENSIDE,
+    60: BLACK_KINGSIDE | BLACK_QUEENSIDE,
+    BLACK_KING_ROOK_INITIAL_STATE.flat(): BLACK_KINGSIDE,
+}.get(square, 0) for square in range(64))
+
+# --------------
+# ZOBRIST
+# --------------
+
+def _zobrist_keys(seed: int = 0x5A0B) -> tuple[tuple[tuple[int, ...], ...], int, tuple[int, ...], tuple[int, ...]]:
+    rng = random.Random(seed)
+    pieces = tuple(tuple(rng.getrandbits(64) for _ in range(64)) for _ in PIECES)
+    black_to_move = rng.getrandbits(64)
+    rights = tuple(rng.getrandbits(64) for _ in range(4))
+    castling = []
+    for mask in range(ALL_CASTLING_RIGHTS + 1):
+        key = 0
+        for bit, right in enumerate(rights):
+            if mask & 1 << bit:
+                key ^= right
+        castling.append(key)
+    en_passant = tuple(rng.getrandbits(64) for _ in range(8))
+    return pieces, black_to_move, tuple(castling), en_passant
+
+
+# ZOBRIST_PIECES[code][square], ZOBRIST_CASTLING[castling rights], ZOBRIST_EN_PASSANT[file]
+ZOBRIST_PIECES, ZOBRIST_BLACK_TO_MOVE, ZOBRIST_CASTLING, ZOBRIST_EN_PASSANT = _zobrist_keys()
+
+# --------------
+# ZOBRIST
+# --------------
+
+# start, end, moved piece, captured piece, captured square, castling rights, en passant target, halfmove clock,
+# fullmove number and state flags before the move
+UndoRecord = tuple[int, int, Piece, Square, int, int, Optional[Slot], int, int, int]
+
+
+# make_packed_move records, the last one first: (record, records before it). Never mutated, so a
+# snapshot shares the whole stack
+UndoStack = Optional[tuple[UndoRecord, 'UndoStack']]
+# Positions played, the current one first: ((Zobrist key, times reached so far), positions before it), shared the
+# same way
+PositionHistory = Optional[tuple[tuple[int, int], 'PositionHistory']]
+
+
+def _unlink(stack: Optional[tuple]) -> list:
+    """ Items of an (item, items before it) stack, the last pushed first """
+    items = []
+    while stack is not None:
+        item, stack = stack
+        items.append(item)
+    return items
+
+
+def _link(items: list) -> Optional[tuple]:
+    stack = None
+    for item in reversed(items):
+        stack = item, stack
+    return stack
+
+
+class Snapshot:
+    """
+        Everything GameState.restore needs to bring a position back. Only
+        the position itself is copied, the history is shared, so the cost
+        does not grow with the plies played
+    """
+    __slots__ = ('board', 'castling_rights', 'en_passant_target', 'halfmove_clock', 'fullmove_number', 'flags',
+                 'side', 'undo_stack', 'position_keys')
+    board: tuple[Square, ...]
+    castling_rights: int
+    en_passant_target: Optional[Slot]
+    halfmove_clock: int
+    fullmove_number: int
+    flags: int
+    side: int
+    undo_stack: UndoStack
+    position_keys: PositionHistory
+
 
 # --------------
 # ENUMS
@@ -398,14 +720,25 @@ class GameStateFlag(Flag):
     DRAW = auto()
 
 
+# GameStateFlag values, for GameState.flags
+FLAG_NORMAL = GameStateFlag.NORMAL.value
+FLAG_CHECK = GameStateFlag.CHECK.value
+FLAG_DOUBLE_CHECK = GameStateFlag.DOUBLE_CHECK.value
+FLAG_EN_PASSANT = GameStateFlag.EN_PASSANT.value
+FLAG_STALEMATE = GameStateFlag.STALEMATE.value
+FLAG_CHECKMATE = GameStateFlag.CHECKMATE.value
+FLAG_DRAW = GameStateFlag.DRAW.value
+
+
 # --------------
 # ENUMS
 # --------------
 
 class GameState:
     _board: Board
-    state_flag: GameStateFlag
-    next_to_move: Color
+    # state_flag and next_to_move as ints, what the move generator reads
+    flags: int
+    side: int
     en_passant_target: Optional[Slot]
     halfmove_clock: int
     fullmove_number: int
@@ -413,12 +746,25 @@ class GameState:
     white_queen_can_castle: bool
     black_king_can_castle: bool
     black_queen_can_castle: bool
+    _undo_stack: UndoStack
+    # Piece index, kept in step with the board: _locations[side][square] and _king_squares[side],
+    # side 0 for white and 1 for black as in Piece.code
+    _locations: tuple[dict[int, Piece], dict[int, Piece]]
+    _king_squares: list[Optional[int]]
+    # Zobrist key of the pieces alone, kept in step with the board like the index
+    _pieces_key: int
+    # squares written since the last take_changed_squares, bit i for square i
+    _changed_squares: int
+    _position_keys: PositionHistory
+    # times each key appears among the _counted latest positions, enough of them to count the next one
+    _position_counts: dict[int, int]
+    _counted: int
 
     def __init__(self, board: Board, st: GameStateFlag, ntm: Color, wk: bool, wq: bool, bk: bool, bq: bool,
                  ept: Optional[Slot], hc: int, fm: int):
         self._board = board
-        self.state_flag = st
-        self.next_to_move = ntm
+        self.flags = st.value
+        self.side = WHITE if ntm else BLACK
         self.white_king_can_castle = wk
         self.white_queen_can_castle = wq
         self.black_king_can_castle = bk
@@ -426,8 +772,25 @@ class GameState:
         self.en_passant_target = ept
         self.halfmove_clock = hc
         self.fullmove_number = fm
+        self._undo_stack = None
+        self._index_pieces()
         if ept is not None:
-            self.raise_flag(GameStateFlag.EN_PASSANT)
+            self.flags |= FLAG_EN_PASSANT
+        self._position_keys = None
+        self._position_counts, self._counted = {}, 0
+        self.record_position()
+
+    def __getstate__(self):
+        """ Histories as lists, copy and pickle would run out of recursion on long games """
+        state = self.__dict__.copy()
+        state['_undo_stack'] = _unlink(self._undo_stack)
+        state['_position_keys'] = _unlink(self._position_keys)
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._undo_stack = _link(state['_undo_stack'])
+        self._position_keys = _link(state['_position_keys'])
 
     def __str__(self):
         res = ''
@@ -440,69 +803,344 @@ class GameState:
     def board(self):
         return self._board
 
+    @property
+    def state_flag(self) -> GameStateFlag:
+        return GameStateFlag(self.flags)
+
+    @state_flag.setter
+    def state_flag(self, flag: GameStateFlag):
+        self.flags = flag.value
+
+    @property
+    def next_to_move(self) -> Color:
+        return COLORS[self.side]
+
+    @next_to_move.setter
+    def next_to_move(self, color: Color):
+        self.side = WHITE if color else BLACK
+
+    def _index_pieces(self):
+        locations, king_squares, key = ({}, {}), [None, None], 0
+        for square, piece in enumerate(self._board):
+            if piece is not None:
+                code = piece.code
+                locations[code & 1][square] = piece
+                key ^= ZOBRIST_PIECES[code][square]
+                if code >> 1 == KING:
+                    king_squares[code & 1] = square
+        self._locations, self._king_squares, self._pieces_key = locations, king_squares, key
+        self._changed_squares = ALL_SQUARES
+
+    def _place(self, square: int, piece: Piece):
+        """ Puts piece on an empty square """
+        self._board[square] = piece
+        self._locations[piece.side][square] = piece
+        self._pieces_key ^= ZOBRIST_PIECES[piece.code][square]
+        self._changed_squares |= 1 << square
+        if piece.type_value == KING:
+            self._king_squares[piece.side] = square
+
+    def _clear(self, square: int) -> Square:
+        """ Empties square, returning what was there """
+        piece = self._board[square]
+        if piece is not None:
+            self._board[square] = None
+            del self._locations[piece.side][square]
+            self._pieces_key ^= ZOBRIST_PIECES[piece.code][square]
+            self._changed_squares |= 1 << square
+        return piece
+
+    def _set(self, square: int, piece: Square):
+        self._clear(square)
+        if piece is not None:
+            self._place(square, piece)
+
+    def _move(self, start: int, end: int):
+        piece = self._clear(start)
+        self._clear(end)
+        self._place(end, piece)
+
+    def take_changed_squares(self) -> int:
+        """
+            Squares written since the previous call, all of them the first
+            time. Meant for a single consumer, the incremental move generator
+        """
+        changed, self._changed_squares = self._changed_squares, 0
+        return changed
+
     def set_en_passant(self, target: Slot):
-        self.raise_flag(GameStateFlag.EN_PASSANT)
+        self.flags |= FLAG_EN_PASSANT
         self.en_passant_target = target
 
     def raise_flag(self, flag: GameStateFlag):
-        if flag is GameStateFlag.CHECK and GameStateFlag.CHECK in flag:
-            flag = GameStateFlag.DOUBLE_CHECK
-        self.state_flag |= flag
+        self.raise_flags(flag.value)
+
+    def raise_flags(self, flags: int):
+        if flags == FLAG_CHECK and self.flags & FLAG_CHECK:
+            flags = FLAG_DOUBLE_CHECK
+        self.flags |= flags
 
     def check_flag(self, flag: GameStateFlag) -> bool:
-        return flag in self.state_flag
+        return self.flags & flag.value == flag.value
+
+    def has_flags(self, flags: int) -> bool:
+        """ check_flag for FLAG_ values, any of them """
+        return bool(self.flags & flags)
 
     def find_king(self, color: Color = None) -> Slot:
         if color is None:
             color = self.next_to_move
-        p = WHITE_KING if color == Color.WHITE else BLACK_KING
-        return Slot.fromflat(self.board.index(p))
+        square = self._king_squares[WHITE if color else BLACK]
+        if square is None:
+            raise ValueError(f'no {color} king')
+        return BOARD_SLOTS[square]
 
     def get_pieces(self, localiced: bool = False) -> PieceSet:
-        f: ColorPieceSet
-        t: ColorPieceSet
+        """ Pieces of the side not to move and of the side to move """
+        opponent, moving = self._locations[self.side ^ 1], self._locations[self.side]
         if localiced:
-            pieces_source = tuple((Slot.fromflat(i), e) for i, e in enumerate(self.board) if e is not None)
-            f, t = partition(lambda s: s[1].color == self.next_to_move, pieces_source)
-        else:
-            f, t = partition(lambda s: s.color == self.next_to_move, self.board)
-
-        return list(f), list(t)
+            return ([(BOARD_SLOTS[square], piece) for square, piece in opponent.items()],
+                    [(BOARD_SLOTS[square], piece) for square, piece in moving.items()])
+        return list(opponent.values()), list(moving.values())
+
+    def zobrist_key(self) -> int:
+        """
+            64 bit key of the position: pieces, side to move, castling rights
+            and en passant file. The pieces part is updated on every board
+            write, the rest is folded in here
+        """
+        key = self._pieces_key ^ ZOBRIST_CASTLING[self.castling_rights()] ^ self._en_passant_key()
+        return key ^ ZOBRIST_BLACK_TO_MOVE if self.side else key
+
+    def _en_passant_key(self) -> int:
+        """ The file of the en passant target counts only if a pawn is there to take it, as in FIDE repetitions """
+        target = self.en_passant_target
+        if target is None:
+            return 0
+        # the pushed pawn stands beyond the target, where the capturing pawns must be too
+        row, capturer = (3, BLACK_PAWN.code) if target.y == 2 else (4, WHITE_PAWN.code)
+        board = self._board
+        for x in (target.x - 1, target.x + 1):
+            if 0 <= x < 8 and board[row * 8 + x] is not None and board[row * 8 + x].code == capturer:
+                return ZOBRIST_EN_PASSANT[target.x]
+        return 0
+
+    def compute_zobrist_key(self) -> int:
+        """ zobrist_key from scratch, to verify the incremental one """
+        key = 0
+        for square, piece in enumerate(self._board):
+            if piece is not None:
+                key ^= ZOBRIST_PIECES[piece.code][square]
+        key ^= ZOBRIST_CASTLING[self.castling_rights()] ^ self._en_passant_key()
+        return key ^ ZOBRIST_BLACK_TO_MOVE if self.side else key
+
+    def record_position(self):
+        """ Adds the current position to the history, once the move leading to it is complete """
+        # only the last halfmove_clock positions can be the same
+        if self._counted < self.halfmove_clock:
+            self._count_positions(self.halfmove_clock)
+        key, counts = self.zobrist_key(), self._position_counts
+        count = counts.get(key, 0) + 1
+        counts[key] = count
+        self._counted += 1
+        self._position_keys = ((key, count), self._position_keys)
+
+    def _count_positions(self, plies: int):
+        """ Extends the counts to the latest plies positions, after a restore or unmaking an irreversible move """
+        counts, history = self._position_counts, self._position_keys
+        for _ in range(self._counted):
+            if history is None:
+                break
+            history = history[1]
+        for _ in range(self._counted, plies):
+            if history is None:
+                break
+            (key, _), history = history
+            counts[key] = counts.get(key, 0) + 1
+        self._counted = plies
+
+    def _forget_position(self):
+        (key, _), self._position_keys = self._position_keys
+        if self._counted:
+            self._counted -= 1
+            count = self._position_counts[key] - 1
+            if count:
+                self._position_counts[key] = count
+            else:
+                del self._position_counts[key]
+
+    def repetitions(self) -> int:
+        """
+            Times the current position has been reached, this one included,
+            counted when it was recorded. Positions before an irreversible move
+            differ in material, pawns or castling rights, so they never match
+        """
+        return self._position_keys[0][1]
+
+    def piece_squares(self, color: Color) -> dict[int, Piece]:
+        """ Square to piece of every piece of color, a live view that must not be modified """
+        return self._locations[WHITE if color else BLACK]
 
     def get_piece(self, slot: Slot) -> Square:
-        return self.board[slot.flat()]
+        return self._board[slot.y * 8 + slot.x]
+
+    def castling_rights(self) -> int:
+        return ((self.white_king_can_castle and WHITE_KINGSIDE)
+                | (self.white_queen_can_castle and WHITE_QUEENSIDE)
+                | (self.black_king_can_castle and BLACK_KINGSIDE)
+                | (self.black_queen_can_castle and BLACK_QUEENSIDE))
+
+    def set_castling_rights(self, rights: int):
+        self.white_king_can_castle = bool(rights & WHITE_KINGSIDE)
+        self.white_queen_can_castle = bool(rights & WHITE_QUEENSIDE)
+        self.black_king_can_castle = bool(rights & BLACK_KINGSIDE)
+        self.black_queen_can_castle = bool(rights & BLACK_QUEENSIDE)
+
+    def _update_castling_rights(self, start: int, end: int):
+        rights = self.castling_rights()
+        kept = rights & CASTLING_RIGHTS_KEPT[start] & CASTLING_RIGHTS_KEPT[end]
+        if kept != rights:
+            self.set_castling_rights(kept)
 
     def commit_move(self, start: Slot, end: Slot):
         self.halfmove_clock = self._change_halfmove_clock(start, end)
+        # a rook captured in its corner takes its castle with it
+        self._update_castling_rights(start.flat(), end.flat())
         self.move(start.flat(), end.flat())
 
         self.en_passant_target = None
-        if not self.next_to_move:
+        if self.side:
             self.fullmove_number += 1
 
-        self.state_flag = GameStateFlag.NORMAL
-        self.next_to_move = ~self.next_to_move
+        self.flags = FLAG_NORMAL
+        self.side ^= 1
 
     def _change_halfmove_clock(self, start: Slot, end: Slot):
         moving_piece = self.get_piece(start)
         if moving_piece is None:
             raise InvalidStateError
-        if moving_piece.type is PieceType.PAWN or self.get_piece(end) is not None:
+        if moving_piece.type_value == PAWN or self.get_piece(end) is not None:
             return 0
         return self.halfmove_clock + 1
 
     def promote_pawn(self, slot: Slot, piece_to_promote: Piece):
-        self._board.set(slot.flat(), piece_to_promote)
+        self._set(slot.flat(), piece_to_promote)
 
     def remove(self, slot: Slot):
-        self._board.set(slot.flat(), None)
+        self._clear(slot.flat())
 
     def move(self, start: int | Slot, end: int | Slot):
         if isinstance(start, Slot):
             start = start.flat()
         if isinstance(end, Slot):
             end = end.flat()
-        self._board.move(start, end)
+        self._move(start, end)
+
+    def encode_move(self, move: Move, promotion: Optional[PieceType] = None) -> PackedMove:
+        start, end = move.as_values()
+        kind = NORMAL_MOVE
+        if move.piece.type is PieceType.PAWN:
+            if abs(end - start) == 16:
+                kind = DOUBLE_PUSH_MOVE
+            elif start % 8 != end % 8 and self._board[end] is None:
+                kind = EN_PASSANT_MOVE
+            elif (end < 8 or end > 55) and promotion is None:
+                promotion = PieceType.QUEEN
+        elif move.piece.type is PieceType.KING and abs(end - start) == 2:
+            kind = CASTLE_MOVE
+        return encode_move(start, end, promotion, kind)
+
+    def make_move(self, move: Move, promotion: Optional[PieceType] = None):
+        """
+            Apply a legal move with all its consequences (castle, en passant,
+            promotion, rights and clocks), keeping what is needed to undo it.
+            Pawns promote to a queen unless told otherwise
+        """
+        self.make_packed_move(self.encode_move(move, promotion))
+
+    def make_packed_move(self, packed: PackedMove):
+        board = self._board
+        start, end, kind = packed & 63, packed >> 6 & 63, packed >> 14
+        piece = board[start]
+        if piece is None:
+            raise InvalidStateError
+        captured_square = end if kind != EN_PASSANT_MOVE else end % 8 + start // 8 * 8
+        captured = board[captured_square]
+        self._undo_stack = ((start, end, piece, captured, captured_square, self.castling_rights(),
+                             self.en_passant_target, self.halfmove_clock, self.fullmove_number, self.flags),
+                            self._undo_stack)
+
+        self._clear(captured_square)
+        self._move(start, end)
+        self.flags = FLAG_NORMAL
+        self.en_passant_target = None
+        if kind == DOUBLE_PUSH_MOVE:
+            self.set_en_passant(Slot.fromflat((start + end) // 2))
+        elif kind == CASTLE_MOVE:
+            rook_start, rook_end = (end + 1, end - 1) if end > start else (end - 2, end + 1)
+            self._move(rook_start, rook_end)
+        elif piece.type_value == PAWN and (end < 8 or end > 55):
+            self._set(end, get_piece_constant(piece.color, PROMOTION_PIECETYPES[packed >> 12 & 3]))
+
+        self._update_castling_rights(start, end)
+        self.halfmove_clock = 0 if piece.type_value == PAWN or captured is not None else self.halfmove_clock + 1
+        if self.side:
+            self.fullmove_number += 1
+        self.side ^= 1
+        self.record_position()
+
+    def unmake_move(self):
+        self._forget_position()
+        ((start, end, piece, captured, captured_square, castling_rights,
+          self.en_passant_target, self.halfmove_clock, self.fullmove_number, self.flags),
+         self._undo_stack) = self._undo_stack
+        self._clear(end)
+        self._place(start, piece)
+        if captured is not None:
+            self._place(captured_square, captured)
+        if piece.type_value == KING and abs(end - start) == 2:
+            rook_start, rook_end = (end + 1, end - 1) if end > start else (end - 2, end + 1)
+            self._move(rook_end, rook_start)
+        self.set_castling_rights(castling_rights)
+        self.side ^= 1
+
+    def snapshot(self) -> Snapshot:
+        snapshot = Snapshot()
+        snapshot.board = tuple(self._board)
+        snapshot.castling_rights = self.castling_rights()
+        snapshot.en_passant_target = self.en_passant_target
+        snapshot.halfmove_clock = self.halfmove_clock
+        snapshot.fullmove_number = self.fullmove_number
+        snapshot.flags = self.flags
+        snapshot.side = self.side
+        snapshot.undo_stack = self._undo_stack
+        snapshot.position_keys = self._position_keys
+        return snapshot
+
+    def restore(self, snapshot: Snapshot):
+        """
+            Brings back the position of snapshot in place, so whoever holds
+            this state or its board (a MoveGenerator) sees it. A snapshot
+            can be restored any number of times
+        """
+        self._board[:] = snapshot.board
+        self._index_pieces()
+        self.set_castling_rights(snapshot.castling_rights)
+        self.en_passant_target = snapshot.en_passant_target
+        self.halfmove_clock = snapshot.halfmove_clock
+        self.fullmove_number = snapshot.fullmove_number
+        self.flags = snapshot.flags
+        self.side = snapshot.side
+        self._undo_stack = snapshot.undo_stack
+        self._position_keys = snapshot.position_keys
+        self._position_counts, self._counted = {}, 0
+
+    def clone(self) -> GameState:
+        """ Independent copy, without the deepcopy of the board pieces """
+        clone = GameState.__new__(GameState)
+        clone._board = Board()
+        clone.restore(self.snapshot())
+        return clone
 
     def castle_available_info(self) -> Iterator[tuple[Slot, Slot, Vector]]:
         if self.next_to_move and self.white_king_can_castle:
@@ -510,9 +1148,9 @@ class GameState:
         if self.next_to_move and self.white_queen_can_castle:
             yield Slot(4, 0), Slot(0, 0), Vector(-1, 0)
         if not self.next_to_move and self.black_king_can_castle:
-            yield Slot(4, 7), Slot(0, 7), Vector(-1, 0)
-        if not self.next_to_move and self.black_queen_can_castle:
             yield Slot(4, 7), Slot(7, 7), Vector(1, 0)
+        if not self.next_to_move and self.black_queen_can_castle:
+            yield Slot(4, 7), Slot(0, 7), Vector(-1, 0)
 
     @classmethod
     def from_fen(cls, fen_str: str):
@@ -1,20 +1,26 @@
 from __future__ import annotations
 
-import copy
-from collections import Counter
 from enum import Flag, auto, Enum
-from itertools import chain
-from typing import Iterator, Callable, Optional
+from itertools import chain, compress
+from typing import Iterator, Callable, Optional, TypeVar
 
-from model import Slot, Vector, Move, Moves, GameState, PieceType, Piece, KNIGHT_MOVEMENTS, PAWN_ATTACK_MOVEMENTS, \
+import bitboard
+from bitboard import Bitboards, IncrementalAttacks, KingSafety
+from model import Slot, Vector, Move, Moves, GameState, InvalidStateError, PieceType, Piece, PAWN_ATTACK_MOVEMENTS, \
     WHITE_PAWN, BLACK_PAWN, \
-    TOP_DIRECTION, BISHOP_MOVEMENTS, ROOK_MOVEMENTS, \
+    TOP_DIRECTION, RIGHT_DIRECTION, LEFT_DIRECTION, BISHOP_MOVEMENTS, ROOK_MOVEMENTS, \
     GameStateFlag, ColorPieceSet, WHITE_KING, WHITE_QUEEN_ROOK_INITIAL_STATE, \
-    WHITE_KING_ROOK_INITIAL_STATE, BLACK_QUEEN_ROOK_INITIAL_STATE, BLACK_KING_ROOK_INITIAL_STATE, GODLIKE_MOVEMENTS
+    WHITE_KING_ROOK_INITIAL_STATE, BLACK_QUEEN_ROOK_INITIAL_STATE, BLACK_KING_ROOK_INITIAL_STATE, \
+    KNIGHT_TARGETS, KING_TARGETS, PAWN_ATTACK_TARGETS, RAY_TARGETS, BETWEEN_SLOTS, DIRECTION_INDEX, \
+    GODLIKE_MOVEMENTS, direction_index, Board, PackedMove, \
+    PROMOTION_PIECETYPES, NORMAL_MOVE, DOUBLE_PUSH_MOVE, EN_PASSANT_MOVE, CASTLE_MOVE, \
+    PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, FLAG_CHECK, FLAG_DOUBLE_CHECK, FLAG_EN_PASSANT
+
 from superclasses import flatten_until
 from util import is_inbound
 
 MovesIterator = Iterator[Move]
+T = TypeVar('T')
 
 
 def none_iter():
@@ -42,16 +48,6 @@ def pawn_regular_movement(start: Slot, piece: Piece) -> MovesIterator:
     yield Move(piece, start, start + TOP_DIRECTION * piece.direction())
 
 
-def pawn_twostep_movement(start: Slot, piece: Piece) -> MovesIterator:
-    v = None
-    if start.y == 1 and piece == WHITE_PAWN:
-        v = 0, 2
-    if start.y == 6 and piece == BLACK_PAWN:
-        v = 0, -2
-    if v is not None:
-        yield Move(piece, start, start + v)
-
-
 def promote_pawn(gm, m):
     if (m.piece == BLACK_PAWN and m.end.y == 0) or (m.piece == WHITE_PAWN and m.end.y == 7):
         gm.promote_pawn(m)
@@ -62,7 +58,7 @@ def remove_en_passant_target_pawn(gm, m: Move):
     gm.game_state.remove(Slot(end_x, start_y))
 
 
-def not_double_check(mg): return not mg.game_state.check_flag(GameStateFlag.DOUBLE_CHECK)
+def not_double_check(mg): return not mg.game_state.flags & FLAG_DOUBLE_CHECK
 
 
 def move_rook_in_castle(gm, move: Move):
@@ -83,8 +79,17 @@ def forbid_castle_king(gm, move: Move):
         gm.black_king_can_castle = False
 
 
+def castle(gm, move: Move):
+    forbid_castle_king(gm, move)
+    move_rook_in_castle(gm, move)
+
+
+def set_en_passant_target(gm, move: Move):
+    gm.game_state.set_en_passant(move.start + TOP_DIRECTION * move.piece.direction())
+
+
 def regular_king_movements(start: Slot, piece: Piece) -> MovesIterator:
-    yield from (Move(piece, start, start + step) for step in GODLIKE_MOVEMENTS)
+    yield from (Move(piece, start, end) for end in KING_TARGETS[start.flat()])
 
 
 def forbid_castle_rook(gm, move: Move):
@@ -99,32 +104,44 @@ def forbid_castle_rook(gm, move: Move):
 
 
 def knight_movement(start: Slot, piece: Piece) -> MovesIterator:
-    for step in KNIGHT_MOVEMENTS:
-        yield Move(piece, start, start + step)
+    for end in KNIGHT_TARGETS[start.flat()]:
+        yield Move(piece, start, end)
 
 
 def is_aligned(start: Slot, step: Vector, stop: Slot):
-    current = copy.copy(start)
-    steps = 0
-    while True:
-        current += step
-        steps += 1
-        if not is_inbound(*current):
-            return False
+    for steps, current in enumerate(RAY_TARGETS[direction_index(step)][start.flat()]):
         if current == stop:
-            return steps - 1
+            return steps
+    return False
 
 
-repeteable_moves_per_piecetype = {
-    PieceType.BISHOP: BISHOP_MOVEMENTS,
-    PieceType.ROOK: ROOK_MOVEMENTS,
-    PieceType.QUEEN: BISHOP_MOVEMENTS + ROOK_MOVEMENTS
-}
+# repeteable_moves_per_piecetype[type_value], directions a slider moves along, none for the other pieces
+repeteable_moves_per_piecetype = (
+    (), (),
+    tuple(map(direction_index, BISHOP_MOVEMENTS)),
+    tuple(map(direction_index, ROOK_MOVEMENTS)),
+    tuple(map(direction_index, BISHOP_MOVEMENTS + ROOK_MOVEMENTS)),
+    (),
+)
+# Per direction index, the pieces that attack along it and the way back
+# SLIDERS_PER_DIRECTION[direction], piece type values moving along it
+SLIDERS_PER_DIRECTION = tuple((BISHOP, QUEEN) if step in BISHOP_MOVEMENTS else (ROOK, QUEEN)
+                              for step in GODLIKE_MOVEMENTS)
+OPPOSITE_DIRECTION = tuple(DIRECTION_INDEX[-x, -y] for x, y in GODLIKE_MOVEMENTS)
 
 
-class GeneratorMode(Enum):
-    MOVEMENTS = 0
-    THREATS = 1
+class MoveStage(Enum):
+    # captures and promotions
+    NOISY = 0
+    CHECKS = 1
+    QUIETS = 2
+
+
+class GeneratorBackend(Enum):
+    OBJECTS = 0
+    BITBOARD = 1
+    # bitboards whose attack sets are kept between turns
+    INCREMENTAL = 2
 
 
 class TargetSquareFlag(Flag):
@@ -142,6 +159,7 @@ class TargetSquareFlag(Flag):
 
 class MoveRestrictor:
     """
+        Lines are found looking outward from the king of the moving side.
         If theres one defender, that piece can only move along the slots
         that belong to the line
         If theres no defender, it means the king is checked. Only moves permitted:
@@ -149,6 +167,7 @@ class MoveRestrictor:
             Other piece to the line
     """
     game_state: GameState
+    checkers: list[Slot]
     threatening_slot: Optional[Slot]
     threatening_line_slots: list[Slot]
     forced_movements_per_piece: dict[Slot, list[Slot]]
@@ -156,105 +175,228 @@ class MoveRestrictor:
 
     def __init__(self, game_state: GameState):
         self.game_state = game_state
+        self.checkers = []
         self.threatening_slot = None
         self.forced_movements_per_piece = {}
         self.forbidden_king_move_slots = []
         self.threatening_line_slots = []
 
-    def add_threatening_line(self, start: Slot, step: Vector, end: Slot):
+    def is_enemy(self, slot: Slot, type_value: int) -> bool:
+        piece = self.game_state.get_piece(slot)
+        return piece is not None and piece.side != self.game_state.side and piece.type_value == type_value
+
+    def scan_king(self, king: Slot):
+        """ Knight and pawn patterns, then rays, cast outward from the king """
+        square, side = king.flat(), self.game_state.side
+        for slot in KNIGHT_TARGETS[square]:
+            if self.is_enemy(slot, KNIGHT):
+                self.add_checker(slot)
+        for slot in PAWN_ATTACK_TARGETS[side][square]:
+            if self.is_enemy(slot, PAWN):
+                self.add_checker(slot)
+        for direction, sliders in enumerate(SLIDERS_PER_DIRECTION):
+            defended = False
+            for slot in RAY_TARGETS[direction][square]:
+                piece = self.game_state.get_piece(slot)
+                if piece is None:
+                    continue
+                if piece.side == side and not defended:
+                    defended = True
+                    continue
+                if piece.side != side and piece.type_value in sliders:
+                    self.add_threatening_line(slot, OPPOSITE_DIRECTION[direction], king)
+                break
+
+    def add_checker(self, start: Slot):
+        # Knights and pawns give check without a line
+        self.game_state.raise_flags(FLAG_CHECK)
+        self.checkers.append(start)
         self.threatening_slot = start
-        current = copy.copy(start)
-        slot_list, defenses_list = [], []
-        defenses_color = self.game_state.next_to_move
-        while True:
-            current += step
-            if current == end:
+
+    def is_attacked(self, slot: Slot) -> bool:
+        """ Whether the enemy attacks slot, looking through the king of the moving side """
+        square, side = slot.flat(), self.game_state.side
+        for targets, type_value in ((KNIGHT_TARGETS, KNIGHT), (KING_TARGETS, KING),
+                                    (PAWN_ATTACK_TARGETS[side], PAWN)):
+            if any(self.is_enemy(target, type_value) for target in targets[square]):
+                return True
+        for direction, sliders in enumerate(SLIDERS_PER_DIRECTION):
+            for target in RAY_TARGETS[direction][square]:
+                piece = self.game_state.get_piece(target)
+                if piece is None or (piece.type_value == KING and piece.side == side):
+                    continue
+                if piece.side != side and piece.type_value in sliders:
+                    return True
                 break
+        return False
+
+    def add_threatening_line(self, start: Slot, direction: int, end: Slot):
+        slot_list, defenses_list = [], []
+        defenses_side = self.game_state.side
+        for current in BETWEEN_SLOTS[start.flat()][end.flat()]:
             current_piece = self.game_state.get_piece(current)
             if current_piece is None:
-                slot_list.append(copy.copy(current))
-            elif current_piece.color is defenses_color:
-                defenses_list.append(copy.copy(current))
+                slot_list.append(current)
+            elif current_piece.side == defenses_side:
+                defenses_list.append(current)
             else:
                 return
 
         if len(defenses_list) == 1:
-            self.forced_movements_per_piece |= {defenses_list.pop(): slot_list}
+            # The pinned piece can still capture the pinning one
+            self.forced_movements_per_piece |= {defenses_list.pop(): slot_list + [start]}
         elif len(defenses_list) == 0:
-            self.game_state.raise_flag(GameStateFlag.CHECK)
+            self.game_state.raise_flags(FLAG_CHECK)
+            self.checkers.append(start)
+            self.threatening_slot = start
             self.threatening_line_slots = slot_list
-            self.forbidden_king_move_slots.append(current + step)
+            self.forbidden_king_move_slots.extend(RAY_TARGETS[direction][end.flat()][:1])
+
+    def captures_threatening_pawn_en_passant(self, piece: Piece, start: Slot, end: Slot) -> bool:
+        return (piece.type_value == PAWN and end == self.game_state.en_passant_target
+                and Slot(end.x, start.y) == self.threatening_slot)
 
     def filter(self, moves: MovesIterator) -> MovesIterator:
-        for move in moves:
-            if self.game_state.check_flag(GameStateFlag.DOUBLE_CHECK):
-                # If double check only king can move
-                if move.piece.type is PieceType.KING:
-                    yield move
-            elif self.game_state.check_flag(GameStateFlag.CHECK):
-                if move.piece.type is PieceType.KING:
-                    # If check, king cannot move within the line or behind
-                    if (move.end not in self.forbidden_king_move_slots
-                            and move.end not in self.threatening_line_slots):
-                        yield move
-                else:
-                    # If check, other pieces can only move within the line
-                    if move.end in self.threatening_line_slots or move.end == self.threatening_slot:
-                        yield move
-            else:
-                restriction = self.forced_movements_per_piece.get(move.start)
-                if restriction is None or move.end in restriction:
-                    yield move
+        return (move for move in moves if self.allows(move.piece, move.start, move.end))
+
+    def allows(self, piece: Piece, start: Slot, end: Slot) -> bool:
+        flags = self.game_state.flags
+        if flags & FLAG_DOUBLE_CHECK:
+            # If double check only king can move
+            return piece.type_value == KING
+        restriction = self.forced_movements_per_piece.get(start)
+        if restriction is not None and end not in restriction:
+            # A pinned piece cannot leave its line even to stop a check
+            return False
+        if not flags & FLAG_CHECK:
+            return True
+        if piece.type_value == KING:
+            # If check, king cannot move within the line or behind
+            return end not in self.forbidden_king_move_slots and end not in self.threatening_line_slots
+        # If check, other pieces can only move within the line
+        return (end in self.threatening_line_slots or end == self.threatening_slot
+                or self.captures_threatening_pawn_en_passant(piece, start, end))
+
+
+class MoveList(list[Move]):
+    """ Collects what the compiled generators find """
+
+    def add(self, piece: Piece, start: Slot, end: Slot, side_effect: Optional[SideEffectType] = None):
+        move = Move(piece, start, end)
+        self.append(move.add_side_effect(side_effect) if side_effect is not None else move)
+
+
+class MoveCounter:
+    """ Counts what the compiled generators find, a promotion once per piece """
+    count: int
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, piece: Piece, _: Slot, end: Slot, side_effect: Optional[SideEffectType] = None):
+        self.count += len(PROMOTION_PIECETYPES) if side_effect is promote_pawn and end.y in (0, 7) else 1
+
+
+MoveSink = MoveList | MoveCounter
 
 
 class MoveGenerator:
     game_state: GameState
+    backend: GeneratorBackend
 
+    # squares the king cannot step on
     threats: list[Slot]
-    mode: GeneratorMode
-    threatening_pieces: ColorPieceSet
     moving_pieces: ColorPieceSet
 
     restrictor: MoveRestrictor
     moving_king_position: Slot
 
-    def __init__(self, game_state: GameState):
+    bitboards: Bitboards
+    attacks: list[int]
+    checkers: int
+    safety: KingSafety
+    incremental: IncrementalAttacks
+    # answer every bitboard query again from bitboards built from scratch and compare
+    verify: bool
+    # the game state moved on without clear and generate_threats, see refresh
+    stale: bool
+
+    def __init__(self, game_state: GameState, backend: GeneratorBackend = GeneratorBackend.OBJECTS,
+                 verify: bool = False):
         self.game_state = game_state
+        self.backend = backend
+        self.verify = verify
+        self.incremental = IncrementalAttacks()
+        self.stale = True
+
+    def uses_bitboards(self) -> bool:
+        return self.backend is not GeneratorBackend.OBJECTS
 
     def clear(self):
-        self.threatening_pieces, self.moving_pieces = self.game_state.get_pieces(True)
         self.threats = []
         self.moving_king_position = self.game_state.find_king()
+        if self.backend is GeneratorBackend.INCREMENTAL:
+            self.attacks = self.incremental.update(self.game_state.board, self.game_state.take_changed_squares())
+            self.bitboards = self.incremental.bitboards
+            self.checkers = 0
+            return
+        if self.backend is GeneratorBackend.BITBOARD:
+            self.bitboards = Bitboards.from_board(self.game_state.board)
+            self.attacks = bitboard.attack_table(self.bitboards)
+            self.checkers = 0
+            return
+        _, self.moving_pieces = self.game_state.get_pieces(True)
         self.restrictor = MoveRestrictor(self.game_state)
 
+    def side(self) -> int:
+        return self.game_state.side
+
+    def pawn_twostep_movement(self, start: Slot, piece: Piece) -> MovesIterator:
+        v = None
+        if start.y == 1 and piece == WHITE_PAWN:
+            v = 0, 2
+        if start.y == 6 and piece == BLACK_PAWN:
+            v = 0, -2
+        # the pawn cannot jump over the square in front of it
+        if v is not None and self.game_state.get_piece(start + TOP_DIRECTION * piece.direction()) is None:
+            yield Move(piece, start, start + v)
+
     def pawn_en_passant_attack(self, start: Slot, piece: Piece):
         en_passant_target = self.game_state.en_passant_target
         for move in pawn_attack(start, piece):
-            if en_passant_target == move.end:
+            if en_passant_target == move.end and not self.en_passant_uncovers_king(piece, start, move.end):
                 yield move
                 return
 
+    def en_passant_uncovers_king(self, pawn: Piece, start: Slot, end: Slot) -> bool:
+        # Both pawns leave the row at once, which the restrictor cannot see
+        king = self.moving_king_position
+        if king.y != start.y:
+            return False
+        captured = Slot(end.x, start.y)
+        step = RIGHT_DIRECTION if start.x > king.x else LEFT_DIRECTION
+        for current in RAY_TARGETS[direction_index(step)][king.flat()]:
+            piece = self.game_state.get_piece(current)
+            if piece is not None and current != start and current != captured:
+                return piece.side != pawn.side and piece.type_value in (ROOK, QUEEN)
+        return False
+
     def get_move_flag(self, move: Move) -> TargetSquareFlag:
         start, target_slot, *_ = move
         moving_piece = self.game_state.get_piece(start)
         target_square = self.game_state.get_piece(target_slot)
 
-        def is_target_safe(sl: Slot) -> bool:
-            if self.mode is GeneratorMode.MOVEMENTS:
-                return sl not in self.threats
-            return True
-
         content_state: TargetSquareFlag
         attacked_state: TargetSquareFlag
 
-        if is_target_safe(target_slot):
+        if target_slot not in self.threats:
             attacked_state = TargetSquareFlag.ISOLATED
         else:
             attacked_state = TargetSquareFlag.GUARDED
 
         if target_square is None:
             content_state = TargetSquareFlag.EMPTY
-        elif target_square.color == moving_piece.color:
+        elif target_square.side == moving_piece.side:
             content_state = TargetSquareFlag.ALLY
         else:
             content_state = TargetSquareFlag.ENEMY
@@ -262,25 +404,14 @@ class MoveGenerator:
         return attacked_state | content_state
 
     def repeteable_moving_pieces(self, start: Slot, piece: Piece) -> MovesIterator:
-        for direction in repeteable_moves_per_piecetype[piece.type]:
-            current = copy.copy(start)
-            discovering_more_threatening_lines = False
-            while True:
-                current += direction
-                if not is_inbound(*current):
-                    break
-                step_result = self.get_move_flag(Move(piece, start, current))
+        for direction in repeteable_moves_per_piecetype[piece.type_value]:
+            for current in RAY_TARGETS[direction][start.flat()]:
+                move = Move(piece, start, current)
+                step_result = self.get_move_flag(move)
                 if TargetSquareFlag.ALLY in step_result:
                     break
-                if not discovering_more_threatening_lines:
-                    yield Move(piece, start, current)
+                yield move
                 if TargetSquareFlag.EMPTY not in step_result:
-                    if self.mode is GeneratorMode.THREATS:
-                        if self.game_state.get_piece(current).type == PieceType.KING:
-                            self.restrictor.add_threatening_line(start, direction, current)
-                            break
-                        discovering_more_threatening_lines = True
-                        continue
                     break
 
     def filter_moves(self, move_iterator: MovesIterator, checker_function: Callable) -> MovesIterator:
@@ -290,18 +421,24 @@ class MoveGenerator:
                 yield move
 
     def king_castle_movements(self, _: Slot, piece: Piece) -> MovesIterator:
+        if self.game_state.check_flag(GameStateFlag.CHECK):
+            return
         for king_start, rook_start, direction in self.game_state.castle_available_info():
-            # check if king's and rook's path is free
-            current = copy.copy(king_start)
+            # check if king's and rook's path is free, and king's path is not threatened
+            current = king_start
+            steps = 0
             while True:
                 current += direction
-                if current in self.threats:
+                steps += 1
+                if steps <= 2 and self.restrictor.is_attacked(current):
                     break
                 current_square = self.game_state.get_piece(current)
-                if current != rook_start and current_square is not None:
-                    break
                 if current == rook_start:
-                    yield Move(piece, king_start, king_start + direction * 2)
+                    if current_square is not None and current_square.type_value == ROOK \
+                            and current_square.side == piece.side:
+                        yield Move(piece, king_start, king_start + direction * 2)
+                    break
+                if current_square is not None:
                     break
 
     def generate_piece(self, start: Slot, piece: Piece,
@@ -320,8 +457,7 @@ class MoveGenerator:
             move_iterator = generator_method(start, piece)
 
         # restrict moves
-        if self.mode is GeneratorMode.MOVEMENTS:
-            move_iterator = self.restrictor.filter(move_iterator)
+        move_iterator = self.restrictor.filter(move_iterator)
 
         # filter those that break condition
         move_iterator = self.filter_moves(move_iterator, condition)
@@ -339,17 +475,110 @@ class MoveGenerator:
             yield from self.generate_piece(start, piece, *movement_type)
 
     @flatten_until(Move)
-    def generate(self, mode: GeneratorMode, pieces: ColorPieceSet) -> list[Move]:
-        self.mode = mode
+    def generate_from_descriptors(self, pieces: ColorPieceSet) -> list[Move]:
+        """ Walks MovementMapper, the specification the compiled generators below follow """
         return list(chain.from_iterable((self.generate_type(*p) for p in pieces)))
 
+    def generate(self, pieces: ColorPieceSet, noisy: Optional[bool] = None) -> list[Move]:
+        """ noisy keeps only captures and promotions if True, only the other moves if False """
+        moves = MoveList()
+        for start, piece in pieces:
+            PIECE_GENERATORS[piece.type_value](self, moves, start, piece, noisy)
+        return moves
+
+    # --------------
+    # COMPILED GENERATORS
+    # --------------
+
+    def add_if_allowed(self, moves: MoveSink, piece: Piece, start: Slot, end: Slot,
+                       side_effect: Optional[SideEffectType] = None):
+        if self.restrictor.allows(piece, start, end):
+            moves.add(piece, start, end, side_effect)
+
+    def pawn_moves(self, moves: MoveSink, start: Slot, piece: Piece, noisy: Optional[bool] = None):
+        state = self.game_state
+        if state.flags & FLAG_DOUBLE_CHECK:
+            return
+        one_step = start + TOP_DIRECTION * piece.direction()
+        promotes = one_step.y in (0, 7)
+        if state.get_piece(one_step) is None:
+            if noisy is None or noisy is promotes:
+                self.add_if_allowed(moves, piece, start, one_step, promote_pawn)
+            two_steps = one_step + TOP_DIRECTION * piece.direction()
+            if noisy is not True and start.y == (6 if piece.side else 1) and state.get_piece(two_steps) is None:
+                self.add_if_allowed(moves, piece, start, two_steps, set_en_passant_target)
+        if noisy is False:
+            return
+        attacks = PAWN_ATTACK_TARGETS[piece.side][start.flat()]
+        for end in attacks:
+            target = state.get_piece(end)
+            if target is not None and target.side != piece.side:
+                self.add_if_allowed(moves, piece, start, end, promote_pawn)
+        if state.flags & FLAG_EN_PASSANT and state.en_passant_target in attacks:
+            end = state.en_passant_target
+            if not self.en_passant_uncovers_king(piece, start, end):
+                self.add_if_allowed(moves, piece, start, end, remove_en_passant_target_pawn)
+
+    def knight_moves(self, moves: MoveSink, start: Slot, piece: Piece, noisy: Optional[bool] = None):
+        state = self.game_state
+        if state.flags & FLAG_DOUBLE_CHECK:
+            return
+        for end in KNIGHT_TARGETS[start.flat()]:
+            if self.wanted_target(piece, end, noisy):
+                self.add_if_allowed(moves, piece, start, end)
+
+    def slider_moves(self, moves: MoveSink, start: Slot, piece: Piece, noisy: Optional[bool] = None):
+        state = self.game_state
+        if state.flags & FLAG_DOUBLE_CHECK:
+            return
+        side_effect = forbid_castle_rook if piece.type_value == ROOK else None
+        for direction in repeteable_moves_per_piecetype[piece.type_value]:
+            for end in RAY_TARGETS[direction][start.flat()]:
+                if self.wanted_target(piece, end, noisy):
+                    self.add_if_allowed(moves, piece, start, end, side_effect)
+                if state.get_piece(end) is not None:
+                    break
+
+    def king_moves(self, moves: MoveSink, start: Slot, piece: Piece, noisy: Optional[bool] = None):
+        state = self.game_state
+        for end in KING_TARGETS[start.flat()]:
+            if self.wanted_target(piece, end, noisy) and end not in self.threats:
+                self.add_if_allowed(moves, piece, start, end, forbid_castle_king)
+        if noisy is not True and not state.flags & FLAG_DOUBLE_CHECK:
+            for move in self.king_castle_movements(start, piece):
+                self.add_if_allowed(moves, piece, start, move.end, castle)
+
+    def wanted_target(self, piece: Piece, end: Slot, noisy: Optional[bool]) -> bool:
+        target = self.game_state.get_piece(end)
+        if target is None:
+            return noisy is not True
+        return target.side != piece.side and noisy is not False
+
+    # --------------
+    # COMPILED GENERATORS
+    # --------------
+
     def generate_threats(self):
-        move_threats = self.generate(GeneratorMode.THREATS, self.threatening_pieces)
-        self.threats = [move.end for move in move_threats]
+        self.stale = False
+        if self.uses_bitboards():
+            side = self.side()
+            self.checkers, danger = bitboard.king_safety(self.bitboards, self.attacks, side)
+            if self.backend is GeneratorBackend.INCREMENTAL:
+                pins = self.incremental.pins(side)
+            else:
+                pins = self.bitboards.pins(side, self.bitboards.king_square(side))
+            self.safety = self.checkers, danger, pins
+            self.threats = [Slot.fromflat(square) for square in bitboard.squares(danger)]
+            return
+        king = self.moving_king_position
+        self.restrictor.scan_king(king)
+        self.threats = [end for end in KING_TARGETS[king.flat()] if self.restrictor.is_attacked(end)]
 
     def get_flag_from_threats(self) -> Optional[GameStateFlag]:
-        check_counter = Counter(self.threats)
-        times_checked = check_counter.get(self.moving_king_position)
+        if self.uses_bitboards():
+            times_checked = bitboard.popcount(self.checkers) or None
+        else:
+            times_checked = len(self.restrictor.checkers) or None
         if times_checked is None:
             return None
         elif times_checked == 1:
@@ -357,24 +586,157 @@ class MoveGenerator:
         else:
             return GameStateFlag.DOUBLE_CHECK
 
+    def refresh(self):
+        """ Prepare the current position if the game state moved on without it, as on a cache hit """
+        if self.stale:
+            self.clear()
+            self.generate_threats()
+
     def generate_movements(self) -> Moves:
-        return Moves(self.generate(GeneratorMode.MOVEMENTS, self.moving_pieces))
+        self.refresh()
+        if self.uses_bitboards():
+            return self.generate_bitboard_movements()
+        return Moves(self.generate(self.moving_pieces))
+
+    def generate_bitboard_movements(self) -> Moves:
+        generated = self.bitboard_packed(bitboard.ANY_PROMOTION)
+        board = self.game_state.board
+        return Moves(unpack_move(board, packed) for packed in generated)
+
+    def generate_packed(self) -> list[PackedMove]:
+        """
+            Legal moves of the position prepared by clear and generate_threats
+            as packed ints, one per promotion piece
+        """
+        self.refresh()
+        if not self.uses_bitboards():
+            state = self.game_state
+            return [state.encode_move(move, promotion) for move in self.generate_movements()
+                    for promotion in promotions_of(move)]
+        return self.bitboard_packed(bitboard.ALL_PROMOTIONS)
+
+    def bitboard_position(self) -> tuple[Bitboards, list[int], int, int, Optional[int]]:
+        state = self.game_state
+        en_passant = state.en_passant_target.flat() if state.flags & FLAG_EN_PASSANT else None
+        return self.bitboards, self.attacks, self.side(), state.castling_rights(), en_passant
+
+    def verified(self, result: T, query: Callable[..., T]) -> T:
+        """
+            result of query on the prepared position, checked against query
+            on bitboards and attacks built from scratch when verify is set
+        """
+        if not self.verify:
+            return result
+        state = self.game_state
+        fresh = Bitboards.from_board(state.board)
+        attacks = bitboard.attack_table(fresh)
+        if fresh.pieces != self.bitboards.pieces or attacks != self.attacks:
+            raise InvalidStateError(f'stale bitboards {state.to_fen()}')
+        _, _, side, castling, en_passant = self.bitboard_position()
+        expected = query(fresh, attacks, side, castling, en_passant)
+        if (sorted(result) if isinstance(result, list) else result) != \
+                (sorted(expected) if isinstance(expected, list) else expected):
+            raise InvalidStateError(f'{query.__name__} {state.to_fen()}')
+        return result
+
+    def bitboard_packed(self, promotions: tuple[int, ...], noisy: Optional[bool] = None) -> list[PackedMove]:
+        packed = bitboard.legal_moves(*self.bitboard_position(), promotions, self.safety, noisy)
+        return self.verified(packed, lambda *position: bitboard.legal_moves(*position, promotions, None, noisy))
+
+    def count_legal(self) -> int:
+        """ Number of legal moves of the prepared position, a promotion once per piece """
+        self.refresh()
+        if self.uses_bitboards():
+            return self.verified(bitboard.count_legal(*self.bitboard_position(), self.safety), bitboard.count_legal)
+        counter = MoveCounter()
+        for start, piece in self.moving_pieces:
+            PIECE_GENERATORS[piece.type_value](self, counter, start, piece)
+        return counter.count
+
+    def has_legal_move(self) -> bool:
+        """ Stops at the first piece that can move """
+        self.refresh()
+        if self.uses_bitboards():
+            return self.verified(bitboard.has_legal_move(*self.bitboard_position(), self.safety),
+                                 bitboard.has_legal_move)
+        counter = MoveCounter()
+        for start, piece in self.moving_pieces:
+            PIECE_GENERATORS[piece.type_value](self, counter, start, piece)
+            if counter.count:
+                return True
+        return False
+
+    def generate_stages(self) -> Iterator[tuple[MoveStage, list[Move]]]:
+        """
+            Legal moves of the position prepared by clear and generate_threats,
+            in stages: captures and promotions, then checks, then the rest.
+            Quiet moves and the check test only run once the caller asks for
+            the next stage
+        """
+        self.refresh()
+        if self.uses_bitboards():
+            board = self.game_state.board
+            noisy = self.bitboard_packed(bitboard.ANY_PROMOTION, True)
+            yield MoveStage.NOISY, [unpack_move(board, packed) for packed in noisy]
+            quiet = self.bitboard_packed(bitboard.ANY_PROMOTION, False)
+            quiet_moves = [unpack_move(board, packed) for packed in quiet]
+            checks = self.bitboard_checks(quiet, quiet_moves)
+        else:
+            yield MoveStage.NOISY, self.generate(self.moving_pieces, noisy=True)
+            quiet_moves = self.generate(self.moving_pieces, noisy=False)
+            checks = [self.gives_check(move) for move in quiet_moves]
+        yield MoveStage.CHECKS, list(compress(quiet_moves, checks))
+        yield MoveStage.QUIETS, [move for move, check in zip(quiet_moves, checks) if not check]
+
+    def generate_staged(self) -> MovesIterator:
+        """ Moves of generate_stages one after the other """
+        for _, moves in self.generate_stages():
+            yield from moves
+
+    def bitboard_checks(self, quiet: list[PackedMove], quiet_moves: list[Move]) -> list[bool]:
+        """
+            Whether each quiet packed move checks, from the squares checking
+            the enemy king and the pieces uncovering a check when they leave
+            their line. Castles, where the rook checks, are played on the board
+        """
+        side = self.side()
+        targets = bitboard.check_targets(self.bitboards, side)
+        discoverers = self.bitboards.discoverers(side)
+        checks = []
+        for packed, move in zip(quiet, quiet_moves):
+            start, end = packed & 63, packed >> 6 & 63
+            if packed >> 14 == CASTLE_MOVE:
+                check = self.gives_check(move)
+            else:
+                line = discoverers.get(start)
+                check = bool(targets[move.piece.type_value] >> end & 1) or line is not None and not line >> end & 1
+            checks.append(check)
+        if self.verify and checks != [self.gives_check(move) for move in quiet_moves]:
+            raise InvalidStateError(f'bitboard_checks {self.game_state.to_fen()}')
+        return checks
+
+    def gives_check(self, move: Move) -> bool:
+        state = self.game_state
+        state.make_move(move)
+        try:
+            return MoveRestrictor(state).is_attacked(state.find_king())
+        finally:
+            state.unmake_move()
 
 
 # <editor-fold desc="Description">
 PAWN_REGULAR_MOVEMENT = (
-    lambda mg: not_double_check(mg) and mg.mode is GeneratorMode.MOVEMENTS, pawn_regular_movement, promote_pawn,
+    not_double_check, pawn_regular_movement, promote_pawn,
     lambda mg, flag: TargetSquareFlag.EMPTY in flag)
 PAWN_TWOSTEPS_MOVEMENT = (
-    lambda mg: not_double_check(mg) and mg.mode is GeneratorMode.MOVEMENTS, pawn_twostep_movement,
-    lambda gm, m: gm.game_state.set_en_passant(m.start + TOP_DIRECTION * m.piece.direction()),
+    not_double_check, MoveGenerator.pawn_twostep_movement,
+    set_en_passant_target,
     lambda mg, flag: TargetSquareFlag.EMPTY in flag)
 PAWN_ATTACK_MOVEMENT = (
     not_double_check, pawn_attack, promote_pawn,
-    lambda mg, flag: GeneratorMode.THREATS is mg.mode or TargetSquareFlag.ENEMY in flag)
+    lambda mg, flag: TargetSquareFlag.ENEMY in flag)
 PAWN_EN_PASSANT_ATTACK_MOVEMENT = (
-    lambda mg: (not_double_check(mg) and mg.mode is GeneratorMode.MOVEMENTS
-                and mg.game_state.check_flag(GameStateFlag.EN_PASSANT)),
+    lambda mg: not_double_check(mg) and mg.game_state.check_flag(GameStateFlag.EN_PASSANT),
     MoveGenerator.pawn_en_passant_attack, remove_en_passant_target_pawn, true)
 KNIGHT_MOVEMENT = (not_double_check, knight_movement, nop, pipe)
 BISHOP_MOVEMENT = (not_double_check, MoveGenerator.repeteable_moving_pieces, nop, pipe)
@@ -384,9 +746,8 @@ KING_REGULAR_MOVEMENT = (
     true, regular_king_movements, forbid_castle_king,
     lambda mg, flag: TargetSquareFlag.ISOLATED in flag)
 KING_CASTLE_MOVEMENT = (
-    lambda mg: mg.mode is not GeneratorMode.THREATS and not_double_check(mg), MoveGenerator.king_castle_movements,
-    lambda gm, m: forbid_castle_king(gm, m) or move_rook_in_castle(gm, m),
-    pipe)
+    not_double_check, MoveGenerator.king_castle_movements,
+    castle, pipe)
 
 PrefilterType = Callable[[MoveGenerator], bool]
 GeneratorMethodType = Callable[[Slot, Piece], MovesIterator]
@@ -413,13 +774,47 @@ MovementMapper = (
 # </editor-fold>
 
 def movement_descriptor(piece: Piece) -> MovementDescriptorsType:
-    return MovementMapper[piece.type.value]
+    return MovementMapper[piece.type_value]
+
+
+# One direct generator per PieceType, following MovementMapper
+PIECE_GENERATORS: tuple[Callable[[MoveGenerator, MoveSink, Slot, Piece, Optional[bool]], None], ...] = (
+    MoveGenerator.pawn_moves, MoveGenerator.knight_moves, MoveGenerator.slider_moves,
+    MoveGenerator.slider_moves, MoveGenerator.slider_moves, MoveGenerator.king_moves
+)
+
+# Side effects of the bitboard backend moves, taken from the descriptors above
+SIDE_EFFECT_PER_PIECETYPE = tuple(descriptors[0][2] for descriptors in MovementMapper)
+SIDE_EFFECT_PER_KIND = {
+    DOUBLE_PUSH_MOVE: PAWN_TWOSTEPS_MOVEMENT[2],
+    EN_PASSANT_MOVE: PAWN_EN_PASSANT_ATTACK_MOVEMENT[2],
+    CASTLE_MOVE: KING_CASTLE_MOVEMENT[2]
+}
+
+
+def unpack_move(board: Board, packed: PackedMove) -> Move:
+    """ Move object of a packed move, the promotion piece is not kept """
+    start, end, kind = packed & 63, packed >> 6 & 63, packed >> 14
+    piece = board[start]
+    move = Move(piece, Slot.fromflat(start), Slot.fromflat(end))
+    if kind == NORMAL_MOVE:
+        side_effect = SIDE_EFFECT_PER_PIECETYPE[piece.type_value]
+    else:
+        side_effect = SIDE_EFFECT_PER_KIND[kind]
+    return move.add_side_effect(side_effect) if side_effect != nop else move
+
+
+def promotions_of(move: Move) -> tuple[Optional[PieceType], ...]:
+    """ Promotion choices of a move, best piece first """
+    if move.piece.type_value == PAWN and move.end.y in (0, 7):
+        return tuple(reversed(PROMOTION_PIECETYPES))
+    return None,
 
 
 """
 Chosen
 
-1 - Generate threats from current position
+1 - Scan outward from the king for checks, pins and attacked king squares
 2 - Evaluate threatening lines
 3 - Generate possible movement of current position
 
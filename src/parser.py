@@ -1,7 +1,42 @@
+"""
+PGN reader
+
+Streams the games of a PGN file of any size: the file is read in large
+binary chunks, split at game boundaries, and only the unfinished game at
+the end of a chunk is carried over, so memory stays bounded by the chunk
+size plus the longest game.
+"""
+from __future__ import annotations
+
+import argparse
+import os
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from time import perf_counter
+from typing import BinaryIO, Callable, Iterator, Optional, TypeVar
+
+from game import GameManager
+from model import Color, Move, PieceType, Slot
+from move_generator import GeneratorBackend
+from perft import PerftGame
+from util import get_games_db_filename, from_san_to_int
+
+# bytes read at once
+CHUNK_SIZE = 1 << 22
 
-from model import Color
-from util import get_games_db_filename
+# line breaks before a tag line, a new game starts there unless the line before is a tag too
+TAG_LINE_START = re.compile(rb'\n(?:[ \t\r]*\n)*(?=\[)')
+LINE_END = b' \t\r'
+# the tag lines at the start of a game
+HEADER = re.compile(r'(?:[ \t]*\[[^\n]*(?:\n|$))*')
+TAG = re.compile(r'^[ \t]*\[(\w+)[ \t]+"((?:[^"\\]|\\.)*)"[ \t]*\][ \t\r]*$', re.M)
+ESCAPE = re.compile(r'\\(.)')
+
+Tags = dict[str, str]
+# start and end byte of a part of a file, holding whole games
+ByteRange = tuple[int, int]
+T = TypeVar('T')
 
 
 class PNGConstant:
@@ -36,28 +71,337 @@ class MoveTester:
     fullmove_cursor: int
 
 
-def read_str_game():
-    with open(get_games_db_filename(), 'r', encoding='utf-8') as games_db:
-        tag_matcher = re.compile(r'^\[', re.A)
-        game_end_matcher = re.compile(PNGRegexp.GAME_RESULT, re.A)
-        game_string = ''
-        while True:
-            line = games_db.readline()
-            if not tag_matcher.search(line):
-                game_string += line
-                if game_end_matcher.search(line):
-                    break
-        return game_string
+class PgnGame:
+    tags: Tags
+    # moves, comments and result, as in the file
+    movetext: str
+    # where the game starts in the file
+    offset: int
+
+    def __init__(self, tags: Tags, movetext: str, offset: int):
+        self.tags = tags
+        self.movetext = movetext
+        self.offset = offset
+
+    def __str__(self):
+        return f'PgnGame(tags={self.tags}, movetext={self.movetext!r}, offset={self.offset})'
+
+    __repr__ = __str__
+
+    @classmethod
+    def parse(cls, text: str, offset: int = 0) -> PgnGame:
+        """ Game of its text without leading blanks, lines of the tag section that are no tags are dropped """
+        end = HEADER.match(text).end()
+        tags = {name: ESCAPE.sub(r'\1', value) if '\\' in value else value
+                for name, value in TAG.findall(text, 0, end)}
+        return cls(tags, text[end:].strip(), offset)
+
+
+class ReadStats:
+    bytes_read: int
+    games: int
+    seconds: float
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.games = 0
+        self.seconds = 0
+
+    def __str__(self):
+        return (f'{self.games} games  {self.bytes_read / 1e6:.1f} MB in {self.seconds:.2f}s  '
+                f'{self.games_per_second():.0f} games/s  {self.bytes_per_second() / 1e6:.1f} MB/s')
+
+    __repr__ = __str__
+
+    def add(self, other: ReadStats):
+        self.bytes_read += other.bytes_read
+        self.games += other.games
+        self.seconds += other.seconds
+
+    def games_per_second(self) -> float:
+        return self.games / self.seconds if self.seconds else 0
 
+    def bytes_per_second(self) -> float:
+        return self.bytes_read / self.seconds if self.seconds else 0
 
-def read_game():
-    string = read_str_game()
+
+def _boundaries(buffer: bytes) -> Iterator[tuple[int, int]]:
+    """ Where each game in buffer ends and the next one starts """
+    for match in TAG_LINE_START.finditer(buffer):
+        start, end = match.span()
+        if end - start == 1:
+            # no blank line, the game goes on if the line before is a tag
+            last = start - 1
+            while last >= 0 and buffer[last] in LINE_END:
+                last -= 1
+            if last < 0 or buffer[last] == 93:  # ']'
+                continue
+        yield start, end
+
+
+def _game_texts(file: BinaryIO, chunk_size: int, stats: ReadStats, start: int,
+                end: Optional[int]) -> Iterator[tuple[bytes, int]]:
+    """ Raw bytes of every game with its offset, the unfinished one carried to the next chunk """
+    rest, offset = b'', start
+    remaining = None if end is None else end - start
+    while True:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        chunk = file.read(size) if size > 0 else b''
+        if remaining is not None:
+            remaining -= len(chunk)
+        stats.bytes_read += len(chunk)
+        if not chunk:
+            if rest.strip():
+                yield rest, offset
+            return
+        buffer, begin = rest + chunk, 0
+        for game_end, game_start in _boundaries(buffer):
+            yield buffer[begin:game_end], offset + begin
+            begin = game_start
+        rest, offset = buffer[begin:], offset + begin
+
+
+def read_games(file: BinaryIO | str, chunk_size: int = CHUNK_SIZE, stats: Optional[ReadStats] = None,
+               start: int = 0, end: Optional[int] = None) -> Iterator[PgnGame]:
+    """
+        Games of a PGN file or binary stream one at a time, stats updated as
+        they are read. Only the bytes from start to end are read, which must
+        hold whole games as the ranges of split_ranges do
+    """
+    if isinstance(file, str):
+        with open(file, 'rb', buffering=0) as opened:
+            yield from read_games(opened, chunk_size, stats, start, end)
+        return
+    if stats is None:
+        stats = ReadStats()
+    if start:
+        file.seek(start)
+    began = perf_counter()
+    for raw, offset in _game_texts(file, chunk_size, stats, start, end):
+        text = raw.decode('utf-8-sig', errors='replace').lstrip()
+        if text:
+            stats.games += 1
+            stats.seconds = perf_counter() - began
+            yield PgnGame.parse(text, offset)
+    stats.seconds = perf_counter() - began
+
+
+def read_str_game(filename: Optional[str] = None) -> str:
+    """ Movetext of the first game of the database """
+    game = next(read_games(filename or get_games_db_filename()), None)
+    return '' if game is None else game.movetext
+
+
+def read_game(filename: Optional[str] = None) -> str:
+    string = read_str_game(filename)
     string = re.sub(PNGRegexp.COMMENT, '', string)
     string = re.sub(PNGRegexp.BLACK_MOVE_NOTATION, '', string)
 
     return string
 
 
+# --------------
+# REPLAY
+# --------------
+
+# comments go first, they may hold parentheses
+COMMENT = re.compile(r'\{[^}]*\}|;[^\n]*')
+VARIATION = re.compile(r'\([^()]*\)')
+MOVETEXT_NOISE = re.compile(r'\$\d+|\d+\.+|1-0|0-1|1/2-1/2|\*')
+SAN = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?')
+CASTLES = {'O-O': 2, 'O-O-O': -2, '0-0': 2, '0-0-0': -2}
+SAN_PIECE_TYPES = {None: PieceType.PAWN, PNGConstant.KNIGHT: PieceType.KNIGHT, PNGConstant.BISHOP: PieceType.BISHOP,
+                   PNGConstant.ROOK: PieceType.ROOK, PNGConstant.QUEEN: PieceType.QUEEN,
+                   PNGConstant.KING: PieceType.KING}
+
+
+def san_tokens(movetext: str) -> list[str]:
+    """ Moves of the main line, without comments, variations, move numbers, annotations and result """
+    movetext = COMMENT.sub(' ', movetext)
+    while '(' in movetext:
+        movetext, count = VARIATION.subn('', movetext)
+        if not count:
+            raise ValueError(f'unbalanced variation in {movetext!r}')
+    return MOVETEXT_NOISE.sub(' ', movetext).split()
+
+
+def find_san_move(game: PerftGame, san: str) -> tuple[Move, Optional[PieceType]]:
+    """ Legal move of the current position written as san, with its promotion piece """
+    san = san.rstrip('+#!?')
+    if san in CASTLES:
+        king = game.game_state.find_king()
+        move = game.current_moves.search_move(king, Slot(king.x + CASTLES[san], king.y))
+        if move is None:
+            raise ValueError(f'illegal castle {san}')
+        return move, None
+    match = SAN.fullmatch(san)
+    if match is None:
+        raise ValueError(f'not a move: {san}')
+    piece, file, rank, end, promotion = match.groups()
+    end = Slot.fromflat(from_san_to_int(end))
+    piece_type = SAN_PIECE_TYPES[piece]
+    candidates = [move for move in game.current_moves if move.end == end and move.piece.type is piece_type
+                  and (file is None or move.start.x == ord(file) - ord('a'))
+                  and (rank is None or move.start.y == int(rank) - 1)]
+    if len(candidates) != 1:
+        raise ValueError(f'{len(candidates)} moves match {san}')
+    return candidates[0], None if promotion is None else SAN_PIECE_TYPES[promotion]
+
+
+def replay(game: PgnGame) -> int:
+    """ Plays the main line of game from its start position, returns the plies played """
+    board = PerftGame(game.tags.get('FEN', GameManager.STARTING_POSITION_FEN), GeneratorBackend.BITBOARD)
+    board.start_game()
+    tokens = san_tokens(game.movetext)
+    for san in tokens:
+        board.play(*find_san_move(board, san))
+    return len(tokens)
+
+
+def game_result(game: PgnGame) -> str:
+    return game.tags.get('Result', '*')
+
+
+# --------------
+# REPLAY
+# --------------
+
+
+# --------------
+# PARALLEL
+# --------------
+
+# bytes of the file per work unit
+PART_SIZE = 1 << 26
+# bytes read at first to find the game following a cut
+PROBE_SIZE = 1 << 16
+
+
+def next_game_start(file: BinaryIO, position: int, probe_size: int = PROBE_SIZE) -> int:
+    """
+        Offset of the first game starting after position, the end of the file
+        if none does. Reads probe_size bytes, twice as many each time no game
+        starts in what was read
+    """
+    if position == 0:
+        return 0
+    file.seek(position)
+    buffer = b''
+    while True:
+        chunk = file.read(max(probe_size, len(buffer)))
+        if not chunk:
+            return position + len(buffer)
+        buffer += chunk
+        for _, start in _boundaries(buffer):
+            return position + start
+
+
+def split_ranges(filename: str, part_size: int = PART_SIZE) -> Iterator[ByteRange]:
+    """
+        The file cut into ranges of about part_size bytes, each cut snapped to
+        the start of a game. Ranges come as the cuts are found, so the work on
+        the first ones starts before the end of the file is probed
+    """
+    size = os.path.getsize(filename)
+    start = 0
+    with open(filename, 'rb') as file:
+        for position in range(part_size, size, part_size):
+            if position > start:
+                cut = next_game_start(file, position)
+                if start < cut < size:
+                    yield start, cut
+                    start = cut
+    yield start, size
+
+
+def process_range(filename: str, start: int, end: int, process: Callable[[PgnGame], T],
+                  chunk_size: int) -> tuple[int, list[T], ReadStats]:
+    """ Runs in a worker: process id, result of every game of the range in order, stats """
+    stats = ReadStats()
+    results = [process(game) for game in read_games(filename, chunk_size, stats, start, end)]
+    return os.getpid(), results, stats
+
+
+class IngestStats:
+    total: ReadStats
+    # per worker process id
+    workers: dict[int, ReadStats]
+
+    def __init__(self):
+        self.total = ReadStats()
+        self.workers = {}
+
+    def __str__(self):
+        lines = [f'worker {pid}: {stats}' for pid, stats in sorted(self.workers.items())]
+        lines.append(f'{len(self.workers)} workers  {self.total}')
+        return '\n'.join(lines)
+
+    __repr__ = __str__
+
+    def add(self, pid: int, stats: ReadStats):
+        self.workers.setdefault(pid, ReadStats()).add(stats)
+        self.total.bytes_read += stats.bytes_read
+        self.total.games += stats.games
+
+
+def parallel_games(filename: str, process: Callable[[PgnGame], T], workers: Optional[int] = None,
+                   ordered: bool = True, part_size: int = PART_SIZE, chunk_size: int = CHUNK_SIZE,
+                   stats: Optional[IngestStats] = None) -> Iterator[T]:
+    """
+        process applied to every game of filename by a pool of processes.
+        The file is split into ranges of whole games, a few ranges per worker
+        in flight at a time, and their results come in file order or as
+        ranges complete. process must be picklable, a module level function,
+        and should reduce a game to what the caller needs: its results are
+        what crosses between the processes. Leaving early cancels the ranges
+        not started yet
+    """
+    if stats is None:
+        stats = IngestStats()
+    ranges = split_ranges(filename, part_size)
+    in_flight = 2 * (workers or os.cpu_count() or 1)
+    began = perf_counter()
+    pool = ProcessPoolExecutor(workers)
+
+    def submit() -> Optional[Future]:
+        byte_range = next(ranges, None)
+        if byte_range is None:
+            return None
+        return pool.submit(process_range, filename, *byte_range, process, chunk_size)
+
+    def collect(future: Future) -> list:
+        pid, results, range_stats = future.result()
+        stats.add(pid, range_stats)
+        stats.total.seconds = perf_counter() - began
+        return results
+
+    try:
+        pending = deque(future for future in (submit() for _ in range(in_flight)) if future is not None)
+        if ordered:
+            while pending:
+                future = pending.popleft()
+                following = submit()
+                if following is not None:
+                    pending.append(following)
+                yield from collect(future)
+            return
+        running = set(pending)
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                following = submit()
+                if following is not None:
+                    running.add(following)
+                yield from collect(future)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# --------------
+# PARALLEL
+# --------------
+
+
 NUMBER_GAMES_TO_BE_PARSED = 1
 
 game_regexp = r'^\[[[^\]]\]'
@@ -65,3 +409,35 @@ game_regexp = r'^\[[[^\]]\]'
 
 class GameParser:
     pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read the games of a PGN file, reporting the throughput')
+    parser.add_argument('file', nargs='?', default=get_games_db_filename())
+    parser.add_argument('--limit', type=int, help='stop after this many games')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--every', type=int, default=100000, help='games between progress reports')
+    parser.add_argument('--replay', action='store_true', help='play the moves of every game too')
+    parser.add_argument('--workers', type=int, default=0, help='split the file over a pool of processes')
+    parser.add_argument('--part-size', type=int, default=PART_SIZE, help='bytes of the file per work unit')
+    parser.add_argument('--unordered', action='store_true', help='take the results of the workers as they come')
+    args = parser.parse_args()
+    if args.workers:
+        stats = IngestStats()
+        games = parallel_games(args.file, replay if args.replay else game_result, args.workers, not args.unordered,
+                               args.part_size, args.chunk_size, stats)
+    else:
+        stats = ReadStats()
+        games = read_games(args.file, args.chunk_size, stats)
+        if args.replay:
+            games = map(replay, games)
+    for count, _ in enumerate(games, 1):
+        if count % args.every == 0:
+            print(stats.total if args.workers else stats)
+        if count == args.limit:
+            break
+    print(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+Perft and divide
+
+Count the leaf nodes of the legal move tree up to a given depth and compare them
+with the published numbers of the reference positions. This is the benchmark to
+run after every change to the move generator or the model.
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, Executor
+from contextlib import nullcontext
+from time import perf_counter
+from typing import Iterator, Optional
+
+from fen import dump_fen
+from game import Game
+from model import Move, PieceType, GameState, WHITE_PAWN, BLACK_PAWN, PackedMove, decode_move, PAWN
+from move_generator import GeneratorBackend
+from util import from_int_to_san
+
+PROMOTION_TYPES = (PieceType.QUEEN, PieceType.ROOK, PieceType.BISHOP, PieceType.KNIGHT)
+
+# name, fen, nodes per depth starting at depth 1
+REFERENCE_POSITIONS = (
+    ('start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+     (20, 400, 8902, 197281, 4865609)),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     (48, 2039, 97862, 4085603)),
+    ('en passant', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+     (14, 191, 2812, 43238, 674624)),
+    ('position 4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+     (6, 264, 9467, 422333)),
+    ('position 5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+     (44, 1486, 62379, 2103487)),
+    ('position 6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+     (46, 2079, 89890, 3894594)),
+    ('castling', 'r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1',
+     (26, 568, 13744, 314346, 7594526)),
+    ('promotion', 'n1n5/PPPk4/8/8/8/8/4Kppp/5N1N b - - 0 1',
+     (24, 496, 9483, 182838, 3605103)),
+)
+
+
+def is_promotion(move: Move) -> bool:
+    return (move.piece == WHITE_PAWN and move.end.y == 7) or (move.piece == BLACK_PAWN and move.end.y == 0)
+
+
+def promotions(move: Move) -> tuple[Optional[PieceType], ...]:
+    return PROMOTION_TYPES if is_promotion(move) else (None,)
+
+
+def move_name(move: Move, promotion: Optional[PieceType] = None) -> str:
+    name = from_int_to_san(move.start.flat()) + from_int_to_san(move.end.flat())
+    return name + promotion.get_representation().lower() if promotion is not None else name
+
+
+def packed_name(state: GameState, packed: PackedMove) -> str:
+    """ Same as move_name, for a packed move of the position in state """
+    start, end, promotion, _ = decode_move(packed)
+    name = from_int_to_san(start) + from_int_to_san(end)
+    if state.board[start].type_value == PAWN and (end < 8 or end > 55):
+        return name + promotion.get_representation().lower()
+    return name
+
+
+class PerftGame(Game):
+    """ Walks the tree on a single game state, making and unmaking moves """
+
+    def legal_moves(self) -> list[Move]:
+        return list(self.current_moves)
+
+    def play(self, move: Move, promotion: Optional[PieceType]):
+        self.game_state.make_move(move, promotion)
+        self.prepare_next_turn()
+
+    def undo(self):
+        self.game_state.unmake_move()
+
+    def children(self, remaining: int = 0) -> Iterator[tuple[Move, Optional[PieceType]]]:
+        """
+            Plays every legal move in turn, the move is undone when the next
+            one is requested. remaining is the depth still to search below the
+            children, what their cache entries are stored with
+        """
+        current_moves = self.current_moves
+        for move in self.legal_moves():
+            for promotion in promotions(move):
+                self.cache_depth = remaining
+                self.play(move, promotion)
+                yield move, promotion
+                self.undo()
+                self.current_moves = current_moves
+
+    def packed_moves(self) -> list[PackedMove]:
+        self.prepare_move_generator()
+        return self.move_generator.generate_packed()
+
+    def count_legal(self) -> int:
+        self.prepare_move_generator()
+        return self.move_generator.count_legal()
+
+
+def perft(game: PerftGame, depth: int) -> int:
+    if depth == 0:
+        return 1
+    if depth == 1:
+        return sum(len(promotions(move)) for move in game.legal_moves())
+    return sum(perft(game, depth - 1) for _ in game.children(depth - 1))
+
+
+def perft_packed(game: PerftGame, depth: int) -> int:
+    """ Same count walking packed moves, without building Move objects """
+    if depth <= 1:
+        return game.count_legal() if depth == 1 else 1
+    state, nodes = game.game_state, 0
+    for packed in game.packed_moves():
+        state.make_packed_move(packed)
+        nodes += perft_packed(game, depth - 1)
+        state.unmake_move()
+    return nodes
+
+
+def divide(game: PerftGame, depth: int) -> dict[str, int]:
+    return {move_name(move, promotion): perft(game, depth - 1) for move, promotion in game.children(depth - 1)}
+
+
+# --------------
+# PARALLEL
+# --------------
+
+# root move, position to count from as fen, remaining depth
+WorkUnit = tuple[str, str, int]
+
+
+def work_units(game: PerftGame, depth: int, split: int) -> list[WorkUnit]:
+    """ Every position split plies below the root, tagged with the root move leading to it """
+    units = []
+    state = game.game_state
+    for packed in game.packed_moves():
+        name = packed_name(state, packed)
+        state.make_packed_move(packed)
+        if split > 1:
+            units.extend((name, fen, remaining) for _, fen, remaining in work_units(game, depth - 1, split - 1))
+        else:
+            units.append((name, dump_fen(state), depth - 1))
+        state.unmake_move()
+    return units
+
+
+def count_unit(fen: str, depth: int, backend: GeneratorBackend) -> tuple[int, int, float]:
+    """ Runs in a worker: process id, nodes and seconds spent """
+    start = perf_counter()
+    nodes = perft_packed(PerftGame(fen, backend), depth)
+    return os.getpid(), nodes, perf_counter() - start
+
+
+class WorkerStats:
+    units: int
+    nodes: int
+    seconds: float
+
+    def __init__(self):
+        self.units = 0
+        self.nodes = 0
+        self.seconds = 0
+
+    def __str__(self):
+        return (f'{self.units:>5} units  {self.nodes:>12} nodes  {self.seconds:>9.3f}s  '
+                f'{self.nodes_per_second():>10.0f} nps')
+
+    __repr__ = __str__
+
+    def nodes_per_second(self) -> float:
+        return self.nodes / self.seconds if self.seconds > 0 else 0
+
+
+class ParallelDivide:
+    counts: dict[str, int]
+    # per worker process id
+    workers: dict[int, WorkerStats]
+    seconds: float
+
+    def __init__(self, counts: dict[str, int], workers: dict[int, WorkerStats], seconds: float):
+        self.counts = counts
+        self.workers = workers
+        self.seconds = seconds
+
+    def __str__(self):
+        lines = [f'worker {pid}: {stats}' for pid, stats in sorted(self.workers.items())]
+        nodes = self.nodes()
+        lines.append(f'{len(self.workers)} workers  {nodes} nodes in {self.seconds:.3f}s, '
+                     f'{nodes / self.seconds if self.seconds > 0 else 0:.0f} nps')
+        return '\n'.join(lines)
+
+    def nodes(self) -> int:
+        return sum(self.counts.values())
+
+
+def parallel_divide(fen: str, depth: int, backend: GeneratorBackend = GeneratorBackend.OBJECTS,
+                    workers: Optional[int] = None, split: int = 1, pool: Optional[Executor] = None) -> ParallelDivide:
+    """
+        Divide splitting the tree split plies below the root. Every position
+        there is a work unit, shipped to the pool as fen, counted with the
+        packed perft and added to the count of its root move. A pool of
+        workers processes is started here unless one is given
+    """
+    if depth < 1:
+        raise ValueError(f'divide needs a depth of at least 1, got {depth}')
+    if pool is None:
+        with ProcessPoolExecutor(workers) as pool:
+            return parallel_divide(fen, depth, backend, workers, split, pool)
+    start = perf_counter()
+    game = PerftGame(fen, backend)
+    # a root move with no position split plies below still gets its count
+    counts = {packed_name(game.game_state, packed): 0 for packed in game.packed_moves()}
+    units = work_units(game, depth, max(1, min(split, depth)))
+    stats: dict[int, WorkerStats] = {}
+    futures = [pool.submit(count_unit, unit_fen, remaining, backend) for _, unit_fen, remaining in units]
+    for (name, _, _), future in zip(units, futures):
+        pid, nodes, seconds = future.result()
+        counts[name] += nodes
+        worker = stats.setdefault(pid, WorkerStats())
+        worker.units += 1
+        worker.nodes += nodes
+        worker.seconds += seconds
+    return ParallelDivide(counts, stats, perf_counter() - start)
+
+
+# --------------
+# PARALLEL
+# --------------
+
+
+class PerftResult:
+    name: str
+    depth: int
+    nodes: int
+    expected: Optional[int]
+    seconds: float
+
+    def __init__(self, name: str, depth: int, nodes: int, expected: Optional[int], seconds: float):
+        self.name = name
+        self.depth = depth
+        self.nodes = nodes
+        self.expected = expected
+        self.seconds = seconds
+
+    def __str__(self):
+        status = '' if self.expected is None else ' ok' if self.is_correct() else f' expected {self.expected}'
+        return (f'{self.name:<12} depth {self.depth}  {self.nodes:>10} nodes  {self.seconds:>9.3f}s  '
+                f'{self.nodes_per_second():>10.0f} nps{status}')
+
+    __repr__ = __str__
+
+    def is_correct(self) -> bool:
+        return self.expected is None or self.expected == self.nodes
+
+    def nodes_per_second(self) -> float:
+        return self.nodes / self.seconds if self.seconds > 0 else 0
+
+
+def run_perft(name: str, fen: str, depth: int, expected: Optional[int] = None,
+              backend: GeneratorBackend = GeneratorBackend.OBJECTS, packed: bool = False,
+              workers: int = 0, pool: Optional[Executor] = None) -> PerftResult:
+    start = perf_counter()
+    if workers:
+        nodes = parallel_divide(fen, depth, backend, workers, pool=pool).nodes()
+        return PerftResult(name, depth, nodes, expected, perf_counter() - start)
+    game = PerftGame(fen, backend)
+    game.start_game()
+    nodes = perft_packed(game, depth) if packed else perft(game, depth)
+    return PerftResult(name, depth, nodes, expected, perf_counter() - start)
+
+
+def benchmark(max_depth: int, backend: GeneratorBackend = GeneratorBackend.OBJECTS,
+              packed: bool = False, workers: int = 0) -> list[PerftResult]:
+    """ Every reference position at every depth up to max_depth, sharing a single pool of workers if any """
+    results = []
+    with ProcessPoolExecutor(workers) if workers else nullcontext() as pool:
+        for name, fen, node_counts in REFERENCE_POSITIONS:
+            for depth, expected in enumerate(node_counts[:max_depth], 1):
+                result = run_perft(name, fen, depth, expected, backend, packed, workers, pool)
+                print(result)
+                results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Perft benchmark over the reference positions')
+    parser.add_argument('depth', type=int, nargs='?', default=3)
+    parser.add_argument('--backend', choices=[b.name.lower() for b in GeneratorBackend], default='objects')
+    parser.add_argument('--fen', help='run divide on this position instead of the benchmark')
+    parser.add_argument('--packed', action='store_true', help='walk packed moves instead of Move objects')
+    parser.add_argument('--workers', type=int, default=0, help='split the root over a pool of processes')
+    parser.add_argument('--split', type=int, default=1, help='plies below the root to split the work at')
+    args = parser.parse_args()
+    backend = GeneratorBackend[args.backend.upper()]
+
+    if args.fen is not None and args.workers:
+        result = parallel_divide(args.fen, args.depth, backend, args.workers, args.split)
+        for name, nodes in sorted(result.counts.items()):
+            print(f'{name}: {nodes}')
+        print(result)
+        return
+
+    if args.fen is not None:
+        game = PerftGame(args.fen, backend)
+        game.start_game()
+        start = perf_counter()
+        counts = divide(game, args.depth)
+        for name, nodes in sorted(counts.items()):
+            print(f'{name}: {nodes}')
+        total = sum(counts.values())
+        print(PerftResult('divide', args.depth, total, None, perf_counter() - start))
+        return
+
+    results = benchmark(args.depth, backend, args.packed, args.workers)
+    nodes, seconds = sum(r.nodes for r in results), sum(r.seconds for r in results)
+    print(f'total {nodes} nodes in {seconds:.3f}s, {nodes / seconds:.0f} nps')
+    if not all(r.is_correct() for r in results):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
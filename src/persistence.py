@@ -1 +1,133 @@
+"""
+Binary positions
 
+A position is a fixed 36 byte record: the board as 64 four bit piece codes
+(Piece.code, EMPTY_CODE for an empty square), two squares per byte with the
+lower square in the low nibble, followed by a little endian state word:
+
+    bit 0       side to move, 1 for black
+    bits 1-4    castling rights (model bits)
+    bit 5       en passant target present
+    bits 6-8    en passant file, the rank follows from the side to move
+    bits 9-16   halfmove clock
+    bits 17-31  fullmove number
+
+Records hold the position only, not the history of moves that led to it.
+"""
+from __future__ import annotations
+
+import struct
+from itertools import chain
+from typing import BinaryIO, Iterable, Iterator
+
+from model import GameState, GameStateFlag, Board, Color, BOARD_SLOTS, EMPTY_CODE, PIECE_OF_CODE, WHITE_KINGSIDE, \
+    WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE
+
+RECORD = struct.Struct('<32sI')
+RECORD_SIZE = RECORD.size
+
+MAX_HALFMOVE_CLOCK = (1 << 8) - 1
+MAX_FULLMOVE_NUMBER = (1 << 15) - 1
+
+# SQUARE_PAIRS[byte], the two squares of a board byte, None if the byte holds a code out of range
+SQUARE_PAIRS = tuple((PIECE_OF_CODE[byte & 15], PIECE_OF_CODE[byte >> 4])
+                     if (byte & 15) <= EMPTY_CODE and (byte >> 4) <= EMPTY_CODE else None
+                     for byte in range(256))
+# records read from a file at once
+CHUNK_RECORDS = 4096
+
+
+class CorruptRecordError(ValueError):
+    pass
+
+
+# --------------
+# ENCODING
+# --------------
+
+def _pack_state(state: GameState) -> int:
+    if not 0 <= state.halfmove_clock <= MAX_HALFMOVE_CLOCK or not 0 <= state.fullmove_number <= MAX_FULLMOVE_NUMBER:
+        raise ValueError(f'clocks out of range: {state.halfmove_clock} {state.fullmove_number}')
+    target = state.en_passant_target
+    en_passant = 0 if target is None else 1 | target.x << 1
+    return ((not state.next_to_move) | state.castling_rights() << 1 | en_passant << 5
+            | state.halfmove_clock << 9 | state.fullmove_number << 17)
+
+
+def _pack_board(board: Board) -> bytes:
+    codes = [EMPTY_CODE if piece is None else piece.code for piece in board]
+    return bytes([low | high << 4 for low, high in zip(codes[::2], codes[1::2])])
+
+
+def encode(state: GameState) -> bytes:
+    return RECORD.pack(_pack_board(state.board), _pack_state(state))
+
+
+def encode_into(buffer: bytearray | memoryview, offset: int, state: GameState):
+    """ Writes the record of state at offset of a writable buffer """
+    RECORD.pack_into(buffer, offset, _pack_board(state.board), _pack_state(state))
+
+
+def encode_many(states: Iterable[GameState]) -> bytes:
+    return b''.join(map(encode, states))
+
+
+def dump(states: Iterable[GameState], file: BinaryIO) -> int:
+    """ Writes the records of states to a binary file, returns how many """
+    count = 0
+    for count, state in enumerate(states, 1):
+        file.write(encode(state))
+    return count
+
+
+# --------------
+# ENCODING
+# --------------
+
+
+# --------------
+# DECODING
+# --------------
+
+def decode(buffer: bytes | bytearray | memoryview, offset: int = 0) -> GameState:
+    board_bytes, word = RECORD.unpack_from(buffer, offset)
+    pairs = list(map(SQUARE_PAIRS.__getitem__, board_bytes))
+    if None in pairs:
+        raise CorruptRecordError(f'piece code out of range at {offset}')
+    white_to_move = not word & 1
+    target = None
+    if word >> 5 & 1:
+        target = BOARD_SLOTS[(5 if white_to_move else 2) * 8 + (word >> 6 & 7)]
+    return GameState(Board(chain.from_iterable(pairs)), GameStateFlag.NORMAL,
+                     Color.WHITE if white_to_move else Color.BLACK,
+                     bool(word & WHITE_KINGSIDE << 1), bool(word & WHITE_QUEENSIDE << 1),
+                     bool(word & BLACK_KINGSIDE << 1), bool(word & BLACK_QUEENSIDE << 1),
+                     target, word >> 9 & MAX_HALFMOVE_CLOCK, word >> 17)
+
+
+def decode_many(buffer: bytes | bytearray | memoryview) -> Iterator[GameState]:
+    if len(buffer) % RECORD_SIZE:
+        raise CorruptRecordError(f'{len(buffer)} bytes is not a whole number of records')
+    for offset in range(0, len(buffer), RECORD_SIZE):
+        yield decode(buffer, offset)
+
+
+def load(file: BinaryIO) -> Iterator[GameState]:
+    """ Streams the positions of a binary file written by dump """
+    rest = b''
+    while True:
+        chunk = file.read(RECORD_SIZE * CHUNK_RECORDS)
+        if not chunk:
+            if rest:
+                raise CorruptRecordError(f'{len(rest)} trailing bytes')
+            return
+        # reads may stop short of a whole record
+        chunk = rest + chunk
+        whole = len(chunk) - len(chunk) % RECORD_SIZE
+        yield from decode_many(memoryview(chunk)[:whole])
+        rest = chunk[whole:]
+
+
+# --------------
+# DECODING
+# --------------
@@ -5,7 +5,8 @@ from typing import Optional, Iterator, Iterable
 
 import pygame as pg
 
-from model import Slot, Moves, GameState, Color, Piece, Board, Point, InvalidStateError, PieceType, Move  # type: ignore
+from model import Slot, Moves, GameState, Color, Piece, Board, Point, InvalidStateError, PieceType, Move, \
+    get_piece_constant  # type: ignore
 from util import get_sprite_filename, get_font_filename
 
 pg.init()
@@ -296,7 +297,7 @@ class PromotingMenuSquare(pg.sprite.Sprite):
 
 def create_promoting_menu_data_per_color(color: Color, sprites_data: SpritesData) -> pg.sprite.Group:
     possible_types = (PieceType.QUEEN, PieceType.ROOK, PieceType.BISHOP, PieceType.KNIGHT)
-    possible_pieces = tuple(Piece(color, t) for t in possible_types)
+    possible_pieces = tuple(get_piece_constant(color, t) for t in possible_types)
     promoting_menu_group = pg.sprite.Group()
     for i, p in enumerate(possible_pieces):
         promoting_sprite = PromotingMenuSquare(p, sprites_data[p.representation],
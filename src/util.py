@@ -95,4 +95,4 @@ def from_san_to_int(algebraic_notation: str) -> int:
 
 def from_int_to_san(square: int) -> str:
     row, column = divmod(square, 8)
-    return chr(column + 90) + str(row)
+    return chr(column + 97) + str(row + 1)
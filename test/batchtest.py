@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+import bitboard
+from batch import Positions, attack_maps, check_status, legal_move_counts
+from move_generator import GeneratorBackend
+from perft import REFERENCE_POSITIONS, PerftGame
+from randomgames import random_fens
+from model import WHITE, BLACK
+
+
+class MyTestCase(unittest.TestCase):
+    def test_agrees_with_move_generator(self):
+        fens = random_fens(60) + ['rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3',
+                                  '8/8/8/K2pP2r/8/8/8/7k w - d6 0 1']
+        positions = Positions.from_fens(fens)
+        maps, checks, counts = attack_maps(positions), check_status(positions), legal_move_counts(positions)
+        for i, fen in enumerate(fens):
+            game = PerftGame(fen, GeneratorBackend.BITBOARD)
+            game.start_game()
+            generator = game.move_generator
+            for side in (WHITE, BLACK):
+                expected = 0
+                for square in bitboard.squares(generator.bitboards.occupancy[side]):
+                    expected |= generator.attacks[square]
+                self.assertEqual(expected, sum(1 << int(square) for square in np.flatnonzero(maps[i, side])), fen)
+            self.assertEqual(bitboard.popcount(generator.checkers), checks[i], fen)
+            self.assertEqual(generator.count_legal(), counts[i], fen)
+
+    def test_reference_counts(self):
+        counts = legal_move_counts(Positions.from_fens(fen for _, fen, _ in REFERENCE_POSITIONS))
+        self.assertEqual([node_counts[0] for _, _, node_counts in REFERENCE_POSITIONS], counts.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
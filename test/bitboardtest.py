@@ -0,0 +1,135 @@
+import random
+import unittest
+
+from game import Game, GameManager
+from model import Moves, Slot, InvalidStateError
+from move_generator import GeneratorBackend, MoveStage
+from perft import PerftGame, perft, perft_packed
+
+POSITIONS = (
+    GameManager.STARTING_POSITION_FEN,
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+    'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+    'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+    'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+)
+
+
+def signature(moves: Moves) -> list[tuple[tuple[int, int], tuple[str, ...]]]:
+    return sorted((move.as_values(), tuple(effect.__name__ for effect in move.side_effects))
+                  for start_moves in moves.values() for move in start_moves)
+
+
+class MyTestCase(unittest.TestCase):
+    plies: int = 40
+
+    def start_games(self, fen: str) -> list[Game]:
+        games = [Game(fen, backend) for backend in GeneratorBackend]
+        for game in games:
+            game.move_generator.verify = True
+            game.start_game()
+        return games
+
+    def assert_same_moves(self, games: list[Game]):
+        objects, *others = games
+        fen = objects.game_state.to_fen()
+        for other in others:
+            self.assertEqual(signature(objects.current_moves), signature(other.current_moves), fen)
+            self.assertEqual(objects.game_state.state_flag, other.game_state.state_flag, fen)
+
+    def test_positions(self):
+        for fen in POSITIONS:
+            self.assert_same_moves(self.start_games(fen))
+
+    def test_random_games(self):
+        rng = random.Random(0)
+        for fen in POSITIONS:
+            games = self.start_games(fen)
+            for ply in range(self.plies):
+                self.assert_same_moves(games)
+                if games[0].current_moves.isempty():
+                    break
+                start, end = rng.choice(signature(games[0].current_moves))[0]
+                for game in games:
+                    move = game.current_moves.search_move(Slot.fromflat(start), Slot.fromflat(end))
+                    # promotions pick a random piece
+                    random.seed(ply)
+                    game.end_turn(move)
+
+    def assert_same_stages(self, games: list[Game]):
+        stages = []
+        for game in games:
+            staged = [(stage, signature(Moves(moves))) for stage, moves in game.move_generator.generate_stages()]
+            self.assertEqual(signature(game.current_moves), sorted(m for _, moves in staged for m in moves))
+            stages.append(staged)
+        self.assertTrue(all(staged == stages[0] for staged in stages), games[0].game_state.to_fen())
+
+    def test_staged(self):
+        rng = random.Random(2)
+        for fen in POSITIONS:
+            games = self.start_games(fen)
+            for ply in range(10):
+                self.assert_same_stages(games)
+                if games[0].current_moves.isempty():
+                    break
+                start, end = rng.choice(signature(games[0].current_moves))[0]
+                for game in games:
+                    random.seed(ply)
+                    game.end_turn(game.current_moves.search_move(Slot.fromflat(start), Slot.fromflat(end)))
+        # g2g3 is the only quiet check of the en passant position
+        game = Game(POSITIONS[2])
+        game.start_game()
+        stage, checks = list(game.move_generator.generate_stages())[1]
+        self.assertEqual(MoveStage.CHECKS, stage)
+        self.assertEqual([(14, 22)], [move.as_values() for move in checks])
+
+    def test_compiled_dispatch(self):
+        rng = random.Random(1)
+        for fen in POSITIONS:
+            game = Game(fen)
+            game.start_game()
+            for _ in range(self.plies):
+                generator = game.move_generator
+                expected = Moves(generator.generate_from_descriptors(generator.moving_pieces))
+                self.assertEqual(signature(expected), signature(game.current_moves), game.game_state.to_fen())
+                if game.current_moves.isempty():
+                    break
+                start, end = rng.choice(signature(game.current_moves))[0]
+                game.end_turn(game.current_moves.search_move(Slot.fromflat(start), Slot.fromflat(end)))
+
+    def test_incremental_make_unmake(self):
+        # verify raises as soon as the incremental update drifts from a full generation
+        for fen in POSITIONS:
+            game = PerftGame(fen, GeneratorBackend.INCREMENTAL)
+            game.move_generator.verify = True
+            game.start_game()
+            perft(game, 2)
+            # count_legal, has_legal_move and generate_packed are checked too
+            self.assertEqual(perft(game, 3), perft_packed(game, 3))
+
+    def test_incremental_update(self):
+        game = PerftGame(POSITIONS[0], GeneratorBackend.INCREMENTAL)
+        game.move_generator.verify = True
+        game.start_game()
+        incremental = game.move_generator.incremental
+        self.assertEqual(32, incremental.recomputed)
+        game.play(game.current_moves.search_move(Slot(6, 0), Slot(5, 2)), None)
+        # the knight itself and the h1 rook seeing g1, nothing else
+        self.assertEqual(2, incremental.recomputed)
+        pins = incremental.pins(1)
+        game.play(game.current_moves.search_move(Slot(0, 6), Slot(0, 5)), None)
+        game.undo()
+        game.prepare_next_turn()
+        # the a7 pawn back home and the a8 rook seeing it, the pins away from a6/a7 are kept
+        self.assertEqual(2, incremental.recomputed)
+        self.assertIs(pins, incremental.pins(1))
+        # a drifting attack table is caught by every query
+        incremental.attacks[0] = 0
+        for query in (game.count_legal, game.packed_moves, game.move_generator.has_legal_move):
+            with self.assertRaises(InvalidStateError):
+                query()
+
+
+if __name__ == '__main__':
+    unittest.main()
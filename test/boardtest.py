@@ -1,7 +1,17 @@
+import copy
+import pickle
 import unittest
 
-from game import GameManager
-from model import GameState
+from game import Game, GameManager
+from model import GameState, Moves, PieceType, Slot, Vector, Board, BOARD_SLOTS, CompactBoard, encode_move, \
+    decode_move, EN_PASSANT_MOVE, CASTLE_MOVE, EMPTY_CODE, WHITE_PAWN, BLACK_KING, Color, GameStateFlag, WHITE, BLACK, \
+    PAWN, KING, FLAG_NORMAL, FLAG_CHECK, FLAG_DOUBLE_CHECK, FLAG_EN_PASSANT
+from perft import REFERENCE_POSITIONS, PerftGame, promotions
+from util import from_san_to_int, from_int_to_san
+
+
+def slot(square: str) -> Slot:
+    return Slot.fromflat(from_san_to_int(square))
 
 
 class MyTestCase(unittest.TestCase):
@@ -10,6 +20,274 @@ class MyTestCase(unittest.TestCase):
         b = g.to_fen()
         self.assertEqual(GameManager.STARTING_POSITION_FEN, b)
 
+    def test_compact_board(self):
+        for _, fen, _ in REFERENCE_POSITIONS:
+            board = GameState.from_fen(fen).board
+            compact = board.compact()
+            self.assertEqual(64, len(compact))
+            # pieces come back as the very same constants
+            self.assertTrue(all(a is b for a, b in zip(board, Board.from_compact(bytes(compact)))))
+        compact = GameState.from_fen(GameManager.STARTING_POSITION_FEN).board.compact()
+        compact.move(from_san_to_int('e2'), from_san_to_int('e4'))
+        self.assertIs(WHITE_PAWN, compact.get_piece(from_san_to_int('e4')))
+        self.assertEqual(EMPTY_CODE, compact[from_san_to_int('e2')])
+        compact.set(from_san_to_int('e2'), BLACK_KING)
+        self.assertIs(BLACK_KING, compact.to_board()[from_san_to_int('e2')])
+        self.assertIsInstance(compact.copy(), CompactBoard)
+
+    def test_slot(self):
+        self.assertIs(Slot(3, 4), Slot.fromflat(35))
+        self.assertIs(BOARD_SLOTS[35], Slot(1, 2) + Vector(2, 2))
+        with self.assertRaises(AttributeError):
+            Slot(3, 4).x = 0
+        current = start = Slot(4, 0)
+        current += Vector(1, 0)
+        self.assertEqual((4, 0), tuple(start))
+        self.assertIs(Slot(5, 0), current)
+        self.assertIs(Slot(3, 3), Slot(3, 4).reverse())
+        # off board slots still work, they are just not shared
+        self.assertEqual(Slot(8, 0), Slot(7, 0) + Vector(1, 0))
+        self.assertFalse(hasattr(Slot(8, 0), '__dict__'))
+
+    def test_make_unmake(self):
+        for _, fen, _ in REFERENCE_POSITIONS:
+            game = Game(fen)
+            game.start_game()
+            state = game.game_state
+            before = (state.to_fen(), state.state_flag, list(state.board))
+            for moves in game.current_moves.values():
+                for move in moves:
+                    for promotion in promotions(move):
+                        state.make_move(move, promotion)
+                        self.assertIsNot(state.next_to_move, before[0].split(' ')[1] == 'w')
+                        state.unmake_move()
+                        self.assertEqual(before, (state.to_fen(), state.state_flag, list(state.board)))
+
+    def test_piece_index(self):
+        def assert_indexed(state: GameState):
+            fresh = GameState.from_fen(state.to_fen())
+            for color in (Color.WHITE, Color.BLACK):
+                self.assertEqual(fresh.piece_squares(color), state.piece_squares(color), state.to_fen())
+                self.assertIs(fresh.find_king(color), state.find_king(color))
+
+        for _, fen, _ in REFERENCE_POSITIONS:
+            game = PerftGame(fen)
+            game.start_game()
+            for _ in game.children():
+                assert_indexed(game.game_state)
+                for _ in game.children():
+                    assert_indexed(game.game_state)
+            assert_indexed(game.game_state)
+            opponent, moving = game.game_state.get_pieces(True)
+            self.assertEqual(sorted(game.game_state.piece_squares(game.game_state.next_to_move)),
+                             sorted(square.flat() for square, _ in moving))
+            self.assertEqual(64 - game.game_state.board.count(None), len(opponent) + len(moving))
+
+    def test_zobrist_key(self):
+        keys = set()
+        for _, fen, _ in REFERENCE_POSITIONS:
+            game = PerftGame(fen)
+            game.start_game()
+            for _ in game.children():
+                state = game.game_state
+                self.assertEqual(state.compute_zobrist_key(), state.zobrist_key(), state.to_fen())
+                self.assertEqual(GameState.from_fen(state.to_fen()).zobrist_key(), state.zobrist_key())
+                keys.add(state.zobrist_key())
+        # every child of every reference position is a different position
+        self.assertEqual(sum(node_counts[0] for _, _, node_counts in REFERENCE_POSITIONS), len(keys))
+
+        # a knight going out and back transposes to the start, move numbers aside
+        game = Game(GameManager.STARTING_POSITION_FEN)
+        game.start_game()
+        start = game.game_state.zobrist_key()
+        for move in ('g1f3', 'g8f6', 'f3g1', 'f6g8'):
+            game.end_turn(game.current_moves.search_move(slot(move[:2]), slot(move[2:])))
+            self.assertEqual(game.game_state.compute_zobrist_key(), game.game_state.zobrist_key())
+        self.assertEqual(start, game.game_state.zobrist_key())
+        # an en passant target nobody can take does not change the position
+        self.assertEqual(GameState.from_fen('4k3/8/8/8/4P3/8/8/4K3 b - e3 0 1').zobrist_key(),
+                         GameState.from_fen('4k3/8/8/8/4P3/8/8/4K3 b - - 0 1').zobrist_key())
+        self.assertNotEqual(GameState.from_fen('4k3/8/8/8/3pP3/8/8/4K3 b - e3 0 1').zobrist_key(),
+                            GameState.from_fen('4k3/8/8/8/3pP3/8/8/4K3 b - - 0 1').zobrist_key())
+
+    def test_repetitions(self):
+        shuffle = ('g1f3', 'g8f6', 'f3g1', 'f6g8')
+        game = Game(GameManager.STARTING_POSITION_FEN)
+        game.start_game()
+        for ply, move in enumerate(shuffle * 2, 1):
+            self.assertFalse(game.game_state.check_flag(GameStateFlag.DRAW), ply)
+            game.end_turn(game.current_moves.search_move(slot(move[:2]), slot(move[2:])))
+        self.assertEqual(3, game.game_state.repetitions())
+        self.assertTrue(game.game_state.check_flag(GameStateFlag.DRAW))
+
+        # twofold is enough for a search, and unmaking forgets the positions
+        game = Game(GameManager.STARTING_POSITION_FEN)
+        game.draw_repetitions = 2
+        game.start_game()
+        state = game.game_state
+        for move in shuffle:
+            state.make_move(game.current_moves.search_move(slot(move[:2]), slot(move[2:])))
+            game.prepare_next_turn()
+        self.assertTrue(state.check_flag(GameStateFlag.DRAW))
+        for _ in shuffle:
+            state.unmake_move()
+        self.assertEqual(1, state.repetitions())
+
+    def test_make_move_side_effects(self):
+        game = Game('r3k2r/8/8/8/1pP5/8/8/R3K2R b KQkq c3 0 1')
+        game.start_game()
+        moves = game.current_moves
+        state = game.game_state
+
+        # en passant removes the captured pawn
+        state.make_move(moves.search_move(*map(slot, ('b4', 'c3'))))
+        self.assertEqual('r3k2r/8/8/8/8/2p5/8/R3K2R w KQkq - 0 2', state.to_fen())
+        state.unmake_move()
+
+        # castle moves the rook and forbids both castles
+        state.make_move(moves.search_move(*map(slot, ('e8', 'c8'))))
+        self.assertEqual('2kr3r/8/8/8/1pP5/8/8/R3K2R w KQ - 1 2', state.to_fen())
+        state.unmake_move()
+
+        # capturing a rook in its corner forbids that castle
+        state.make_move(moves.search_move(*map(slot, ('h8', 'h1'))))
+        self.assertEqual('r3k3/8/8/8/1pP5/8/8/R3K2r w Qq - 0 2', state.to_fen())
+        state.unmake_move()
+        self.assertEqual('r3k2r/8/8/8/1pP5/8/8/R3K2R b KQkq c3 0 1', state.to_fen())
+
+    def test_make_move_promotion(self):
+        game = Game('n1n5/PPPk4/8/8/8/8/4Kppp/5N1N b - - 0 1')
+        game.start_game()
+        state = game.game_state
+        move = game.current_moves.search_move(*map(slot, ('g2', 'h1')))
+        state.make_move(move, PieceType.KNIGHT)
+        self.assertEqual('n1n5/PPPk4/8/8/8/8/4Kp1p/5N1n w - - 0 2', state.to_fen())
+
+    def test_scan_king(self):
+        # knight check plus a bishop pinning the d2 rook
+        game = Game('4k3/8/8/8/1b6/5n2/3R4/4K3 w - - 0 1')
+        game.start_game()
+        restrictor = game.move_generator.restrictor
+        self.assertEqual([slot('f3')], restrictor.checkers)
+        self.assertEqual([slot('c3'), slot('b4')], restrictor.forced_movements_per_piece[slot('d2')])
+        self.assertTrue(restrictor.is_attacked(slot('g1')))
+        self.assertFalse(restrictor.is_attacked(slot('f2')))
+        self.assertEqual({'e1d1', 'e1e2', 'e1f1', 'e1f2'},
+                         {from_int_to_san(m.start.flat()) + from_int_to_san(m.end.flat())
+                          for moves in game.current_moves.values() for m in moves})
+
+    def test_int_codes(self):
+        self.assertEqual((WHITE, PAWN), (WHITE_PAWN.side, WHITE_PAWN.type_value))
+        self.assertEqual((BLACK, KING), (BLACK_KING.side, BLACK_KING.type_value))
+        state = GameState.from_fen('4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1')
+        self.assertEqual((WHITE, FLAG_NORMAL | FLAG_EN_PASSANT), (state.side, state.flags))
+        self.assertIs(Color.WHITE, state.next_to_move)
+        self.assertEqual(GameStateFlag.NORMAL | GameStateFlag.EN_PASSANT, state.state_flag)
+        state.make_packed_move(encode_move(from_san_to_int('e1'), from_san_to_int('e2')))
+        self.assertEqual((BLACK, FLAG_NORMAL), (state.side, state.flags))
+        state.unmake_move()
+        self.assertEqual((WHITE, FLAG_NORMAL | FLAG_EN_PASSANT), (state.side, state.flags))
+        state.raise_flag(GameStateFlag.CHECK)
+        state.raise_flags(FLAG_CHECK)
+        self.assertTrue(state.check_flag(GameStateFlag.DOUBLE_CHECK))
+        self.assertTrue(state.has_flags(FLAG_DOUBLE_CHECK))
+        state.next_to_move = Color.BLACK
+        state.state_flag = GameStateFlag.NORMAL
+        self.assertEqual((BLACK, FLAG_NORMAL), (state.side, state.flags))
+
+    def test_snapshot(self):
+        _, fen, _ = REFERENCE_POSITIONS[1]
+        game = PerftGame(fen)
+        game.start_game()
+        game.play(game.legal_moves()[0], None)
+        state = game.game_state
+        board, before, key = state.board, state.to_fen(), state.zobrist_key()
+        snapshot = state.snapshot()
+        clone = state.clone()
+        for _ in range(2):
+            for _ in range(3):
+                game.play(game.legal_moves()[-1], None)
+            state.restore(snapshot)
+            game.prepare_next_turn()
+            self.assertIs(board, state.board)
+            self.assertEqual((before, key, 1), (state.to_fen(), state.zobrist_key(), state.repetitions()))
+            self.assertEqual(state.compute_zobrist_key(), state.zobrist_key())
+            self.assertEqual({square: piece for square, piece in enumerate(board) if piece is not None},
+                             state.piece_squares(Color.WHITE) | state.piece_squares(Color.BLACK))
+        clone.unmake_move()
+        self.assertEqual(fen, clone.to_fen())
+        self.assertEqual(before, state.to_fen())
+        self.assertIsNot(board, clone.board)
+
+    def test_snapshot_long_game(self):
+        state = GameState.from_fen(GameManager.STARTING_POSITION_FEN)
+        shuffle = [encode_move(start, end) for start, end in ((6, 21), (62, 45), (21, 6), (45, 62))]
+        for ply in range(2000):
+            state.make_packed_move(shuffle[ply % 4])
+        # the position came back every 4 plies
+        self.assertEqual(501, state.repetitions())
+        snapshot = state.snapshot()
+        state.make_packed_move(shuffle[0])
+        state.restore(snapshot)
+        for copied in (copy.deepcopy(state), pickle.loads(pickle.dumps(state)), state.clone()):
+            self.assertEqual((state.zobrist_key(), 501), (copied.zobrist_key(), copied.repetitions()))
+            for _ in range(2000):
+                copied.unmake_move()
+            self.assertEqual(GameManager.STARTING_POSITION_FEN, copied.to_fen())
+        self.assertEqual(501, state.repetitions())
+        # counting goes on from the restored history
+        for ply in range(4):
+            state.make_packed_move(shuffle[ply])
+        self.assertEqual(502, state.repetitions())
+        # a clock older than the history
+        state = GameState.from_fen('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 40 1')
+        for ply in range(8):
+            state.make_packed_move(shuffle[ply % 4])
+            self.assertEqual(1 + (ply + 1) // 4 if ply % 4 == 3 else 1 + ply // 4, state.repetitions())
+        for _ in range(8):
+            state.unmake_move()
+        state.restore(state.snapshot())
+        for ply in range(4):
+            state.make_packed_move(shuffle[ply])
+        self.assertEqual(2, state.repetitions())
+
+    def test_copies_keep_the_key(self):
+        # the d6 target counts in the key only because the e5 pawn can take
+        state = GameState.from_fen('8/8/8/K2pP2r/8/8/8/7k w - d6 0 1')
+        key = state.zobrist_key()
+        self.assertNotEqual(GameState.from_fen('8/8/8/K2pP2r/8/8/8/7k w - - 0 1').zobrist_key(), key)
+        for copied in (copy.deepcopy(state), pickle.loads(pickle.dumps(state)), state.clone()):
+            self.assertEqual(key, copied.zobrist_key())
+            self.assertIs(WHITE_PAWN, copied.board[from_san_to_int('e5')])
+
+    def test_moves(self):
+        game = Game(GameManager.STARTING_POSITION_FEN)
+        game.start_game()
+        generated = list(game.current_moves)
+        # starts no longer adjacent, every group must survive
+        moves = Moves(generated[::2] + generated[1::2])
+        self.assertEqual(20, len(moves))
+        self.assertEqual(sorted(map(str, generated)), sorted(map(str, moves)))
+        self.assertEqual({slot('f3'), slot('h3')}, set(moves.from_start(slot('g1'))))
+        self.assertIs(None, moves.get(slot('e1')))
+        self.assertEqual([], moves.from_start(slot('e1')))
+        self.assertEqual(slot('e4'), moves.search_move(slot('e2'), slot('e4')).end)
+        self.assertIs(None, moves.search_move(slot('e2'), slot('e5')))
+        self.assertTrue(moves.search_end(slot('a3')))
+        self.assertFalse(moves.search_end(slot('e5')))
+        self.assertTrue(Moves([]).isempty())
+
+    def test_packed_move(self):
+        packed = encode_move(54, 63, PieceType.ROOK)
+        self.assertLess(packed, 1 << 16)
+        self.assertEqual((54, 63, PieceType.ROOK, 0), decode_move(packed))
+        game = Game('r3k2r/8/8/3pP3/8/8/8/R3K2R w KQkq d6 0 1')
+        game.start_game()
+        en_passant = game.current_moves.search_move(slot('e5'), slot('d6'))
+        castle = game.current_moves.search_move(slot('e1'), slot('g1'))
+        self.assertEqual(EN_PASSANT_MOVE, decode_move(game.game_state.encode_move(en_passant))[3])
+        self.assertEqual(CASTLE_MOVE, decode_move(game.game_state.encode_move(castle))[3])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+
+from cache import MoveCache, CacheEntry, EvictionPolicy
+from game import Game, GameManager
+from model import GameStateFlag, Slot
+from move_generator import GeneratorBackend
+from perft import REFERENCE_POSITIONS, PerftGame, perft
+from util import from_san_to_int
+
+
+def entry(key: int, depth: int = 0) -> CacheEntry:
+    return CacheEntry(key, [], GameStateFlag.NORMAL, depth)
+
+
+class MyTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = MoveCache(2)
+        cache.put(entry(1))
+        cache.put(entry(2))
+        self.assertIsNotNone(cache.get(1))
+        # 2 is the least recently used now
+        cache.put(entry(3))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(1))
+        self.assertEqual(2, len(cache))
+        self.assertEqual((2, 1, 1), (cache.stats.hits, cache.stats.misses, cache.stats.evictions))
+
+    def test_depth_preferred(self):
+        cache = MoveCache(4, EvictionPolicy.DEPTH_PREFERRED)
+        cache.put(entry(1, depth=3))
+        # same bucket, shallower, rejected
+        cache.put(entry(5, depth=2))
+        self.assertIsNone(cache.get(5))
+        self.assertEqual(3, cache.get(1).depth)
+        # same bucket, as deep, replaces
+        cache.put(entry(9, depth=3))
+        self.assertIsNone(cache.get(1))
+        self.assertIsNotNone(cache.get(9))
+        self.assertEqual(1, cache.stats.evictions)
+
+    def test_perft(self):
+        for policy in EvictionPolicy:
+            for _, fen, node_counts in REFERENCE_POSITIONS[:3]:
+                cache = MoveCache(4096, policy)
+                game = PerftGame(fen, GeneratorBackend.BITBOARD, cache)
+                game.start_game()
+                self.assertEqual(node_counts[2], perft(game, 3), fen)
+                # the second walk is served from the cache, but for bucket collisions
+                hits, misses = cache.stats.hits, cache.stats.misses
+                self.assertEqual(node_counts[2], perft(game, 3), fen)
+                if policy is EvictionPolicy.LRU:
+                    self.assertEqual(misses, cache.stats.misses, fen)
+                self.assertGreater(cache.stats.hits - hits, cache.stats.misses - misses, fen)
+
+    def test_perft_depths(self):
+        # collect the keys of the children, searched 2 plies deeper, and of the grandchildren, 1 ply deeper
+        _, fen, node_counts = REFERENCE_POSITIONS[0]
+        game = PerftGame(fen, GeneratorBackend.BITBOARD)
+        game.start_game()
+        children, grandchildren = [], []
+        for _ in game.children():
+            children.append(game.game_state.zobrist_key())
+            grandchildren.extend(game.game_state.zobrist_key() for _ in game.children())
+        cache = MoveCache(256, EvictionPolicy.DEPTH_PREFERRED)
+        game = PerftGame(fen, GeneratorBackend.BITBOARD, cache)
+        game.start_game()
+        self.assertEqual(node_counts[2], perft(game, 3))
+        buckets = [key % cache.max_entries for key in children]
+        alone = [key for key, bucket in zip(children, buckets) if buckets.count(bucket) == 1]
+        # the grandchildren come after the children and share their buckets, without evicting them
+        self.assertTrue(any(key % cache.max_entries in buckets for key in grandchildren))
+        for key in alone:
+            self.assertEqual(2, cache.get(key).depth)
+
+    def test_game_flags(self):
+        cache = MoveCache()
+        # fool's mate, played twice
+        for _ in range(2):
+            game = Game(GameManager.STARTING_POSITION_FEN, move_cache=cache)
+            game.start_game()
+            for move in ('f2f3', 'e7e5', 'g2g4', 'd8h4'):
+                start, end = (Slot.fromflat(from_san_to_int(square)) for square in (move[:2], move[2:]))
+                game.end_turn(game.current_moves.search_move(start, end))
+            self.assertTrue(game.game_state.check_flag(GameStateFlag.CHECKMATE))
+            self.assertTrue(game.current_moves.isempty())
+        self.assertEqual((5, 5), (cache.stats.hits, cache.stats.misses))
+
+    def test_generator_after_hit(self):
+        moves = [tuple(Slot.fromflat(from_san_to_int(square)) for square in (move[:2], move[2:]))
+                 for move in ('e1g1', 'h3g2')]
+        for backend in GeneratorBackend:
+            cache = MoveCache()
+            game = Game(REFERENCE_POSITIONS[1][1], backend, cache)
+            game.start_game()
+            for start, end in moves:
+                game.end_turn(game.current_moves.search_move(start, end))
+            # the generator of a second game is left on the position before the last move, then served a hit
+            game = Game(REFERENCE_POSITIONS[1][1], backend)
+            game.start_game()
+            game.end_turn(game.current_moves.search_move(*moves[0]))
+            game.move_cache = cache
+            game.end_turn(game.current_moves.search_move(*moves[1]))
+            self.assertEqual(1, cache.stats.hits)
+            generator = game.move_generator
+            self.assertEqual(len(game.current_moves), generator.count_legal())
+            self.assertEqual(sorted(move.as_values() for move in game.current_moves),
+                             sorted(move.as_values() for _, staged in generator.generate_stages() for move in staged))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+from fen import parse_fen, dump_fen, parse_epd, dump_epd, parse_many, dump_many, parse_many_epd
+from model import GameState, WrongFenError
+from randomgames import random_fens
+
+
+class MyTestCase(unittest.TestCase):
+    def test_same_as_game_state(self):
+        fens = random_fens(40) + ['8/8/8/K2pP2r/8/8/8/7k w - d6 0 1']
+        for fen, state in zip(fens, parse_many(fens)):
+            reference = GameState.from_fen(fen)
+            self.assertEqual(fen, dump_fen(state))
+            self.assertEqual(reference.to_fen(), dump_fen(reference))
+            self.assertEqual(list(reference.board), list(state.board))
+            self.assertEqual(reference.state_flag, state.state_flag)
+            self.assertEqual(reference.zobrist_key(), state.zobrist_key())
+        self.assertEqual(fens, list(dump_many(parse_many(['# comment', ''] + fens))))
+
+    def test_wrong_fen(self):
+        for fen in ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0',
+                    'rnbqkbnr/pppppppp/9/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+                    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP w KQkq - 0 1',
+                    'rnbqkbnr/ppppxppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+                    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR x KQkq - 0 1',
+                    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq e9 0 1',
+                    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - a 1'):
+            with self.assertRaises(WrongFenError):
+                parse_fen(fen)
+
+    def test_epd(self):
+        line = 'r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - bm Bb5 Bc4; id "open; game"; hmvc 2;'
+        state, operations = parse_epd(line)
+        self.assertEqual({'bm': ['Bb5', 'Bc4'], 'id': ['open; game'], 'hmvc': ['2']}, operations)
+        self.assertEqual(2, state.halfmove_clock)
+        self.assertEqual(line, dump_epd(state, operations))
+        self.assertEqual('4k3/8/8/8/8/8/8/4K3 b - -', dump_epd(parse_epd('4k3/8/8/8/8/8/8/4K3 b - -')[0]))
+        self.assertEqual([operations], [ops for _, ops in parse_many_epd(['', line])])
+        with self.assertRaises(WrongFenError):
+            parse_epd('4k3/8/8/8/8/8/8/4K3 b - - bm Bb5')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+
+from parser import read_games, read_str_game, PgnGame, ReadStats, IngestStats, replay, san_tokens, split_ranges, \
+    parallel_games, game_result, next_game_start
+
+GAMES = (b'[Event "Rated Blitz game"]\n[White "Alice \\"A\\""]\n[Result "1-0"]\n\n'
+         b'1. e4 { [%clk 0:05:00] } 1... e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n\n'
+         b'[Event "Casual"]\r\n[Result "1/2-1/2"]\r\n\r\n1. d4 d5\r\n2. c4 1/2-1/2\r\n'
+         # no blank lines around the movetext
+         b'[Event "Tight"]\n[Result "0-1"]\n1. f3 e5 2. g4 Qh4# 0-1\n'
+         b'[Event "Last"]\n\n*')
+
+# castles, a capture, a disambiguated knight, a variation and comments
+OPENING = (b'[Event "Opening"]\n[Result "*"]\n\n1. e4 e5 2. Nf3 Nc6 3. Bc4 (3. Bb5 a6) Nf6 4. O-O Be7 5. d4 exd4 '
+           b'6. Nxd4 O-O {castled} 7. Nc3 d6 8. Nce2 $1 *\n\n')
+PROMOTION = b'[Event "Promotion"]\n[FEN "8/P7/8/8/8/8/8/k6K w - - 0 1"]\n\n1. a8=Q+ Kb2 2. Qb8+ Kc2 *\n\n'
+SLOW_GAME_SECONDS = 0.05
+
+
+def slow_result(game: PgnGame) -> str:
+    time.sleep(SLOW_GAME_SECONDS)
+    return game_result(game)
+
+
+class MyTestCase(unittest.TestCase):
+    def test_read_games(self):
+        games = list(read_games(io.BytesIO(GAMES)))
+        self.assertEqual(['Rated Blitz game', 'Casual', 'Tight', 'Last'], [game.tags['Event'] for game in games])
+        self.assertEqual('Alice "A"', games[0].tags['White'])
+        self.assertEqual('1. e4 { [%clk 0:05:00] } 1... e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0', games[0].movetext)
+        self.assertEqual('1. d4 d5\r\n2. c4 1/2-1/2', games[1].movetext)
+        self.assertEqual('1. f3 e5 2. g4 Qh4# 0-1', games[2].movetext)
+        self.assertEqual(({'Event': 'Last'}, '*'), (games[3].tags, games[3].movetext))
+        for game in games:
+            self.assertTrue(GAMES.startswith(b'[Event', game.offset))
+
+    def test_chunk_sizes(self):
+        expected = [str(game) for game in read_games(io.BytesIO(GAMES))]
+        for chunk_size in range(1, 64):
+            stats = ReadStats()
+            self.assertEqual(expected, [str(game) for game in read_games(io.BytesIO(GAMES), chunk_size, stats)])
+            self.assertEqual((len(GAMES), 4), (stats.bytes_read, stats.games))
+        self.assertEqual([], list(read_games(io.BytesIO(b'\n\n'))))
+
+    def test_read_str_game(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'games.pgn')
+            with open(filename, 'wb') as file:
+                file.write(GAMES)
+            self.assertEqual(PgnGame.parse(GAMES.decode().split('\n\n[')[0]).movetext, read_str_game(filename))
+            self.assertEqual(4, sum(1 for _ in read_games(filename)))
+
+    def test_replay(self):
+        opening, promotion = read_games(io.BytesIO(OPENING + PROMOTION))
+        self.assertEqual(['e4', 'e5', 'Nf3', 'Nc6', 'Bc4', 'Nf6', 'O-O'], san_tokens(opening.movetext)[:7])
+        self.assertEqual(15, replay(opening))
+        self.assertEqual(4, replay(promotion))
+        # parentheses in comments are not variations
+        self.assertEqual(['e4', 'e5', 'Nf3'], san_tokens('1. e4 {a smiley :( here} e5 2. Nf3 ; or :)\n*'))
+        with self.assertRaises(ValueError):
+            replay(PgnGame({}, '1. e4 e5 2. Ke3 *', 0))
+
+    def test_parallel_games(self):
+        data = (OPENING + PROMOTION + GAMES + b'\n\n') * 10
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'games.pgn')
+            with open(filename, 'wb') as file:
+                file.write(data)
+            ranges = list(split_ranges(filename, 100))
+            self.assertLess(1, len(ranges))
+            self.assertEqual((0, len(data)), (ranges[0][0], ranges[-1][1]))
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, start)
+                self.assertTrue(data.startswith(b'[Event', start))
+            # a probe too small for a whole game grows until it finds the next one
+            with open(filename, 'rb') as file:
+                for position in range(1, len(data), 37):
+                    self.assertEqual(next_game_start(file, position), next_game_start(file, position, 1))
+            expected = [str(game) for game in read_games(filename)]
+            stats = IngestStats()
+            self.assertEqual(expected, list(parallel_games(filename, str, 2, True, 300, stats=stats)))
+            self.assertEqual((len(expected), len(data)), (stats.total.games, stats.total.bytes_read))
+            results = list(parallel_games(filename, game_result, 2, False, 300))
+            self.assertEqual(sorted(map(game_result, read_games(filename))), sorted(results))
+
+    def test_parallel_games_early_exit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'games.pgn')
+            with open(filename, 'wb') as file:
+                file.write(GAMES * 20)
+            games = parallel_games(filename, slow_result, 1, True, 2000)
+            next(games)
+            # neither the range being processed nor the ones queued behind it are waited for
+            began = time.perf_counter()
+            games.close()
+            self.assertLess(time.perf_counter() - began, 10 * SLOW_GAME_SECONDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
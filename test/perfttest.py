@@ -0,0 +1,88 @@
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from model import GameStateFlag
+from move_generator import GeneratorBackend
+from perft import REFERENCE_POSITIONS, PerftGame, run_perft, divide, perft, parallel_divide
+
+
+class MyTestCase(unittest.TestCase):
+    depth: int = 2
+
+    def check_reference_positions(self, backend: GeneratorBackend):
+        for name, fen, node_counts in REFERENCE_POSITIONS:
+            for depth, expected in enumerate(node_counts[:self.depth], 1):
+                result = run_perft(name, fen, depth, expected, backend)
+                self.assertTrue(result.is_correct(), result)
+
+    def test_objects(self):
+        self.check_reference_positions(GeneratorBackend.OBJECTS)
+
+    def test_bitboard(self):
+        self.check_reference_positions(GeneratorBackend.BITBOARD)
+
+    def test_packed(self):
+        for backend in GeneratorBackend:
+            for name, fen, node_counts in REFERENCE_POSITIONS:
+                result = run_perft(name, fen, self.depth, node_counts[self.depth - 1], backend, packed=True)
+                self.assertTrue(result.is_correct(), result)
+
+    def test_count_legal(self):
+        mate = 'rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3'
+        stalemate = '7k/5Q2/6K1/8/8/8/8/8 b - - 0 1'
+        for backend in GeneratorBackend:
+            for name, fen, node_counts in REFERENCE_POSITIONS:
+                game = PerftGame(fen, backend)
+                game.start_game()
+                self.assertEqual(node_counts[0], game.move_generator.count_legal(), name)
+                self.assertTrue(game.move_generator.has_legal_move(), name)
+            for fen, flag in ((mate, GameStateFlag.CHECKMATE), (stalemate, GameStateFlag.STALEMATE)):
+                game = PerftGame(fen, backend)
+                game.start_game()
+                self.assertEqual(0, game.move_generator.count_legal())
+                self.assertFalse(game.move_generator.has_legal_move())
+                self.assertTrue(game.game_state.check_flag(flag), fen)
+
+    def test_divide(self):
+        _, fen, node_counts = REFERENCE_POSITIONS[-1]
+        game = PerftGame(fen, GeneratorBackend.BITBOARD)
+        game.start_game()
+        counts = divide(game, 2)
+        self.assertEqual(node_counts[1], sum(counts.values()))
+        self.assertEqual(perft(game, 2), sum(counts.values()))
+        # every promotion is a root move of its own
+        for piece in 'qrbn':
+            self.assertIn('g2h1' + piece, counts)
+
+    def test_parallel_divide(self):
+        _, fen, node_counts = REFERENCE_POSITIONS[-1]
+        game = PerftGame(fen, GeneratorBackend.BITBOARD)
+        game.start_game()
+        expected = divide(game, 3)
+        with ProcessPoolExecutor(2) as pool:
+            for split in (1, 2):
+                result = parallel_divide(fen, 3, GeneratorBackend.BITBOARD, split=split, pool=pool)
+                self.assertEqual(expected, result.counts)
+                self.assertEqual(sum(expected.values()), sum(stats.nodes for stats in result.workers.values()))
+            # the same pool serves every depth of the benchmark
+            for depth in (1, 2):
+                result = run_perft('', fen, depth, node_counts[depth - 1], GeneratorBackend.BITBOARD,
+                                   workers=2, pool=pool)
+                self.assertTrue(result.is_correct())
+        with self.assertRaises(ValueError):
+            parallel_divide(fen, 0, GeneratorBackend.BITBOARD, workers=2)
+
+    def test_parallel_divide_mating_move(self):
+        # d8h4 mates, nothing is left two plies below it
+        fen = 'rnbqkbnr/pppp1ppp/8/4p3/6P1/5P2/PPPPP2P/RNBQKBNR b KQkq g3 0 2'
+        game = PerftGame(fen, GeneratorBackend.BITBOARD)
+        game.start_game()
+        expected = divide(game, 2)
+        self.assertEqual(0, expected['d8h4'])
+        with ProcessPoolExecutor(2) as pool:
+            result = parallel_divide(fen, 2, GeneratorBackend.BITBOARD, split=2, pool=pool)
+        self.assertEqual(expected, result.counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
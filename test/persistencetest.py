@@ -0,0 +1,49 @@
+import io
+import unittest
+
+from fen import parse_fen, dump_fen
+from persistence import RECORD_SIZE, CorruptRecordError, encode, decode, encode_into, encode_many, decode_many, \
+    dump, load
+from randomgames import random_fens
+
+
+class MyTestCase(unittest.TestCase):
+    fens = random_fens(40) + ['8/8/8/K2pP2r/8/8/8/7k w - d6 0 1',
+                              'rnbqkbnr/pppp1ppp/8/8/3pP3/8/PPP2PPP/RNBQKBNR b KQkq e3 0 3']
+
+    def test_round_trip(self):
+        for fen in self.fens:
+            state = parse_fen(fen)
+            record = encode(state)
+            self.assertEqual(RECORD_SIZE, len(record))
+            decoded = decode(record)
+            self.assertEqual(fen, dump_fen(decoded))
+            self.assertEqual(state.zobrist_key(), decoded.zobrist_key())
+            self.assertEqual(state.state_flag, decoded.state_flag)
+
+    def test_bulk(self):
+        states = list(map(parse_fen, self.fens))
+        buffer = encode_many(states)
+        self.assertEqual(self.fens, [dump_fen(state) for state in decode_many(memoryview(buffer))])
+        writable = bytearray(RECORD_SIZE * 2)
+        encode_into(writable, RECORD_SIZE, states[1])
+        self.assertEqual(self.fens[1], dump_fen(decode(writable, RECORD_SIZE)))
+
+        file = io.BytesIO()
+        self.assertEqual(len(states), dump(states, file))
+        file.seek(0)
+        self.assertEqual(self.fens, [dump_fen(state) for state in load(file)])
+
+    def test_corrupt(self):
+        record = bytearray(encode(parse_fen(self.fens[0])))
+        record[0] = 0xFF
+        with self.assertRaises(CorruptRecordError):
+            decode(record)
+        with self.assertRaises(CorruptRecordError):
+            list(decode_many(bytes(RECORD_SIZE + 1)))
+        with self.assertRaises(ValueError):
+            encode(parse_fen('4k3/8/8/8/8/8/8/4K3 w - - 300 1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
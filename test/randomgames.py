@@ -0,0 +1,22 @@
+"""
+Positions of random games shared by the tests, with no dependency beyond the engine
+"""
+import random
+
+from model import PROMOTION_PIECETYPES
+from move_generator import GeneratorBackend
+from perft import REFERENCE_POSITIONS, PerftGame
+
+
+def random_fens(plies: int, seed: int = 0) -> list[str]:
+    rng, fens = random.Random(seed), []
+    for _, fen, _ in REFERENCE_POSITIONS:
+        game = PerftGame(fen, GeneratorBackend.BITBOARD)
+        game.start_game()
+        for _ in range(plies):
+            fens.append(game.game_state.to_fen())
+            moves = game.legal_moves()
+            if not moves:
+                break
+            game.play(rng.choice(moves), rng.choice(PROMOTION_PIECETYPES))
+    return fens